@@ -0,0 +1,51 @@
+import torch
+
+class ControlVec():
+    # M episodes of Env.Linear or Env.NonLinear stepped together with the batched getNextState/getReward
+    # of the scalar env. State x [M, x_dim], every env keeps its own step counter k [M]. Follows the
+    # scalar step: the k slot of the next state holds the step index before the increment and the last
+    # step returns the terminal cost only. Finished envs are reset automatically.
+    def __init__(self, Env, M=16):
+        self.Env = Env
+        self.M = M
+        self.N = Env.N
+        self.IS_K = Env.IS_K
+        self.u_dim = Env.u_dim
+        self.x_dim = Env.x_dim
+        self.umin, self.umax = Env.umin, Env.umax
+        self.xmean, self.xstd = Env.xmean, Env.xstd
+        self.dp = Env.dp
+        self.vp = Env.vp
+
+        self.x = torch.zeros((M, self.x_dim))
+        self.k = torch.zeros(M, dtype=torch.long)
+        self.reset()
+
+    def resetEnvs(self, envIdx):
+        self.x[envIdx] = self.Env.resetState(envIdx.numel())
+        self.k[envIdx] = 0
+
+    def step(self, u):
+        u = torch.as_tensor(u, dtype=torch.float32).reshape(self.M, self.u_dim)
+        info = {}
+
+        x_next = self.Env.getNextState(self.x, u, self.k)
+        self.k = self.k + 1
+        reward = self.Env.getReward(x_next, u, self.k)
+        done = (self.k == self.N)
+        self.x = x_next
+
+        # auto-reset finished envs, their last observation goes to info
+        observationNext = x_next.clone()
+        if torch.any(done):
+            idxDone = torch.nonzero(done).reshape(-1)
+            info['final_observation'] = x_next[idxDone].clone()
+            info['_final_observation'] = done.clone()
+            self.resetEnvs(idxDone)
+            observationNext[idxDone] = self.x[idxDone]
+
+        return observationNext, reward, done, torch.zeros_like(done), info
+
+    def reset(self):
+        self.resetEnvs(torch.arange(self.M))
+        return self.x.clone(), {}
@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+from gym import spaces
+from .LQT import LQT
+
+class LQTVec():
+    # M LQT episodes stepped together, state x [M, 4] and every env keeps its own step counter k [M].
+    # References are drawn from a bank of bankSize precomputed (A, B, w) sine trajectories dp [bankSize, N+1, 4]
+    # instead of being generated on every reset. Finished envs are reset automatically.
+    def __init__(self, M=16, N=50, dt=0.1, args=None, bankSize=4096):
+        # a scalar LQT is kept around for the model and cost matrices
+        self.Env = LQT(N=N, dt=dt, args=args)
+        Env = self.Env
+        self.M = M
+        self.N = N
+        self.dt = dt
+        self.n = Env.n
+        self.m = Env.m
+        self.u_dim = Env.u_dim
+        self.umin, self.umax = Env.umin, Env.umax
+        self.obs_dim = Env.obs_dim
+        self.x_dim = Env.x_dim
+        self.with_ref = Env.with_ref
+
+        # transposed once so that a batch of row vectors is stepped as x @ A^T + u @ B^T
+        self.AT = Env.A.T.contiguous()
+        self.BT = Env.B.T.contiguous()
+        self.Q = Env.Q
+        self.R = Env.R
+        self.Qf = Env.Qf
+
+        self.action_space = spaces.Box(low=-1.0, high=1.0, shape=(2,), dtype=np.float32)
+        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(4,), dtype=np.float32)
+
+        self.bankSize = bankSize
+        self.generateBank()
+
+        self.x = torch.zeros((M, self.n))
+        self.k = torch.zeros(M, dtype=torch.long)
+        self.refIdx = torch.zeros(M, dtype=torch.long)
+        self.random_state = False
+        self.reset()
+
+    def generateBank(self):
+        # same distribution as LQT.generate_reference_trajectory, drawn for the whole bank at once
+        t_series = np.arange(self.N + 1) * self.dt
+        A = np.random.uniform(0.0, 5.0, self.bankSize)
+        B = np.random.uniform(0.0, 5.0, self.bankSize)
+        w = np.random.uniform(0.01, 0.3, self.bankSize)
+
+        x = A[:,None] * np.sin(w[:,None] * t_series)
+        y = B[:,None] * np.sin(w[:,None] * t_series)
+        vx = np.gradient(x, self.dt, axis=1)
+        vy = np.gradient(y, self.dt, axis=1)
+
+        self.bankDp = torch.as_tensor(np.stack([x, y, vx, vy], axis=2), dtype=torch.float32)  # [bankSize, N+1, 4]
+        self.bankPara = torch.as_tensor(np.stack([A, B, w], axis=1), dtype=torch.float32)     # [bankSize, 3]
+
+    def resetEnvs(self, envIdx):
+        n = envIdx.numel()
+        if self.random_state:
+            self.x[envIdx] = torch.column_stack((torch.empty(n, 2).uniform_(-1.0, 1.0), torch.zeros(n, 2)))
+        else:
+            self.x[envIdx] = 0
+        self.k[envIdx] = 0
+        self.refIdx[envIdx] = torch.randint(0, self.bankSize, (n,))
+
+    def observation(self, envIdx=None):
+        if envIdx is None:
+            envIdx = torch.arange(self.M)
+        if self.with_ref:
+            return torch.column_stack((self.x[envIdx], self.k[envIdx].float(), self.bankPara[self.refIdx[envIdx]]))
+        return self.x[envIdx].clone()
+
+    def get_dp(self, k, envIdx=None):
+        # reference of every env at its own step k [M], [M, 4]
+        if envIdx is None:
+            envIdx = torch.arange(self.M)
+        return self.bankDp[self.refIdx[envIdx], k]
+
+    def quadCost(self, e, W):
+        # e_m^T W e_m for every row of e
+        return ((e @ W) * e).sum(dim=1)
+
+    def step(self, action):
+        action = torch.as_tensor(action, dtype=torch.float32).reshape(self.M, self.m)
+        action = torch.clamp(action, -1.0, 1.0)
+        info = {}
+
+        e = self.x - self.get_dp(self.k)
+        cost = self.quadCost(e, self.Q) + self.quadCost(action, self.R)
+
+        self.x = self.x @ self.AT + action @ self.BT
+        self.k = self.k + 1
+
+        done = (self.k >= self.N)
+        eN = self.x - self.get_dp(torch.clamp(self.k, max=self.N))
+        cost = cost + torch.where(done, self.quadCost(eN, self.Qf), torch.zeros_like(cost))
+        cost = cost*0.01
+        observationNext = self.observation()
+
+        # auto-reset finished envs, their last observation goes to info
+        if torch.any(done):
+            idxDone = torch.nonzero(done).reshape(-1)
+            info['final_observation'] = observationNext[idxDone].clone()
+            info['_final_observation'] = done.clone()
+            self.resetEnvs(idxDone)
+            observationNext[idxDone] = self.observation(idxDone)
+
+        return observationNext, -cost, done, done.clone(), info
+
+    def reset(self, random_state=False):
+        self.random_state = random_state
+        self.resetEnvs(torch.arange(self.M))
+        return self.observation(), {}
@@ -60,35 +60,41 @@ class Linear:
         self.vp = 0
         
     def reset(self):
-        import random
         self.k = 0
-        if self.IS_K:
-            self.x = torch.tensor([random.uniform(-2,2),self.k])         
-        else:
-            self.x = torch.tensor([random.uniform(-2,2)])
+        self.x = self.resetState()
         return self.x, None
-    
-    def getReward(self, x, u):
-        if self.k == self.N:
-            tc = 0.5*x[0]**2 
-            return -tc.unsqueeze(-1)
-        else:
-            sc = 0.5*u**2 
-            return -sc
-    
-    def step(self, u):  
+
+    def resetState(self, n=None):
+        # random initial states [x_dim], or [n, x_dim] for n episodes, with the k slot at 0
+        shape = (1,) if n is None else (n, 1)
+        x = torch.empty(shape).uniform_(-2, 2)
+        if self.IS_K:
+            x = torch.cat((x, torch.zeros(shape[:-1] + (1,))), dim=-1)
+        return x
+
+    def getReward(self, x, u, k=None):
+        # x [x_dim] or [B, x_dim], u [u_dim] or [B, u_dim], k: step counter (int or [B]), self.k by default
+        # stage cost, or the terminal cost alone where k == N; returns [1] or [B]
+        k = self.k if k is None else k
+        xb = x.reshape(-1, self.x_dim)
+        ub = torch.as_tensor(u, dtype=xb.dtype).reshape(-1, self.u_dim)
+        tc = 0.5*xb[:,0]**2
+        sc = 0.5*(ub**2).sum(-1)
+        return -torch.where(torch.as_tensor(k) == self.N, tc, sc)
+
+    def step(self, u):
         x_next = self.getNextState(self.x, u)
         self.x = x_next
         self.k += 1
         done = (self.k == self.N)
-        return x_next, self.getReward(x_next, u), done, False, None    
-        
-    def getNextState(self, x, u):
+        return x_next, self.getReward(x_next, u), done, False, None
+
+    def getNextState(self, x, u, k=None):
+        # x [x_dim] or [B, x_dim], u [u_dim] or [B, u_dim]; the k slot is set to k (int or [B]), self.k by default
+        xb = x.reshape(-1, self.x_dim)
+        ub = torch.as_tensor(u, dtype=xb.dtype).reshape(-1, self.u_dim)
+        x_next = xb[:,:1] + ub
         if self.IS_K:
-            x_next = x + u
-            x_next[1] = self.k
-        else:
-            x_next = x + u
-        return x_next
-    
-        
\ No newline at end of file
+            k = self.k if k is None else k
+            x_next = torch.column_stack((x_next, torch.as_tensor(k, dtype=xb.dtype).expand(xb.shape[0])))
+        return x_next.reshape(x.shape)
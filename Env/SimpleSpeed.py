@@ -6,6 +6,7 @@ import random
 import torch
 import h5py
 import plotly.graph_objects as go
+from .TrafficCache import TrafficCache
 
 def plot_Q(self):
     from Env.SimpleSpeed import TerminalReward
@@ -92,6 +93,52 @@ def TerminalReward(state,dp_final,vp_final):
     dsafe = vf*ht + dmin 
     reward = w5*(df-dsafe)**2 +w6*(vf)**2
     return reward
+
+def LagrangeBasis(tIntBeg, tIntEnd, tauList):
+    # LGL nodes of every interval and the inverse of their Vandermonde matrices [nIntvl, n+1, n+1],
+    # column k of invV[i] holds the coefficients (lower order first) of the k-th Lagrange basis polynomial of interval i
+    tList = ((1-tauList)*np.reshape(tIntBeg,(-1,1)) + (1+tauList)*np.reshape(tIntEnd,(-1,1)))/2
+    V = tList[:,:,None]**np.arange(len(tauList))
+    return tList, np.linalg.inv(V)
+
+def polyFeatures(fArr, k, dt):
+    # fArr [p0,p1,p2,p3] -> p3*t^3+p2*t^2+p1*t+p0, shared [nIntvl, nPoly+1] or per row [B, nIntvl, nPoly+1]
+    # returns p3*t^3, p2*t^2, p1*t, p1*t+p0 per interval, [B, nIntvl*(nPoly+1)]
+    nPoly = fArr.shape[-1]-1
+    order = torch.arange(nPoly, 0, -1)
+    tPow = (dt*(k.float()+1)).reshape(-1, 1, 1)**order.reshape(1, 1, -1)
+    poly = fArr[...,order]*tPow
+    last = poly[...,-1] + fArr[...,0]
+    return torch.cat((poly, last.unsqueeze(-1)), dim=-1).reshape(k.shape[0], -1)
+
+def speedModel(Env):
+    # SimpleSpeed dynamics and cost constants as a plain dict, picklable for worker processes
+    return {'dt': Env.dt,
+            'N': Env.N,
+            'w1': Env.w1, 'w2': Env.w2, 'w3': Env.w3, 'w4': Env.w4, 'w5': Env.w5, 'w6': Env.w6,
+            'ht': Env.ht,
+            'dmin': Env.dmin, 'dmax': Env.dmax,
+            'vmin': Env.vmin, 'vmax': Env.vmax,
+            'p1': Env.Veh['p1'], 'p2': Env.Veh['p2'], 'p3': Env.Veh['p3'],
+            }
+
+# SimpleSpeed dynamics and positive costs on broadcastable torch tensors or numpy arrays alike,
+# the reward is -0.01*(speedActionCost + speedDistanceCost) and -0.01*speedTerminalCost at k == N
+def speedNextState(model, d, v, a):
+    return d + model['dt']*v, (v + model['dt']*a).clip(model['vmin'], model['vmax'])
+
+def speedActionCost(model, v, a):
+    pow = model['p1']*v + model['p2']*(v**3) + model['p3']*(v*a)
+    return model['w1']*(a**2) + model['w2']*pow
+
+def speedDistanceCost(model, d, dp):
+    df = dp - d
+    return model['w3']*(df-model['dmax']).clip(min=0)**2 + model['w4']*(model['dmin']-df).clip(min=0)**2
+
+def speedTerminalCost(model, d, v, dpN, vpN):
+    df = dpN - d
+    dmin = model['ht']*vpN + model['dmin']
+    return model['w5']*(df-dmin)**2 + model['w6']*(vpN-v)**2
     
 class SimpleSpeed():
     def __init__(self, dataPath, SELECT_PREC_ID=None, SELECT_OBSERVATION='state', options={}):
@@ -157,29 +204,26 @@ class SimpleSpeed():
             self.OLD_FASHION = options['EnableOldFashion']
         else:
             self.OLD_FASHION = False
+        # memory-mapped dataset from buildTrafficCache.py, replaces both file formats
+        if 'TrafficCache' in options.keys():
+            self.TRAFFIC_CACHE = options['TrafficCache']
+            self.OLD_FASHION = False
+        else:
+            self.TRAFFIC_CACHE = None
+        # traffic data is opened once and kept, see updatePrecedingVehicle
+        self.TrafficData = None
+        self.WindowIndex = {}
+        self.LagrangeCache = {}
         self.reset(options=options)
 
 
 
-    def __GetLagrangeCoeff(self, n, x, y):
-        L = [1]*(n+1)
-        Lbasis = [1]*(n+1)
-
-        # try to get combined coefficients
-        for k in range(0, n+1): # start the outer loop through the data values for x
-            
-            for kk in range(0, (k)): # start the inner loop through the data values for x (if k = 0 this loop is not executed)
-                L[k] = np.polymul(L[k],[1/(x[k]-x[kk]), - x[kk]/(x[k]-x[kk])]) # see the Lagrange interpolating polynomials
-            
-            for kk in range(k+1, n+1): # start the inner loop through the data values (if k = n this loop is not executed)
-                L[k] = np.polymul(L[k],[1/(x[k]-x[kk]), - x[kk]/(x[k]-x[kk])]) # see the Lagrange interpolating polynomials
-
-            pass
-            Lbasis[k] = L[k]
-            L[k] = y[k]*L[k]
-
-        L = np.sum(np.array(L), axis=0)
-        return L, Lbasis
+    def getLagrangeBasis(self, tIntBeg, tIntEnd, tauList):
+        # the interval grid only depends on the horizon, so the basis is computed once per horizon
+        key = (len(tIntBeg), tIntBeg[0], tIntEnd[-1])
+        if key not in self.LagrangeCache:
+            self.LagrangeCache[key] = LagrangeBasis(tIntBeg, tIntEnd, tauList)
+        return self.LagrangeCache[key]
     
     def tylor_approx_features(self, x, num_segments=3, max_order=4):
         x = np.asarray(x)
@@ -203,6 +247,66 @@ class SimpleSpeed():
         return np.array(features)
     
     
+    def buildWindowIndex(self, tHorizon):
+        # one pass over the hdf5 file: for each vehicle, the windows a random reset can start, the same
+        # ones the old retry loop accepted. A window begins at a whole second tBeg (clipped to
+        # [time[0], time[-1]-tHorizon]) on the first sample at or after it, has all tHorizon/dt+1 samples
+        # (no lane change gap) and a mean speed >= 2. Stored CSR-style: vehicle j owns the sample
+        # indices starts[offsets[j]:offsets[j+1]]
+        nSample = int(tHorizon/self.dt+1)
+        vehIdx = []
+        starts = []
+        offsets = [0]
+        for j, vehId in enumerate(self.vehNames):
+            time = np.array(self.TrafficData[vehId]['time']).reshape(-1)
+            speed = np.array(self.TrafficData[vehId]['speed']).reshape(-1)
+            if time.size < nSample:
+                continue
+            tLast = time[-1]-tHorizon
+            tBeg = np.unique(np.clip(np.arange(np.round(time[0]), np.round(tLast)+1), time[0], tLast))
+            iBeg = np.searchsorted(time, tBeg-1e-7, side='left')
+            iEnd = np.searchsorted(time, tBeg+tHorizon+1e-7, side='right')
+            valid = (iEnd-iBeg == nSample)
+            speedSum = np.concatenate(([0], np.cumsum(speed)))
+            iBeg = iBeg[valid]
+            vpAvrg = (speedSum[iBeg+nSample]-speedSum[iBeg])/nSample
+            iBeg = np.unique(iBeg[vpAvrg >= 2])
+            if iBeg.size == 0:
+                continue
+            vehIdx.append(j)
+            starts.append(iBeg.astype(np.int32))
+            offsets.append(offsets[-1]+iBeg.size)
+
+        self.WindowIndex[tHorizon] = {'vehIdx': np.array(vehIdx, dtype=np.int32),
+                                      'offsets': np.array(offsets, dtype=np.int64),
+                                      'starts': np.concatenate(starts) if starts else np.empty(0, dtype=np.int32),
+                                      'filtered': {}}
+        return self.WindowIndex[tHorizon]
+
+    def drawWindow(self, tHorizon, DataFilterFunc=None):
+        # O(1): uniform over all valid windows, so a vehicle is drawn in proportion to its number of
+        # windows as with the old rejection sampling. Returns the vehicle name and the start sample index
+        if tHorizon not in self.WindowIndex:
+            self.buildWindowIndex(tHorizon)
+        Index = self.WindowIndex[tHorizon]
+        offsets = Index['offsets']
+        if DataFilterFunc is None:
+            nWindow = Index['starts'].size
+        else:
+            if DataFilterFunc not in Index['filtered']:
+                # positions in starts of the windows of the vehicles that pass the filter
+                vehNamesFiltered = set(DataFilterFunc(self.vehNames))
+                jList = [j for j, i in enumerate(Index['vehIdx']) if self.vehNames[i] in vehNamesFiltered]
+                Index['filtered'][DataFilterFunc] = np.concatenate([np.arange(offsets[j], offsets[j+1]) for j in jList]) if jList else np.empty(0, dtype=np.int64)
+            nWindow = Index['filtered'][DataFilterFunc].size
+        if nWindow == 0:
+            raise ValueError('no preceding vehicle has a valid {}s window in {}'.format(tHorizon, self.dataPath))
+        r = np.random.randint(nWindow)
+        if DataFilterFunc is not None:
+            r = Index['filtered'][DataFilterFunc][r]
+        j = np.searchsorted(offsets, r, side='right')-1
+        return self.vehNames[Index['vehIdx'][j]], int(Index['starts'][r])
+
     #def updatePrecedingVehicle(self, SELECT_PREC_ID=None, DATA_FILTER=None, IS_INIT=False, T_BEG=None, T_HORIZON=None, INIT_STATE=None):
     def updatePrecedingVehicle(self, options={}):
         # parser options
@@ -241,16 +345,27 @@ class SimpleSpeed():
             RAND_VEH = False
 
         if self.OLD_FASHION:
-            self.TrafficData = scipy.io.loadmat(self.dataPath)
-            # remove not needed keys
-            del self.TrafficData['__header__']
-            del self.TrafficData['__version__']
-            del self.TrafficData['__globals__']
-            self.vehNames = sorted(self.TrafficData)
+            if self.TrafficData is None:
+                self.TrafficData = scipy.io.loadmat(self.dataPath)
+                # remove not needed keys
+                del self.TrafficData['__header__']
+                del self.TrafficData['__version__']
+                del self.TrafficData['__globals__']
+                self.vehNames = sorted(self.TrafficData)
         else:
             # print(self.dataPath)
-            self.TrafficData = h5py.File(self.dataPath, 'r')
-            self.vehNames = np.array(sorted(self.TrafficData))[1:]
+            if self.TrafficData is None and self.TRAFFIC_CACHE is not None:
+                self.TrafficData = TrafficCache(self.TRAFFIC_CACHE)
+                self.vehNames = self.TrafficData.vehNames
+            elif self.TrafficData is None:
+                self.TrafficData = h5py.File(self.dataPath, 'r')
+                self.vehNames = np.array(sorted(self.TrafficData))[1:]
+
+            # randomdize time
+            if T_HORIZON is None:
+                tHorizon = 15
+            else:
+                tHorizon = T_HORIZON
 
             # randomdize vehicle
             # if speed is almost all zero, we want to skip it to next time or speed
@@ -260,6 +375,7 @@ class SimpleSpeed():
             NOT_VALID = True
             while NOT_VALID: #vpAvrg < 2:
 
+                tBegIdxSel = None
                 if PrecInfo is not None:
                     time = PrecInfo['t']
                     distance = PrecInfo['d']
@@ -276,8 +392,11 @@ class SimpleSpeed():
                     distance = self.TrafficData[vehId][0][0][3][0]
                     speed = self.TrafficData[vehId][0][0][4][0]
                 else:
-                    # we do a find every time Env.reset(), this is still ok for tens of thousands of data
-                    if RAND_VEH:
+                    if RAND_VEH and T_BEG is None:
+                        # draw from the precomputed valid windows, no retry needed
+                        vehId, tBegIdxSel = self.drawWindow(tHorizon, DataFilterFunc)
+                        SELECT_PREC_ID = int(vehId.split('_')[1])
+                    elif RAND_VEH:
                         if DataFilterFunc is None:
                             vehId = np.random.choice(self.vehNames)
                         else:
@@ -291,14 +410,10 @@ class SimpleSpeed():
                     distance = np.array(self.TrafficData[vehId]['distance']).reshape(-1)
                     speed = np.array(self.TrafficData[vehId]['speed']).reshape(-1)
 
-                # randomdize time
-                if T_HORIZON is None:
-                    tHorizon = 15
-                else:
-                    tHorizon = T_HORIZON
-
                 # normalize time first
-                if T_BEG is None:
+                if tBegIdxSel is not None:
+                    tBegSel = time[tBegIdxSel]
+                elif T_BEG is None:
                     tBegSel = round(np.random.uniform(time[0], time[-1]-tHorizon))
                 else:
                     #tBegSel = time[0]+2 # time[0]+14
@@ -341,20 +456,14 @@ class SimpleSpeed():
             #tauList = legendre_gauss_lobatto_nodes(n)
             tauList = np.array([-1.0, -0.4472135954999579, 0.4472135954999579, 1.0])
 
-            fArr = [np.nan]*len(tIntBeg)
-            fBasis = [np.nan]*(len(tIntBeg))
-            dpBasis = [np.nan]*(len(tIntBeg))
-            for i, _ in enumerate(tIntBeg):
-                tList = ((1-tauList)*tIntBeg[i] + (1+tauList)*tIntEnd[i])/2
-                dpVal = np.interp(tList, t, dp)
-
-                L, Lbasis = self.__GetLagrangeCoeff(n,tList,dpVal)
-
-                fArr[i] = np.flip(L)
-                fBasis[i] = np.array(Lbasis)
-                dpBasis[i] = dpVal
+            # all intervals at once: coefficients = invV @ dp at the LGL nodes
+            tList, invV = self.getLagrangeBasis(tIntBeg, tIntEnd, tauList)
+            dpBasis = np.interp(tList, t, dp)
+            fArr = np.matmul(invV, dpBasis[:,:,None])[:,:,0]
+            fBasis = np.flip(np.transpose(invV, (0,2,1)), axis=-1) # row k is the k-th basis polynomial, higher order first
 
             self.fArr = fArr # coefficients of lower order first, higher order last [p0,p1,p2,p3] -> p3*t^3+p2*t^2+p1*t+p0
+            self.fArrTensor = torch.FloatTensor(fArr)
             self.fBasis = fBasis
             self.dpBasis = dpBasis
 
@@ -467,8 +576,7 @@ class SimpleSpeed():
             stateNext = torch.empty(state.shape)
 
         # move forward one step to get next state
-        stateNext[:,0] = d + self.dt*v
-        stateNext[:,1] = torch.minimum(torch.maximum(v + self.dt*a, torch.tensor(self.vmin)), torch.tensor(self.vmax))
+        stateNext[:,0], stateNext[:,1] = speedNextState(speedModel(self), d, v, a)
         return stateNext
     
 
@@ -505,19 +613,8 @@ class SimpleSpeed():
             # idx = torch.minimum(torch.floor(k/self.nIntvlIdx),torch.tensor(self.nIntvl-1)).int()
             # dpNext = torch.matmul(torch.FloatTensor([[np.power(self.dt,3), np.power(self.dt,2), np.power(self.dt,1), 1]]), \
                                         # torch.transpose(torch.FloatTensor(self.fArr)[idx],0,-1)*torch.row_stack([(k+1)**3, (k+1)**2, k+1, torch.ones(k.shape)]))
-            observation = torch.empty(state.shape[0],self.state_dim+1+self.nIntvl*(self.nPoly+1))
-            observation[:,0] = state[:,0]
-            observation[:,1] = state[:,1]
-            observation[:,2] = k
-            
             # observation poly, from highest order to zero order
-            # fArr [p0,p1,p2,p3] -> p3*t^3+p2*t^2+p1*t+p0
-            for i in range(self.nIntvl):
-                for j in range(self.nPoly):
-                    observation[:,self.state_dim+1+i*(self.nPoly+1)+j] = self.fArr[i][self.nPoly-j]*np.power(self.dt*(k+1), self.nPoly-j)
-                observation[:,self.state_dim+1+i*(self.nPoly+1)+self.nPoly] = observation[:,self.state_dim+1+i*(self.nPoly+1)+self.nPoly-1] + self.fArr[i][0]
-                pass
-            pass
+            observation = torch.column_stack((state[:,0], state[:,1], k.float(), polyFeatures(self.fArrTensor, k, self.dt)))
         elif self.SELECT_OBSERVATION == 'all':
             observation = torch.empty(state.shape[0],self.state_dim+1+self.N)
             observation[:,0:self.state_dim] = state
@@ -635,11 +732,7 @@ class SimpleSpeed():
             d = obs[:,0]
             v = obs[:,1]
             
-            df = self.dp[-1]-d
-            vf = self.vp[-1]
-            
-            dmin = self.ht*vf + self.dmin
-            reward = self.w5*(df-dmin)**2 +self.w6*(vf-v)**2
+            reward = speedTerminalCost(speedModel(self), d, v, self.dp[-1], self.vp[-1])
         else:
             reward = 0
         return reward 
@@ -655,24 +748,14 @@ class SimpleSpeed():
         v = obs[:,1]
         k = self.k
 
-        p1 = self.Veh['p1']
-        p2 = self.Veh['p2']
-        p3 = self.Veh['p3']
         # penalize k==self.N, which is the last state
         # df_final, vfinal = self.getDesiredFinalStates(obs, k)
         dp = self.dp[self.k]
-        vp = self.vp[self.k]
-        df = dp-d 
-        
-        df_upper_penalty = max(df-self.dmax,0)
-        df_lower_penalty = max(self.dmin-df,0)
-        reward = 0
         if self.k == self.N:
             reward = self.getTerminalReward(xVar, action)
         else:
-            pow=(p1*v+p2*(v**3)+p3*(v*a))
-            reward +=  self.w1*(a**2) + self.w2*(pow)
-            reward += self.w3*(df_upper_penalty**2) + self.w4*(df_lower_penalty**2)
+            model = speedModel(self)
+            reward = speedActionCost(model, v, a) + speedDistanceCost(model, d, dp)
         reward = -reward*0.01
         return torch.tensor([reward]) 
 
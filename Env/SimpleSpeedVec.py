@@ -0,0 +1,139 @@
+import torch
+from .SimpleSpeed import SimpleSpeed, polyFeatures, speedModel, speedNextState, speedActionCost, speedDistanceCost, speedTerminalCost
+
+class SimpleSpeedVec():
+    # M SimpleSpeed episodes stepped together. Preceding-vehicle segments are stacked as
+    # dp/vp [M, N+1] and polynomial coefficients fArr [M, nIntvl, nPoly+1], state is [M, 2]
+    # and every env keeps its own step counter k [M]. Finished envs are reset automatically.
+    def __init__(self, dataPath, M=16, SELECT_OBSERVATION='poly', options={}):
+        # a scalar SimpleSpeed is kept around to draw new segments and for the model constants
+        self.Env = SimpleSpeed(dataPath, SELECT_OBSERVATION=SELECT_OBSERVATION, options=options)
+        Env = self.Env
+        self.M = M
+        self.options = options
+        self.SELECT_OBSERVATION = SELECT_OBSERVATION
+
+        self.Veh = Env.Veh
+        self.dt = Env.dt
+        self.w1, self.w2, self.w3, self.w4, self.w5, self.w6 = Env.w1, Env.w2, Env.w3, Env.w4, Env.w5, Env.w6
+        self.ht = Env.ht
+        self.vmax, self.vmin = Env.vmax, Env.vmin
+        self.umax, self.umin = Env.umax, Env.umin
+
+        self.N = Env.N
+        self.nPoly = Env.nPoly
+        self.nIntvl = Env.nIntvl
+        self.nIntvlIdx = Env.nIntvlIdx
+        self.state_dim = Env.state_dim
+        self.obs_dim = Env.obs_dim
+        self.action_dim = Env.action_dim
+        self.xmean = Env.xmean
+        self.xstd = Env.xstd
+
+        self.dp = torch.empty((M, self.N+1))
+        self.vp = torch.empty((M, self.N+1))
+        self.fArr = torch.empty((M, self.nIntvl, self.nPoly+1))
+        self.state = torch.empty((M, self.state_dim))
+        self.k = torch.zeros(M, dtype=torch.long)
+        self.vehId = [None]*M
+
+        self.reset()
+
+    def loadSegment(self, m):
+        Env = self.Env
+        Env.updatePrecedingVehicle(options=self.options)
+        if Env.N != self.N or Env.nIntvl != self.nIntvl:
+            raise ValueError('all segments of SimpleSpeedVec need the same horizon, got N={} instead of {}'.format(Env.N, self.N))
+        self.dp[m] = torch.as_tensor(Env.dp, dtype=torch.float32)
+        self.vp[m] = torch.as_tensor(Env.vp, dtype=torch.float32)
+        self.fArr[m] = Env.fArrTensor
+        self.state[m] = torch.FloatTensor([Env.d0, Env.v0])
+        self.k[m] = 0
+        self.vehId[m] = Env.vehId
+        # constraints are overwritten per segment in updatePrecedingVehicle
+        self.dmax = Env.dmax
+        self.dmin = Env.dmin
+
+    def reset(self, options=None):
+        if options is not None:
+            self.options = options
+        for m in range(self.M):
+            self.loadSegment(m)
+        self.observation = self.state2Observation(self.state, self.k)
+        return self.observation, {}
+
+    def getNextState(self, state, action):
+        state = state.reshape(-1, self.state_dim)
+        action = action.reshape(-1, 1)
+        d = state[:,0]
+        v = state[:,1]
+        a = action[:,0]
+        return torch.column_stack(speedNextState(speedModel(self), d, v, a))
+
+    def state2Observation(self, state, k, envIdx=None):
+        # envIdx: which segment each row belongs to, all M envs by default
+        if envIdx is None:
+            envIdx = torch.arange(self.M)
+        state = state.reshape(-1, self.state_dim)
+        k = k.reshape(-1)
+
+        if self.SELECT_OBSERVATION == 'none':
+            observation = state.clone()
+        elif self.SELECT_OBSERVATION == 'poly':
+            observation = torch.column_stack((state, k.float(), polyFeatures(self.fArr[envIdx], k, self.dt)))
+        elif self.SELECT_OBSERVATION == 'all':
+            observation = torch.column_stack((state, k.float(), self.dp[envIdx, :self.N]))
+        return observation
+
+    def getReward(self, obs, action, k, envIdx=None):
+        if envIdx is None:
+            envIdx = torch.arange(self.M)
+        obs = obs.reshape(-1, self.obs_dim)
+        a = action.reshape(-1, self.action_dim)[:,0]
+        d = obs[:,0]
+        v = obs[:,1]
+        model = speedModel(self)
+
+        dp = self.dp[envIdx, k]
+        vp = self.vp[envIdx, k]
+        reward = speedActionCost(model, v, a) + speedDistanceCost(model, d, dp)
+        # terminal cost at k == N, see SimpleSpeed.getTerminalReward
+        rewardTerminal = speedTerminalCost(model, d, v, dp, vp)
+        reward = torch.where(k == self.N, rewardTerminal, reward)
+        return -reward*0.01
+
+    def calcDyn(self, obs, action, k):
+        obs = obs.reshape(-1, self.obs_dim)
+        stateNext = self.getNextState(obs[:,:self.state_dim], action)
+        if self.SELECT_OBSERVATION == 'none':
+            return stateNext
+        elif self.SELECT_OBSERVATION == 'poly':
+            # same as SimpleSpeed.calcDyn: step counter slot holds k, poly features are carried over
+            return torch.column_stack((stateNext, k.float(), obs[:,self.state_dim+1:]))
+        elif self.SELECT_OBSERVATION == 'all':
+            return torch.column_stack((stateNext, k.float()+1, obs[:,self.state_dim+1:]))
+
+    def step(self, action):
+        action = torch.as_tensor(action, dtype=torch.float32).reshape(self.M, self.action_dim)
+        k = self.k
+        info = {}
+
+        reward = self.getReward(self.observation, action, k)
+        self.state = self.getNextState(self.state, action)
+        observationNext = self.calcDyn(self.observation, action, k)
+
+        truncated = (k == self.N-1)
+        terminated = truncated.clone()
+        self.k = k + 1
+
+        # auto-reset finished envs, their last observation goes to info
+        if torch.any(truncated):
+            idxDone = torch.nonzero(truncated).reshape(-1)
+            info['final_observation'] = observationNext[idxDone].clone()
+            info['_final_observation'] = truncated.clone()
+            for m in idxDone.tolist():
+                self.loadSegment(m)
+            observationNext[idxDone] = self.state2Observation(self.state[idxDone], self.k[idxDone], idxDone)
+
+        self.observation = observationNext
+        return observationNext, reward, terminated, truncated, info
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import scipy.io
+import h5py
+
+# Columnar cache of the traffic dataset used by SimpleSpeed.
+# All vehicles' samples are concatenated into flat arrays, vehicle i owns [offsets[i], offsets[i+1]):
+#   time.npy      float64  (window search uses 1e-7 s tolerances on absolute timestamps)
+#   distance.npy  float32
+#   speed.npy     float32
+#   offsets.npy   int64 [nVeh+1]
+#   vehNames.npy  str [nVeh]
+# TrafficCache np.memmaps the arrays, so several training processes share the page cache.
+
+def buildTrafficCache(dataPath, cacheDir, OLD_FASHION=False):
+    time, distance, speed = [], [], []
+    offsets = [0]
+    if OLD_FASHION:
+        TrafficData = scipy.io.loadmat(dataPath)
+        vehNames = sorted(k for k in TrafficData if not k.startswith('__'))
+        for vehId in vehNames:
+            time.append(np.asarray(TrafficData[vehId][0][0][0][0], dtype=np.float64).reshape(-1))
+            distance.append(np.asarray(TrafficData[vehId][0][0][3][0], dtype=np.float32).reshape(-1))
+            speed.append(np.asarray(TrafficData[vehId][0][0][4][0], dtype=np.float32).reshape(-1))
+            offsets.append(offsets[-1]+time[-1].size)
+    else:
+        TrafficData = h5py.File(dataPath, 'r')
+        # same vehicle list as SimpleSpeed.updatePrecedingVehicle
+        vehNames = list(np.array(sorted(TrafficData))[1:])
+        for vehId in vehNames:
+            time.append(np.array(TrafficData[vehId]['time'], dtype=np.float64).reshape(-1))
+            distance.append(np.array(TrafficData[vehId]['distance'], dtype=np.float32).reshape(-1))
+            speed.append(np.array(TrafficData[vehId]['speed'], dtype=np.float32).reshape(-1))
+            offsets.append(offsets[-1]+time[-1].size)
+        TrafficData.close()
+
+    os.makedirs(cacheDir, exist_ok=True)
+    np.save(os.path.join(cacheDir, 'time.npy'), np.concatenate(time))
+    np.save(os.path.join(cacheDir, 'distance.npy'), np.concatenate(distance))
+    np.save(os.path.join(cacheDir, 'speed.npy'), np.concatenate(speed))
+    np.save(os.path.join(cacheDir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(cacheDir, 'vehNames.npy'), np.array(vehNames, dtype=str))
+    return len(vehNames), offsets[-1]
+
+
+class TrafficCache():
+    # read-only, h5py-like access: TrafficCache(cacheDir)[vehId]['speed']
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.time = np.load(os.path.join(cacheDir, 'time.npy'), mmap_mode='r')
+        self.distance = np.load(os.path.join(cacheDir, 'distance.npy'), mmap_mode='r')
+        self.speed = np.load(os.path.join(cacheDir, 'speed.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(cacheDir, 'offsets.npy'))
+        self.vehNames = np.load(os.path.join(cacheDir, 'vehNames.npy'))
+        self.vehIndex = {vehId: i for i, vehId in enumerate(self.vehNames)}
+
+    def __len__(self):
+        return len(self.vehNames)
+
+    def __iter__(self):
+        return iter(self.vehNames)
+
+    def __contains__(self, vehId):
+        return vehId in self.vehIndex
+
+    def __getitem__(self, vehId):
+        i = self.vehIndex[vehId]
+        idxBeg, idxEnd = self.offsets[i], self.offsets[i+1]
+        return {'time': self.time[idxBeg:idxEnd],
+                'distance': self.distance[idxBeg:idxEnd],
+                'speed': self.speed[idxBeg:idxEnd]}
@@ -1,4 +1,7 @@
 from .SimpleSpeed import SimpleSpeed
+from .SimpleSpeedVec import SimpleSpeedVec
 from .nonLinear import NonLinear
 from .Linear import Linear
 from .LQT import LQT
+from .LQTVec import LQTVec
+from .ControlVec import ControlVec
@@ -75,33 +75,43 @@ class NonLinear:
         self.vp = None
         
     def reset(self):
-        import random
         self.k = 0
-        self.x = torch.tensor([random.uniform(-1,1),random.uniform(-1,1),self.k])         
+        self.x = self.resetState()
         return self.x, None
-    
-    def getReward(self, x, u):
-        x = x[:2]
-        if self.k == self.N:
-            tc = 0.5* x.T @self.Qf@ x
-            return - tc
-        else:
-            sc = 0.5* x.T @self.Q @ x + u.T @self.R@ u
-            return -sc
-    
-    def step(self, u):  
+
+    def resetState(self, n=None):
+        # random initial states [x_dim], or [n, x_dim] for n episodes, with the k slot at 0
+        shape = (2,) if n is None else (n, 2)
+        x = torch.empty(shape).uniform_(-1, 1)
+        if self.IS_K:
+            x = torch.cat((x, torch.zeros(shape[:-1] + (1,))), dim=-1)
+        return x
+
+    def getReward(self, x, u, k=None):
+        # x [x_dim] or [B, x_dim], u [u_dim] or [B, u_dim], k: step counter (int or [B]), self.k by default
+        # stage cost, or the terminal cost alone where k == N; returns a scalar or [B]
+        k = self.k if k is None else k
+        xb = x.reshape(-1, self.x_dim)[:,:2]
+        ub = torch.as_tensor(u, dtype=xb.dtype).reshape(-1, self.u_dim)
+        tc = 0.5*((xb @ self.Qf)*xb).sum(-1)
+        sc = 0.5*((xb @ self.Q)*xb).sum(-1) + ((ub @ self.R)*ub).sum(-1)
+        cost = torch.where(torch.as_tensor(k) == self.N, tc, sc)
+        return -cost if x.dim() > 1 else -cost[0]
+
+    def step(self, u):
         x_next = self.getNextState(self.x, u)
         self.x = x_next
         self.k += 1
         done = (self.k == self.N)
-        return x_next, self.getReward(x_next, u), done, False, None    
-        
-    def getNextState(self, x, u):
-        x_next = torch.zeros_like(x)
-        x_next[0] = 0.2*x[0] * torch.exp(x[1]**2) + self.g[0,0]*u[0]
-        x_next[1] = 0.3*x[1]**3 + self.g[1,1]*u[1]
+        return x_next, self.getReward(x_next, u), done, False, None
+
+    def getNextState(self, x, u, k=None):
+        # x [x_dim] or [B, x_dim], u [u_dim] or [B, u_dim]; the k slot is set to k (int or [B]), self.k by default
+        xb = x.reshape(-1, self.x_dim)
+        ub = torch.as_tensor(u, dtype=xb.dtype).reshape(-1, self.u_dim)
+        cols = [0.2*xb[:,0]*torch.exp(xb[:,1]**2) + self.g[0,0]*ub[:,0],
+                0.3*xb[:,1]**3 + self.g[1,1]*ub[:,1]]
         if self.IS_K:
-            x_next[2] = self.k
-        return x_next
-    
-        
\ No newline at end of file
+            k = self.k if k is None else k
+            cols.append(torch.as_tensor(k, dtype=xb.dtype).expand(xb.shape[0]))
+        return torch.stack(cols, dim=1).reshape(x.shape)
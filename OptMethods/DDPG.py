@@ -6,7 +6,10 @@ import torch.optim as optim
 
 import numpy as np
 
-from .lib.ReplayBuffer import Replay_buffer
+from .lib.ReplayBuffer import build_replay_buffer
+from .lib.TargetUpdate import SoftUpdater
+from .lib.LossMeter import LossMeter
+from .lib.AgentBase import LossMetrics
 
 class Actor(nn.Module):
     def __init__(self, observation_dim, action_dim, max_action, xMean, xStd):
@@ -67,7 +70,7 @@ class Critic(nn.Module):
 
         return x
     
-class DDPG(object):
+class DDPG(LossMetrics):
     def __init__(self, observation_dim, action_dim, ScalingDict, device, args):
 
         self.action_max = ScalingDict['actionMax']
@@ -84,7 +87,7 @@ class DDPG(object):
         self.critic_target = Critic(observation_dim, action_dim, xuMean, xuStd).to(device)
         self.critic_target.load_state_dict(self.critic.state_dict())
         self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=args.critic_learning_rate)
-        self.replay_buffer = Replay_buffer()
+        self.replay_buffer = build_replay_buffer(args)
         #self.writer = SummaryWriter(directory)
 
         self.num_critic_update_iteration = 0
@@ -99,9 +102,11 @@ class DDPG(object):
         # parser args
         self.gamma = args.gamma
         self.tau = args.tau
+        self.target_updater = SoftUpdater([self.critic_target, self.actor_target], [self.critic, self.actor], self.tau, getattr(args, 'target_update_every', 1))
         self.exploration_noise = args.exploration_noise
         self.dynamic_noise = args.dynamic_noise
 
+        self.loss_meter = LossMeter()
         self.LossDict = {'Critic': 0,
                     'Actor': 0}
         
@@ -168,14 +173,11 @@ class DDPG(object):
         self.actor_optimizer.step()
 
         # Update the frozen target models
-        for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-            target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
-
-        for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-            target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+        self.target_updater()
 
         self.num_actor_update_iteration += 1
         self.num_critic_update_iteration += 1
+        self.loss_meter.add(Critic=critic_loss, Actor=actor_loss)
 
         # return critic_loss, actor_loss
         #return F.mse_loss(current_Q, target_Q), -self.critic(observation, self.actor(observation)).mean()
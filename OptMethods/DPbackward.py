@@ -6,10 +6,13 @@ from typing import Mapping
 from multiprocessing import Pool
 from itertools import repeat
 import torch
+from .DPcache import DPcache
+from .DPutils import actionGrid, gridIndex, gridInterp, interpValue, reachableStates, chunkSizeFromBudget, PairScratch, MemoryMonitor
+from Env.SimpleSpeed import SimpleSpeed, speedModel, speedNextState, speedActionCost, speedDistanceCost, speedTerminalCost
 
 class DPbackward():
 
-    def __init__(self, Env, dRes=1, vRes=0.2, aRes=0.1, SELECT_MIN_MAX='min'):
+    def __init__(self, Env, dRes=1, vRes=0.2, aRes=0.1, SELECT_MIN_MAX='min', ENABLE_PRUNE=False, memBudget=5e9, SELECT_LOOKUP='nearest', cache=None, ENABLE_MEM_MONITOR=False):
         
         # get number of steps and dt from Env
         N = Env.N+1
@@ -18,7 +21,7 @@ class DPbackward():
         # discretize states 
         dArr = np.arange(np.floor(np.min(Env.dp-Env.dmax)), np.ceil(np.max(Env.dp-Env.dmin)), dRes)
         vArr = np.arange(np.floor(Env.vmin), np.ceil(Env.vmax), vRes)
-        aArr = np.arange(np.floor(Env.amin), np.ceil(Env.amax), aRes)
+        aArr = actionGrid(Env, aRes)
         tArr = Env.t
 
         self.N = N
@@ -32,10 +35,58 @@ class DPbackward():
         self.aRes = aRes
 
         self.SELECT_MIN_MAX = SELECT_MIN_MAX
+        # value of next states off the grid: 'nearest' rounds to the closest grid point, 'bilinear' interpolates
+        # between the four surrounding ones and the optimal trajectory is not snapped to the grid
+        if SELECT_LOOKUP not in ('nearest', 'bilinear'):
+            raise ValueError('SELECT_LOOKUP must be nearest or bilinear, got {}'.format(SELECT_LOOKUP))
+        self.SELECT_LOOKUP = SELECT_LOOKUP
+        # only evaluate states reachable from (d0, v0) that keep the following distance
+        self.ENABLE_PRUNE = ENABLE_PRUNE
+        self.Reachable = None
+
+        # try to vectorize things up
+        vList, dList = np.meshgrid(self.vArr, self.dArr)
+        dList, vList = dList.flatten(), vList.flatten()
+        stateList = np.zeros((dList.size,2))
+        stateList[:,0] = dList
+        stateList[:,1] = vList
+
+        self.stateList = stateList
+        self.dList = dList
+        self.vList = vList
+
+        # state x action pairs are swept in chunks that fit memBudget bytes, sList/aList buffers are
+        # float32 like the torch tensors Env works on, so torch.from_numpy shares them without a copy
+        self.memBudget = memBudget
+        # peakMemory[k]: largest process RSS sampled during step k, see MemoryMonitor, zeros when off
+        self.ENABLE_MEM_MONITOR = ENABLE_MEM_MONITOR
+        self.chunkSize = min(dList.size, chunkSizeFromBudget(memBudget, aArr.size))
+        self.scratch = PairScratch(aArr, self.chunkSize, dtype=np.float32)
+
+        # DPcache with solutions of earlier runs, runOpt skips the solve when the segment is in it
+        self.cache = cache
 
         # reset
         self.reset()
 
+    def cacheKey(self):
+        Env = self.Env
+        params = {'N': self.N,
+                  'dt': float(Env.dt),
+                  'd0': float(Env.d0), 'v0': float(Env.v0),
+                  'dRes': self.dRes, 'vRes': self.vRes, 'aRes': self.aRes,
+                  'SELECT_MIN_MAX': self.SELECT_MIN_MAX,
+                  'SELECT_LOOKUP': self.SELECT_LOOKUP,
+                  'ENABLE_PRUNE': self.ENABLE_PRUNE,
+                  }
+        for name in ['w1', 'w2', 'w3', 'w4', 'w5', 'w6', 'ht', 'dmin', 'dmax', 'vmin', 'vmax', 'amin', 'amax']:
+            value = getattr(Env, name, None)
+            params[name] = None if value is None else float(value)
+        # vehicle and power model constants enter the dynamics and the reward
+        params['Veh'] = dict(getattr(Env, 'Veh', {}))
+        arrays = [Env.dp, getattr(Env, 'vp', np.empty(0))]
+        return DPcache.makeKey(arrays, params)
+
     def runOpt(self):
         # initialize terminal cost 
         # k = T-1
@@ -54,6 +105,18 @@ class DPbackward():
         # reset
         self.reset()
 
+        if self.cache is not None:
+            key = self.cacheKey()
+            solution = self.cache.load(key)
+            if solution is not None:
+                print('DP solution loaded from cache {}'.format(self.cache.path(key)))
+                self.ValueMap = solution['ValueMap']
+                self.OptActionIdx = solution['OptActionIdx']
+                self.nEvaluated = solution['nEvaluated']
+                self.nSkipped = solution['nSkipped']
+                self.peakMemory = solution['peakMemory']
+                return
+
         # short names
         # tArr, dArr, vArr, aArr = self.tArr, self.dArr, self.vArr, self.aArr
         # ValueMap, QvalueMap = self.ValueMap, self.QvalueMap
@@ -65,18 +128,23 @@ class DPbackward():
         dftol = max(0.1, np.average(np.diff(self.dArr))+1e-3)
         v0tol = max(0.01, np.average(np.diff(self.vArr))+1e-3)
         vftol = max(0.1, np.average(np.diff(self.vArr))+1e-3)
-    
-        
-        # try to vectorize things up
-        vList, dList = np.meshgrid(self.vArr, self.dArr)
-        dList, vList = dList.flatten(), vList.flatten()
-        stateList = np.zeros((dList.size,2))
-        stateList[:,0] = dList
-        stateList[:,1] = vList
 
-        self.stateList = stateList
-        self.dList = dList
-        self.vList = vList
+        # forward reachability pass, Reachable[k] is the band of states the backward sweep evaluates at step k
+        if self.ENABLE_PRUNE:
+            idx0 = np.linalg.norm(np.abs(self.stateList-np.array((Env.d0,Env.v0))),axis=1).argmin()
+            def followCheck(stateList, k):
+                d = stateList[:,0]
+                if k == 0 or k == self.N-1:
+                    return np.ones(d.shape, dtype=bool)
+                return (dp[k] - d <= Env.dmax) & (dp[k] - d >= Env.dmin)
+            def getNextState(sList, aList):
+                return Env.getNextState(torch.from_numpy(sList), torch.from_numpy(aList)).data.numpy()
+            self.Reachable = reachableStates(getNextState, self.stateList, self.dArr, self.vArr, self.dRes, self.vRes, self.aArr, self.N, idx0, followCheck, self.scratch,
+                                             dilate=self.SELECT_LOOKUP == 'bilinear')
+        else:
+            self.Reachable = None
+
+        self.memMonitor = MemoryMonitor(self.ENABLE_MEM_MONITOR)
 
         # final value
         def finalValueCheck(stateList):
@@ -97,6 +165,17 @@ class DPbackward():
             return (d>=Env.d0-d0tol) & (d<=Env.d0+d0tol) & (v>=Env.v0-v0tol) & (v<=Env.v0+v0tol)
         self.__basicIterLoop(0, initValueCheck)
 
+        print('evaluated {} states, skipped {} unreachable states'.format(np.sum(self.nEvaluated), np.sum(self.nSkipped)))
+        if self.ENABLE_MEM_MONITOR:
+            print('peak resident memory {:.1f} MB'.format(np.max(self.peakMemory)/1e6))
+
+        if self.cache is not None:
+            # tables and the optimal trajectory, retrieveOptValue() can be called again at no cost
+            tOpt, dOpt, vOpt, aOpt, vv, _, rr, _ = self.retrieveOptValue()
+            self.cache.save(key, ValueMap=self.ValueMap, OptActionIdx=self.OptActionIdx,
+                            nEvaluated=self.nEvaluated, nSkipped=self.nSkipped, peakMemory=self.peakMemory,
+                            tOpt=tOpt, dOpt=dOpt, vOpt=vOpt, aOpt=aOpt, valueOpt=vv, rewardOpt=rr)
+
         # retrieve optimal value
         
     def retrieveOptValue(self):
@@ -108,8 +187,29 @@ class DPbackward():
         vv = np.empty(shape=(self.N,))
         rr = np.empty(shape=(self.N,))
         ii = np.empty(shape=(self.N,))
-        vvOpt = np.empty(shape=(self.N,self.N))
+        # the trajectory stops at the first state without a solved action, the rest is nan and idx -1
+        feasible = True
         for k in range(0, self.N):
+            if self.SELECT_LOOKUP == 'bilinear':
+                # follow the continuous state, the action comes from a one step lookahead on the interpolated values
+                if k == 0:
+                    state = np.array((Env.d0,Env.v0))
+                else:
+                    state = Env.getNextState(torch.FloatTensor(state), torch.FloatTensor([aOpt[k-1]])).data.numpy()[0]
+                idxAction, vv[k] = self.__lookahead(k, state)
+                if not np.isfinite(vv[k]):
+                    feasible = False
+                    break
+                # nearest grid point of the state, -1 off the grid
+                idx, idxValid = gridIndex(state.reshape(1,2), self.dArr, self.vArr, self.dRes, self.vRes)
+                dOpt[k] = state[0]
+                vOpt[k] = state[1]
+                aOpt[k] = self.aArr[idxAction]
+                r,_,_ = Env.getReward(torch.FloatTensor([dOpt[k], vOpt[k]]), torch.FloatTensor([aOpt[k]]), k=k)
+                rr[k] = r.item()
+                ii[k] = idx[0] if idxValid[0] else -1
+                continue
+
             if k == 0:
                 # if self.SELECT_MIN_MAX == 'max':
                 #     idx = np.argmax(self.ValueMap[tOpt[k]])         
@@ -120,23 +220,39 @@ class DPbackward():
             else:
                 stateNextRaw = Env.getNextState(torch.FloatTensor([dOpt[k-1], vOpt[k-1]]), torch.FloatTensor([aOpt[k-1]]))
                 stateNextRaw = stateNextRaw.data.numpy()[0]
-                tmpIdxD = np.round((stateNextRaw[0]-self.dArr[0])/self.dRes)
-                tmpIdxV = np.round((stateNextRaw[1]-self.vArr[0])/self.vRes)
-                idx = (tmpIdxD*self.vArr.size + tmpIdxV).astype(int)
+                idx, idxValid = gridIndex(stateNextRaw.reshape(1,2), self.dArr, self.vArr, self.dRes, self.vRes)
+                idx = idx[0] if idxValid[0] else -1
 
+            # off the grid, pruned, or no action with a finite value: OptActionIdx is -1 and aArr[-1] would be wrong
+            if idx < 0 or self.OptActionIdx[k,idx] < 0:
+                feasible = False
+                break
             dOpt[k] = self.stateList[idx,0]
             vOpt[k] = self.stateList[idx,1]
-            aOpt[k] = self.OptActionMap[tOpt[k]][idx]
-            vv[k] = self.ValueMap[tOpt[k]][idx] 
+            aOpt[k] = self.aArr[self.OptActionIdx[k,idx]]
+            vv[k] = self.ValueMap[k,idx]
             r,_,_ = Env.getReward(torch.FloatTensor([dOpt[k], vOpt[k]]), torch.FloatTensor([aOpt[k]]), k=k)
             rr[k] = r.item()
             ii[k] = idx
-            vvOpt[k,:] = np.array([v[idx] for v in self.ValueMap.values()])# this is map given each optimal state, then give its value over time. a N-by-N matrix
+        if not feasible:
+            dOpt[k:], vOpt[k:], aOpt[k:], vv[k:], rr[k:] = np.nan, np.nan, np.nan, np.nan, np.nan
+            ii[k:] = -1
+        if self.SELECT_LOOKUP == 'bilinear':
+            # the states are off the grid, their values are interpolated the way the solve looked them up, nan outside the grid
+            stateOpt = np.column_stack((dOpt, vOpt))
+            finite = np.all(np.isfinite(stateOpt), axis=1)
+            idx, w, idxValid = gridInterp(np.where(finite[:,None], stateOpt, 0), self.dArr, self.vArr, self.dRes, self.vRes)
+            vvOpt = np.stack([interpValue(self.ValueMap[j], idx, w) for j in range(self.N)], axis=1)
+            vvOpt[~(idxValid & finite)] = np.nan
+        else:
+            vvOpt = self.ValueMap[:,ii.astype(int)].transpose() # this is map given each optimal state, then give its value over time. a N-by-N matrix
+            vvOpt[ii < 0] = np.nan
 
         # store info
         info['dRes'] = self.dRes
         info['vRes'] = self.vRes
         info['aRes'] = self.aRes
+        info['lookup'] = self.SELECT_LOOKUP
         # info['dList'] = self.stateList[:,0]
         # info['vList'] = self.stateList[:,1]
         info['dOpt'] = dOpt
@@ -145,7 +261,11 @@ class DPbackward():
         info['valueOpt'] = vv
         info['rewardOpt'] = rr
         info['idxOpt'] = ii
+        info['feasible'] = feasible
         info['ValueMap'] = vvOpt
+        info['nEvaluated'] = self.nEvaluated
+        info['nSkipped'] = self.nSkipped
+        info['peakMemory'] = self.peakMemory
 
         return tOpt, dOpt, vOpt, aOpt, vv, vv, rr, info
     
@@ -153,7 +273,7 @@ class DPbackward():
     def __basicIterLoop(self, k, constrCheck, *args):
         # short names
         tArr, dArr, vArr, aArr = self.tArr, self.dArr, self.vArr, self.aArr
-        ValueMap, QvalueMap, OptActionMap = self.ValueMap, self.QvalueMap, self.OptActionMap
+        ValueMap, OptActionIdx = self.ValueMap, self.OptActionIdx
         Env = self.Env
         N = self.N
         # _, _, aOpt = self.dOpt, self.vOpt, self.aOpt
@@ -162,15 +282,9 @@ class DPbackward():
 
         print('optimizing step {}/{}, progress {:.4f}%'.format(k+1, N, (N-(k))/N*100))
 
-        Env.k = k
-
         # initialization
         if 0: #self.dRes <= 0.05 or self.vRes <= 0.05  or self.aRes <= 0.05:
-            if self.SELECT_MIN_MAX == 'max':
-                self.ValueMap[self.tArr[k]] = np.array([-np.inf]*self.dList.size)
-            else:
-                self.ValueMap[self.tArr[k]] = np.array([np.inf]*self.dList.size)
-            self.OptActionMap[self.tArr[k]] = np.array([np.nan]*self.dList.size)
+            # tables are filled with +-inf and -1 by reset()
             # for state in stateList:
             #     ValueMap[tArr[k]][state.tobytes()] = np.inf 
 
@@ -209,78 +323,94 @@ class DPbackward():
             ##########################
             # try to vectorize further the state and action loop
 
-            # initialization
-            if self.SELECT_MIN_MAX == 'max':
-                ValueMap[tArr[k]] = np.array([-np.inf]*dList.size)
-            else:
-                ValueMap[tArr[k]] = np.array([np.inf]*dList.size)
-            OptActionMap[tArr[k]] = np.array([np.nan]*dList.size)
+            # initialization, tables are filled with +-inf and -1 by reset()
             # for state in stateList:
             #     ValueMap[tArr[k]][state.tobytes()] = np.inf 
 
             #idxLegitState = np.where(constrCheck(stateList, *args))[0]
-            idxLegitState = np.arange(0,np.shape(stateList)[0])
-
-            # aList, sList = np.meshgrid(actionList, stateList[idxLegitState])
-            # sList, aList = sList.flatten(), aList.flatten()
-            sList = np.tile(stateList[idxLegitState], (aArr.size, 1))
-            aList = (np.tile(aArr, (idxLegitState.size, 1))).transpose().flatten()
-
-            if k < N-1:
-                stateNextRaw = Env.getNextState(torch.FloatTensor(sList), torch.FloatTensor(aList))
-
-                stateNextRaw = stateNextRaw.data.numpy()
-                # conver to idx in stateList
-                # dList, vList, stateList, ValueMap[tArr[k+1]] all same size
-                tmpIdxD = np.round((stateNextRaw[:,0]-dArr[0])/self.dRes)
-                tmpIdxV = np.round((stateNextRaw[:,1]-vArr[0])/self.vRes)
-                idx = (tmpIdxD*vArr.size + tmpIdxV).astype(int)
-                # if say state is alreay on the upper bound, those state will be discarded and not add to value list
-                idxValid = (tmpIdxD <= dArr.size-1) & (tmpIdxV <= vArr.size-1)
-                # idx = idx[idxValid]
-
-                # if idx.size == 0:
-                #     continue
-                r,_,_ = Env.getReward(torch.FloatTensor(sList), torch.FloatTensor(aList))
-                r = r.data.numpy()
-                valueList = r + ValueMap[tArr[k+1]][np.minimum(idx, dList.size-1)]
-                if self.SELECT_MIN_MAX == 'max':
-                    valueList[~idxValid] = -np.inf
-                else:
-                    valueList[~idxValid] = np.inf
-                # ttdd = np.round((sList[:,0]-dArr[0])/self.dRes)
-                # ttvv = np.round((sList[:,1]-vArr[0])/self.vRes)
-                # iii = (ttdd*vArr.size + ttvv).astype(int)
+            if self.Reachable is not None:
+                idxLegitState = np.where(self.Reachable[k])[0]
             else:
-                valueList,_,_ = Env.getReward(torch.FloatTensor(sList), torch.FloatTensor(aList))
-                valueList = valueList.data.numpy()
+                idxLegitState = np.arange(0,np.shape(stateList)[0])
+            self.nEvaluated[k] = idxLegitState.size
+            self.nSkipped[k] = np.shape(stateList)[0]-idxLegitState.size
 
-            valueListReshape = (np.reshape(valueList, (-1, idxLegitState.size))).transpose()
-            aListReshape = (np.reshape(aList, (-1, idxLegitState.size))).transpose()
-            if self.SELECT_MIN_MAX == 'max':
-                idxOptValue = np.argmax(valueListReshape, axis=1)
-            else:
-                idxOptValue = np.argmin(valueListReshape, axis=1)
-            # aOpt[k] = actionList[idxMinValue]
-            ValueMap[tArr[k]][idxLegitState] = valueListReshape[np.arange(0, idxLegitState.size),idxOptValue]
-            OptActionMap[tArr[k]][idxLegitState] = aListReshape[np.arange(0, idxLegitState.size),idxOptValue]
+            # divide into chunks of state, action pairs that fit the memory budget
+            for iChunk in range(0, idxLegitState.size, self.chunkSize):
+                idxChunk = idxLegitState[iChunk:iChunk+self.chunkSize]
+
+                # sList = [S, S, ..., S], aList = [a0,a0,...a0,a1,a1,...], views into the scratch buffers
+                sList, aList = self.scratch.fill(stateList[idxChunk])
+                sTensor, aTensor = torch.from_numpy(sList), torch.from_numpy(aList)
+
+                if k < N-1:
+                    stateNextRaw = Env.getNextState(sTensor, aTensor)
 
-            #print('sum value {}, sum opt {}'.format(sum(ValueMap[tArr[k]][idxLegitState]), sum(OptActionMap[tArr[k]][idxLegitState])))
+                    stateNextRaw = stateNextRaw.data.numpy()
+
+                    r,_,_ = Env.getReward(sTensor, aTensor, k=k)
+                    r = r.data.numpy()
+                    valueList = r + self.__nextValue(k, stateNextRaw)
+                else:
+                    valueList,_,_ = Env.getReward(sTensor, aTensor, k=k)
+                    valueList = valueList.data.numpy()
+
+                # column j of valueListReshape is action aArr[j]
+                valueListReshape = (np.reshape(valueList, (-1, idxChunk.size))).transpose()
+                self.memMonitor.sample()
+                if self.SELECT_MIN_MAX == 'max':
+                    idxOptValue = np.argmax(valueListReshape, axis=1)
+                else:
+                    idxOptValue = np.argmin(valueListReshape, axis=1)
+                # aOpt[k] = actionList[idxMinValue]
+                ValueMap[k,idxChunk] = valueListReshape[np.arange(0, idxChunk.size),idxOptValue]
+                OptActionIdx[k,idxChunk] = idxOptValue
 
-        if not np.any(np.isfinite(self.ValueMap[self.tArr[k]])):
+            #print('sum value {}, sum opt {}'.format(sum(ValueMap[k,idxLegitState]), sum(aArr[OptActionIdx[k,idxLegitState]])))
+
+        if not np.any(np.isfinite(self.ValueMap[k])):
             pass
 
-        # now write back
-        self.ValueMap = ValueMap
-        self.QvalueMap = QvalueMap
-        self.OptActionMap = OptActionMap
+        self.peakMemory[k] = self.memMonitor.stepPeak()
+        if self.ENABLE_MEM_MONITOR:
+            print('\tpeak resident memory {:.1f} MB'.format(self.peakMemory[k]/1e6))
+
+    def __nextValue(self, k, stateNextRaw):
+        # value at k+1 of raw next states, dList, vList, stateList, ValueMap[k+1] all same size
+        # if say state is alreay on the bound, those state will be discarded and not add to value list
+        if self.SELECT_LOOKUP == 'bilinear':
+            idx, w, idxValid = gridInterp(stateNextRaw, self.dArr, self.vArr, self.dRes, self.vRes)
+            valueNext = interpValue(self.ValueMap[k+1], idx, w)
+        else:
+            idx, idxValid = gridIndex(stateNextRaw, self.dArr, self.vArr, self.dRes, self.vRes)
+            valueNext = self.ValueMap[k+1][idx]
+        if self.SELECT_MIN_MAX == 'max':
+            valueNext[~idxValid] = -np.inf
+        else:
+            valueNext[~idxValid] = np.inf
+        return valueNext
+
+    def __lookahead(self, k, state):
+        # best action index and its value at a single off-grid state
+        Env = self.Env
+        sList, aList = self.scratch.fill(state.reshape(1,2).astype(np.float32))
+        sTensor, aTensor = torch.from_numpy(sList), torch.from_numpy(aList)
+        valueList,_,_ = Env.getReward(sTensor, aTensor, k=k)
+        valueList = valueList.data.numpy()
+        if k < self.N-1:
+            valueList = valueList + self.__nextValue(k, Env.getNextState(sTensor, aTensor).data.numpy())
+        if self.SELECT_MIN_MAX == 'max':
+            idxOptValue = np.argmax(valueList)
+        else:
+            idxOptValue = np.argmin(valueList)
+        return idxOptValue, valueList[idxOptValue]
 
     @staticmethod
     def stateForLoop(self, k, state, idxState):
 
         # short names
         tArr, dArr, vArr, aArr = self.tArr, self.dArr, self.vArr, self.aArr
-        ValueMap, QvalueMap, OptActionMap = self.ValueMap, self.QvalueMap, self.OptActionMap
+        ValueMap, OptActionIdx = self.ValueMap, self.OptActionIdx
         Env = self.Env
         N = self.N
         _, _, aOpt = self.dOpt, self.vOpt, self.aOpt
@@ -299,41 +429,42 @@ class DPbackward():
             # if say state is alreay on the upper bound, those state will be discarded and not add to value list
             idxValid = (tmpIdxD <= dArr.size-1) & (tmpIdxV <= vArr.size-1)
             idx = idx[idxValid]
+            idxAction = np.where(idxValid)[0]
             # print('i {}'.format(i))
             stateNext = stateList[idx]
 
             if idx.size == 0:
                 # print('returned')
                 return
-            r,_,_ = Env.getReward(torch.FloatTensor(state), torch.FloatTensor(actionList[idxValid]))
+            r,_,_ = Env.getReward(torch.FloatTensor(state), torch.FloatTensor(actionList[idxValid]), k=k)
             r = r.data.numpy()
-            valueList = r + ValueMap[tArr[k+1]][idx]
+            valueList = r + ValueMap[k+1][idx]
         else:
-            valueList,_,_ = Env.getReward(torch.FloatTensor(state), torch.FloatTensor(actionList))
+            valueList,_,_ = Env.getReward(torch.FloatTensor(state), torch.FloatTensor(actionList), k=k)
             valueList = valueList.data.numpy()
+            idxAction = np.arange(actionList.size)
 
         if self.SELECT_MIN_MAX == 'max':
             idxOptValue = np.argmax(valueList)
         else:
             idxOptValue = np.argmin(valueList)
         # aOpt[k] = actionList[idxMinValue]
-        ValueMap[tArr[k]][idxState] = valueList[idxOptValue]
-        OptActionMap[tArr[k]][idxState] = actionList[idxOptValue]
-
-        # now write back
-        self.ValueMap = ValueMap
-        self.QvalueMap = QvalueMap
-        self.OptActionMap = OptActionMap
+        ValueMap[k,idxState] = valueList[idxOptValue]
+        OptActionIdx[k,idxState] = idxAction[idxOptValue]
 
 
     def reset(self):
-        ValueMap = {}
-        QvalueMap = {}
-        OptActionMap = {}
-        for t in self.tArr:
-            ValueMap[t] = np.empty(0)
-            QvalueMap[t] = np.empty(0)
-            OptActionMap[t] = np.empty(0)
+        # ValueMap[k, i] is the value of stateList[i] at tArr[k], OptActionIdx[k, i] indexes aArr (-1 if not solved)
+        if self.SELECT_MIN_MAX == 'max':
+            ValueMap = np.full((self.N, self.dList.size), -np.inf, dtype=np.float32)
+        else:
+            ValueMap = np.full((self.N, self.dList.size), np.inf, dtype=np.float32)
+        OptActionIdx = np.full((self.N, self.dList.size), -1, dtype=np.int16)
+
+        # number of states evaluated and skipped by pruning at each step
+        self.nEvaluated = np.zeros(self.N, dtype=int)
+        self.nSkipped = np.zeros(self.N, dtype=int)
+        self.peakMemory = np.zeros(self.N, dtype=int)
 
         # array to store optimal acceleration
         dOpt = np.empty(shape=(self.N,))
@@ -343,8 +474,154 @@ class DPbackward():
         info = {}
 
         self.ValueMap = ValueMap
-        self.QvalueMap = QvalueMap
-        self.OptActionMap = OptActionMap
+        self.OptActionIdx = OptActionIdx
 
         self.dOpt, self.vOpt, self.aOpt = dOpt, vOpt, aOpt
-        self.info = info
\ No newline at end of file
+        self.info = info
+
+
+def _segmentGrid(grid, model, chunkSize):
+    # next-state index and action cost of every (state, action) pair, shared by all segments, as one
+    # [ns, nA] pair of arrays per chunk of chunkSize states. Pairs are built in the PairScratch buffers
+    # and go through the SimpleSpeed formulas, next states off the grid are never chosen
+    dArr, vArr, aArr = grid['dArr'], grid['vArr'], grid['aArr']
+    vList, dList = np.meshgrid(vArr, dArr)
+    dList, vList = dList.flatten(), vList.flatten()
+    stateList = np.column_stack((dList, vList))
+    scratch = PairScratch(aArr, chunkSize)
+
+    chunks = []
+    for iChunk in range(0, dList.size, chunkSize):
+        idxChunk = np.arange(iChunk, min(iChunk+chunkSize, dList.size))
+        sList, aList = scratch.fill(stateList[idxChunk])
+        dNext, vNext = speedNextState(model, sList[:,0], sList[:,1], aList)
+        tmpIdxD = np.round((dNext-dArr[0])/grid['dRes'])
+        tmpIdxV = np.round((vNext-vArr[0])/grid['vRes'])
+        idxValid = (tmpIdxD >= 0) & (tmpIdxD <= dArr.size-1) & (tmpIdxV >= 0) & (tmpIdxV <= vArr.size-1)
+        idxNext = np.where(idxValid, tmpIdxD*vArr.size + tmpIdxV, 0).astype(int)
+        costSA = np.where(idxValid, 0.01*speedActionCost(model, sList[:,1], aList), np.inf).astype(np.float32)
+        # scratch layout is action major, column j is action aArr[j]
+        chunks.append((idxChunk, idxNext.reshape(aArr.size, -1).transpose(), costSA.reshape(aArr.size, -1).transpose()))
+    return dList, vList, chunks
+
+def _solveSegments(grid, model, memBudget, dp, vp, d0, v0):
+    # backward recursion for a stack of segments dp/vp [S, N+1], cost is -SimpleSpeed.getReward.
+    # States are swept in chunks so that the [S, ns, nA] values of a chunk fit memBudget bytes
+    S, N = dp.shape[0], model['N']
+    dArr, vArr, aArr = grid['dArr'], grid['vArr'], grid['aArr']
+    chunkSize = chunkSizeFromBudget(memBudget/S, aArr.size)
+    dList, vList, chunks = _segmentGrid(grid, model, chunkSize)
+    nStates = dList.size
+
+    ValueMap = np.empty((N+1, S, nStates), dtype=np.float32)
+    OptActionIdx = np.empty((N, S, nStates), dtype=np.int16)
+
+    # terminal cost at k = N
+    ValueMap[N] = 0.01*speedTerminalCost(model, dList, vList, dp[:,-1:], vp[:,-1:])
+
+    for k in range(N-1, -1, -1):
+        for idxChunk, idxNext, costSA in chunks:
+            costS = (0.01*speedDistanceCost(model, dList[idxChunk], dp[:,k:k+1])).astype(np.float32)
+            valueList = costSA[None,:,:] + costS[:,:,None] + ValueMap[k+1][:,idxNext] # [S, ns, nA]
+            idxOptValue = np.argmin(valueList, axis=2)
+            OptActionIdx[k][:,idxChunk] = idxOptValue
+            ValueMap[k][:,idxChunk] = np.take_along_axis(valueList, idxOptValue[:,:,None], axis=2)[:,:,0]
+
+    # roll out the optimal policy from the grid point nearest to (d0, v0)
+    rows = np.arange(S)
+    idxOpt = np.empty((S, N+1), dtype=int)
+    aIdx = np.empty((S, N), dtype=int)
+    idxOpt[:,0] = np.clip(np.round((d0-dArr[0])/grid['dRes']), 0, dArr.size-1)*vArr.size \
+                + np.clip(np.round((v0-vArr[0])/grid['vRes']), 0, vArr.size-1)
+    for k in range(N):
+        aIdx[:,k] = OptActionIdx[k, rows, idxOpt[:,k]]
+        dNext, vNext = speedNextState(model, dList[idxOpt[:,k]], vList[idxOpt[:,k]], aArr[aIdx[:,k]])
+        idxOpt[:,k+1] = np.clip(np.round((dNext-dArr[0])/grid['dRes']), 0, dArr.size-1)*vArr.size \
+                      + np.clip(np.round((vNext-vArr[0])/grid['vRes']), 0, vArr.size-1)
+    cost = ValueMap[0, rows, idxOpt[:,0]]
+    return dList[idxOpt], vList[idxOpt], aArr[aIdx], cost
+
+
+class DPbackwardBatch():
+    # Backward DP over many SimpleSpeed preceding-vehicle segments at once. The (d, v) grid and
+    # the actions are shared, so the next state index of every (state, action) pair is computed
+    # once, only the following distance penalty and the terminal cost differ between segments.
+    # Segments are shifted to dp[0] = 0 internally, returned distances are absolute again.
+    # Dynamics and cost are the SimpleSpeed ones (speedNextState and friends), memBudget bounds the
+    # bytes of the state x action chunks of every batch like in DPbackward.
+    def __init__(self, Env, segments=None, dRes=1, vRes=0.2, aRes=0.1, nProc=1, batchSize=16, memBudget=5e9):
+        if not isinstance(Env, SimpleSpeed):
+            raise TypeError('DPbackwardBatch solves SimpleSpeed segments, got {}'.format(type(Env).__name__))
+        self.Env = Env
+        self.model = speedModel(Env)
+        self.dRes = dRes
+        self.vRes = vRes
+        self.aRes = aRes
+        # same action set as DPbackward
+        self.aArr = actionGrid(Env, aRes)
+        self.vArr = np.arange(np.floor(Env.vmin), np.ceil(Env.vmax), vRes)
+        self.nProc = nProc
+        self.batchSize = batchSize
+        self.memBudget = memBudget
+
+        self.segments = []
+        if segments is not None:
+            self.setSegments(segments)
+
+    @staticmethod
+    def getSegment(Env):
+        # snapshot of the segment currently loaded in Env, call after every Env.reset()
+        return {'dp': np.array(Env.dp, dtype=float),
+                'vp': np.array(Env.vp, dtype=float),
+                'd0': float(Env.d0),
+                'v0': float(Env.v0),
+                'vehId': Env.vehId,
+                'tBeg': Env.tBeg,
+                }
+
+    def setSegments(self, segments):
+        N = self.model['N']
+        for seg in segments:
+            if len(seg['dp']) != N+1:
+                raise ValueError('all segments need {} samples, got {}'.format(N+1, len(seg['dp'])))
+        self.segments = segments
+
+        dp = np.stack([seg['dp'] for seg in segments])
+        self.dShift = dp[:,0].copy()
+        self.dp = dp - self.dShift[:,None]
+        self.vp = np.stack([seg['vp'] for seg in segments])
+        self.d0 = np.array([seg['d0'] for seg in segments]) - self.dShift
+        self.v0 = np.array([seg['v0'] for seg in segments])
+
+        # one d grid covering the following distance band of every segment
+        self.dArr = np.arange(np.floor(np.min(self.dp-self.model['dmax'])), np.ceil(np.max(self.dp-self.model['dmin'])), self.dRes)
+
+    def runOpt(self):
+        S = len(self.segments)
+        grid = {'dArr': self.dArr, 'vArr': self.vArr, 'aArr': self.aArr,
+                'dRes': self.dRes, 'vRes': self.vRes}
+        groups = [np.arange(i, min(i+self.batchSize, S)) for i in range(0, S, self.batchSize)]
+        args = [(grid, self.model, self.memBudget, self.dp[g], self.vp[g], self.d0[g], self.v0[g]) for g in groups]
+
+        print('optimizing {} segments in {} batches, {} states x {} actions'.format(S, len(groups), self.dArr.size*self.vArr.size, self.aArr.size))
+        if self.nProc > 1:
+            with Pool(self.nProc) as pool:
+                results = pool.starmap(_solveSegments, args)
+        else:
+            results = [_solveSegments(*arg) for arg in args]
+
+        dOpt = np.concatenate([res[0] for res in results]) + self.dShift[:,None]
+        vOpt = np.concatenate([res[1] for res in results])
+        aOpt = np.concatenate([res[2] for res in results])
+        cost = np.concatenate([res[3] for res in results])
+        tOpt = np.arange(self.model['N']+1)*self.model['dt']
+
+        info = {'dRes': self.dRes,
+                'vRes': self.vRes,
+                'aRes': self.aRes,
+                'vehId': [seg.get('vehId') for seg in self.segments],
+                'tBeg': [seg.get('tBeg') for seg in self.segments],
+                'feasible': np.isfinite(cost),
+                }
+        self.info = info
+        return tOpt, dOpt, vOpt, aOpt, cost, info
@@ -0,0 +1,64 @@
+# on-disk cache of DP solutions, one compressed .npz per segment, evicted least recently used first
+
+import os
+import glob
+import json
+import hashlib
+import zipfile
+import numpy as np
+
+class DPcache():
+
+    def __init__(self, cacheDir, maxBytes=2e9):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+
+    @staticmethod
+    def makeKey(arrays, params):
+        # content hash of the segment profiles and every setting that changes the solution
+        h = hashlib.sha1()
+        for arr in arrays:
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key + '.npz')
+
+    def load(self, key):
+        # returns the stored arrays as a dict, or None on a miss
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                solution = {name: data[name] for name in data.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # truncated or corrupt file, solve again
+            os.remove(path)
+            return None
+        # mtime marks the last use for LRU eviction
+        os.utime(path)
+        return solution
+
+    def save(self, key, **arrays):
+        # write to a temporary file first so readers never see a partial file
+        path = self.path(key)
+        tmpPath = path + '.tmp.npz'
+        np.savez_compressed(tmpPath, **arrays)
+        os.replace(tmpPath, path)
+        self.evict()
+
+    def evict(self):
+        fileList = [(os.path.getmtime(f), os.path.getsize(f), f) for f in glob.glob(os.path.join(self.cacheDir, '*.npz'))
+                    if not f.endswith('.tmp.npz')]
+        total = sum(size for _, size, _ in fileList)
+        for _, size, f in sorted(fileList):
+            if total <= self.maxBytes:
+                break
+            os.remove(f)
+            total -= size
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in glob.glob(os.path.join(self.cacheDir, '*.npz')))
@@ -4,10 +4,11 @@ import numpy as np
 from typing import Mapping
 from multiprocessing import Pool
 from itertools import repeat
+from .DPutils import gridIndex, reachableStates, chunkSizeFromBudget, PairScratch, MemoryMonitor
 
 class DPforward():
 
-    def __init__(self, Env, dRes=1, vRes=0.2, aRes=0.1):
+    def __init__(self, Env, dRes=1, vRes=0.2, aRes=0.1, ENABLE_PRUNE=False, memBudget=5e9, ENABLE_MEM_MONITOR=False):
         
         # get number of steps and dt from Env
         N = Env.N
@@ -54,6 +55,15 @@ class DPforward():
         self.dftol = dftol
         self.v0tol = v0tol
         self.vftol = vftol
+        # only evaluate states reachable from (d0, v0) that pass constrCheck
+        self.ENABLE_PRUNE = ENABLE_PRUNE
+
+        # state x action pairs are swept in chunks that fit memBudget bytes, sList/aList buffers are reused
+        self.memBudget = memBudget
+        # peakMemory[k]: largest process RSS sampled during step k, see MemoryMonitor, zeros when off
+        self.ENABLE_MEM_MONITOR = ENABLE_MEM_MONITOR
+        self.chunkSize = min(dList.size, chunkSizeFromBudget(memBudget, aArr.size))
+        self.scratch = PairScratch(aArr, self.chunkSize)
 
         # reset
         self.reset()
@@ -98,6 +108,17 @@ class DPforward():
         thld = 0.2
         iIter = 0
         iMax = 500
+
+        # forward reachability pass, Reachable[k] is the band of states evaluated at step k
+        if self.ENABLE_PRUNE:
+            idx0 = np.linalg.norm(np.abs(stateList-np.array((Env.d0,Env.v0))),axis=1).argmin()
+            Reachable = reachableStates(Env.getNextState, stateList, dArr, vArr, self.dRes, self.vRes, aArr, dpList.size, idx0, self.constrCheck, self.scratch)
+        else:
+            Reachable = None
+        nEvaluated = np.zeros(dpList.size, dtype=int)
+        nSkipped = np.zeros(dpList.size, dtype=int)
+        peakMemory = np.zeros(dpList.size, dtype=int)
+        memMonitor = MemoryMonitor(self.ENABLE_MEM_MONITOR)
         # while delta >= thld and i < iMax:
         # while (deltaNoInfMax >= thld or iIter < 1) and iIter < iMax:
         while iIter < 1:
@@ -112,23 +133,23 @@ class DPforward():
                 print('optimizing step {}/{}, progress {:.4f}%'.format(k+1, N, (N-(k))/N*100))
 
                 # check constraint to find out which states are valid, then only find values of these states, all other states will have inf value
-                idxLegitState = np.where(self.constrCheck(stateList, k))[0]
+                if Reachable is not None:
+                    idxLegitState = np.where(Reachable[k])[0]
+                else:
+                    idxLegitState = np.where(self.constrCheck(stateList, k))[0]
+                nEvaluated[k] = idxLegitState.size
+                nSkipped[k] = dList.size-idxLegitState.size
                 
                 # for each legit state, update Value
                 #   need to go through all possible action then find the smallest/best value
                 # 
                 # divide into several groups of state, action pairs then vectorize it
-                ns = stateList[idxLegitState].size
-                na = actionList.size
-                chunkSize = np.floor(5*1e9/8/na) # allow 5Gb size of the array
-                nchunk = np.ceil(ns/chunkSize)
-                stateListChunk = np.split(stateList[idxLegitState], nchunk)
-                for iChunk, sListChunk in enumerate(stateListChunk):
-                    # get number of state in current chunk
-                    nsInChunk = np.shape(sListChunk)[0]
-
+                for iChunk in range(0, idxLegitState.size, self.chunkSize):
                     # idx of each state back in the original stateList
-                    idxInOrigStateList = idxLegitState[np.arange((iChunk)*chunkSize,(iChunk)*chunkSize+min(nsInChunk,chunkSize),1).astype(int)]
+                    idxInOrigStateList = idxLegitState[iChunk:iChunk+self.chunkSize]
+
+                    # get number of state in current chunk
+                    nsInChunk = idxInOrigStateList.size
 
                     # store previous value
                     valuePrev = self.ValueMap[idxInOrigStateList,k]
@@ -136,8 +157,8 @@ class DPforward():
                     # make vectorized list of state and corresponding action
                     # sList is aArr.size of S: [S, S, ..., S], [[d0,v0],[d0,v1],...[dn,vn], [d0,v0],[d0,v1],...[dn,vn]] 
                     # aList is S.size of aArr then transpose: [A, A, ..., A]^T, [a0,a0,...a0,a1,a1,...a1,...,an], each a_i is of size S.size
-                    sList = np.tile(sListChunk, (aArr.size, 1))
-                    aList = (np.tile(aArr, (nsInChunk, 1))).transpose().flatten()
+                    # both are views into the preallocated scratch buffers
+                    sList, aList = self.scratch.fill(stateList[idxInOrigStateList])
 
                     # print('idxState {}'.format(idxState))
 
@@ -149,12 +170,8 @@ class DPforward():
 
                         # conver to idx in stateList
                         # dList, vList, stateList, ValueMap[:,k] all same size
-                        tmpIdxD = np.round((stateNextRaw[:,0]-dArr[0])/self.dRes)
-                        tmpIdxV = np.round((stateNextRaw[:,1]-vArr[0])/self.vRes)
-                        idx = (tmpIdxD*vArr.size + tmpIdxV).astype(int)
-                        # if say state is alreay on the upper bound, those state will be discarded and not add to value list
-                        idxValid = (tmpIdxD <= dArr.size-1) & (tmpIdxV <= vArr.size-1)
-                        # idx = idx[idxValid]
+                        # if say state is alreay on the bound, those state will be discarded and not add to value list
+                        idx, idxValid = gridIndex(stateNextRaw, dArr, vArr, self.dRes, self.vRes)
 
                         # stateNext = stateList[idx]
 
@@ -164,13 +181,14 @@ class DPforward():
                         #   d0,v1   v1,0 v1,1 ...
                         #   ...
                         r,_,_ = Env.getReward(sList, aList)
-                        valueList = r + self.ValueMap[np.minimum(idx, dList.size-1),k+1]
+                        valueList = r + self.ValueMap[idx,k+1]
                         valueList[~idxValid] = np.inf
                     else:
                         r,_,_ = Env.getReward(sList, aList)
                         valueList = r
 
                     valueListReshape = (np.reshape(valueList, (-1, nsInChunk))).transpose()
+                    memMonitor.sample()
                     aListReshape = (np.reshape(aList, (-1, nsInChunk))).transpose()
                     idxMinValue = np.argmin(valueListReshape, axis=1)
                     # aOpt[k] = actionList[idxMinValue]
@@ -193,8 +211,13 @@ class DPforward():
                     else:
                         deltaNoInfMax = np.inf
 
+                peakMemory[k] = memMonitor.stepPeak()
+                if self.ENABLE_MEM_MONITOR:
+                    print('\tpeak resident memory {:.1f} MB'.format(peakMemory[k]/1e6))
+
             print('optimizing iteration {}/{}, delta {:.4f}, delta noInf {:.4f}, threshold {:.4f}'.format(iIter, iMax, delta, deltaNoInfMax, thld))
             print('\ttotal value {}, number of finite {}'.format(self.ValueMap.size, self.ValueMap[np.isfinite(self.ValueMap)].size))
+            print('\tevaluated {} states, skipped {} states'.format(np.sum(nEvaluated), np.sum(nSkipped)))
 
             # update number of iteration
             iIter = iIter + 1
@@ -233,6 +256,9 @@ class DPforward():
         info['valueOpt'] = vv
         info['rewardOpt'] = rr
         info['idxOpt'] = ii
+        info['nEvaluated'] = nEvaluated
+        info['nSkipped'] = nSkipped
+        info['peakMemory'] = peakMemory
         if delta < thld:
             info['status'] = 'optimal ValueMap found under threshold {}'.format(thld)
         elif iIter >= 500:
@@ -0,0 +1,137 @@
+# helpers shared by DPbackward and DPforward
+
+import os
+import numpy as np
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# rough bytes held per (state, action) pair during one chunk: sList, aList, next state, reward,
+# value, grid index and the temporaries made by Env.getNextState/getReward
+BYTES_PER_PAIR = 128
+
+def actionGrid(Env, aRes):
+    # action grid shared by the DP solvers: Env.amin/amax, or the input bounds umin/umax of envs without them
+    amin = getattr(Env, 'amin', Env.umin)
+    amax = getattr(Env, 'amax', Env.umax)
+    return np.arange(np.floor(amin), np.ceil(amax), aRes)
+
+def chunkSizeFromBudget(memBudget, na):
+    # number of states per chunk so that states x actions fit in memBudget bytes
+    return max(1, int(memBudget//(BYTES_PER_PAIR*na)))
+
+class PairScratch():
+    # sList/aList buffers for up to chunkSize states x all actions, allocated once and reused by every chunk
+    # layout is [S, S, ..., S] and [a0, a0, ..., a1, a1, ...], i.e. action major as np.tile used to give
+    def __init__(self, aArr, chunkSize, dtype=np.float64):
+        self.aArr = aArr.astype(dtype)
+        self.sBuf = np.empty((chunkSize*aArr.size, 2), dtype=dtype)
+        self.aBuf = np.empty(chunkSize*aArr.size, dtype=dtype)
+        self.nsFilled = 0
+
+    def fill(self, states):
+        ns, na = states.shape[0], self.aArr.size
+        sList = self.sBuf[:ns*na]
+        aList = self.aBuf[:ns*na]
+        sList.reshape(na, ns, 2)[:] = states[None,:,:]
+        if ns != self.nsFilled:
+            aList.reshape(na, ns)[:] = self.aArr[:,None]
+            self.nsFilled = ns
+        return sList, aList
+
+def currentRss():
+    # current resident set size of the process in bytes, numpy buffers and torch tensors alike, 0 if unknown
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return 0
+
+class MemoryMonitor():
+    # peak resident set size per step: sample() is called after every chunk of a step, stepPeak() returns the
+    # largest sample since the previous stepPeak(). Off by default, stepPeak() returns 0 then
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.peak = 0
+
+    def sample(self):
+        if self.enabled:
+            self.peak = max(self.peak, currentRss())
+
+    def stepPeak(self):
+        self.sample()
+        peak = self.peak
+        self.peak = 0
+        return peak
+
+def gridIndex(stateNextRaw, dArr, vArr, dRes, vRes):
+    # snap raw (d, v) states to the grid, returns idx in stateList and whether it lies on the grid
+    tmpIdxD = np.round((stateNextRaw[:,0]-dArr[0])/dRes)
+    tmpIdxV = np.round((stateNextRaw[:,1]-vArr[0])/vRes)
+    idxValid = (tmpIdxD >= 0) & (tmpIdxD <= dArr.size-1) & (tmpIdxV >= 0) & (tmpIdxV <= vArr.size-1)
+    idx = np.where(idxValid, tmpIdxD*vArr.size + tmpIdxV, 0).astype(int)
+    return idx, idxValid
+
+def reachableStates(getNextState, stateList, dArr, vArr, dRes, vRes, aArr, N, idx0, legitCheck=None, scratch=None, dilate=False):
+    # forward pass over the grid with the same snapped dynamics as the backward sweep
+    # Reachable[k, i] is True if stateList[i] can be reached at step k from stateList[idx0],
+    # legitCheck(stateList, k) removes states that break the constraints, their successors are not expanded
+    # getNextState(sList, aList) works on numpy arrays, scratch is a PairScratch bounding the chunk size
+    # dilate adds the 8 grid neighbours of every reached state, as bilinear lookup reads all four corners
+    # of the cell around a successor and not only the nearest one
+    Reachable = np.zeros((N, stateList.shape[0]), dtype=bool)
+    Reachable[0,idx0] = True
+    if scratch is None:
+        scratch = PairScratch(aArr, stateList.shape[0])
+    chunkSize = scratch.aBuf.size//aArr.size
+    for k in range(N):
+        idxState = np.where(Reachable[k])[0]
+        if legitCheck is not None:
+            idxState = idxState[legitCheck(stateList[idxState], k)]
+            Reachable[k] = False
+            Reachable[k,idxState] = True
+        if k == N-1 or idxState.size == 0:
+            break
+
+        for iChunk in range(0, idxState.size, chunkSize):
+            sList, aList = scratch.fill(stateList[idxState[iChunk:iChunk+chunkSize]])
+            idx, idxValid = gridIndex(getNextState(sList, aList), dArr, vArr, dRes, vRes)
+            Reachable[k+1,idx[idxValid]] = True
+        if dilate:
+            Reachable[k+1] = dilateGrid(Reachable[k+1].reshape(dArr.size, vArr.size)).reshape(-1)
+    return Reachable
+
+def dilateGrid(mask):
+    # mask [nD, nV] grown by one cell in d and v, diagonals included
+    out = mask.copy()
+    out[1:,:] |= mask[:-1,:]
+    out[:-1,:] |= mask[1:,:]
+    rows = out.copy()
+    out[:,1:] |= rows[:,:-1]
+    out[:,:-1] |= rows[:,1:]
+    return out
+
+def gridInterp(stateNextRaw, dArr, vArr, dRes, vRes):
+    # bilinear interpolation on the (d, v) grid: idx [4, n] of the surrounding points in stateList,
+    # their weights w [4, n] and whether the state lies inside the grid
+    fd = (stateNextRaw[:,0]-dArr[0])/dRes
+    fv = (stateNextRaw[:,1]-vArr[0])/vRes
+    idxValid = (fd >= 0) & (fd <= dArr.size-1) & (fv >= 0) & (fv <= vArr.size-1)
+    iD = np.clip(np.floor(fd), 0, max(dArr.size-2, 0)).astype(int)
+    iV = np.clip(np.floor(fv), 0, max(vArr.size-2, 0)).astype(int)
+    wd = np.clip(fd-iD, 0, 1)
+    wv = np.clip(fv-iV, 0, 1)
+    iD1 = np.minimum(iD+1, dArr.size-1)
+    iV1 = np.minimum(iV+1, vArr.size-1)
+    idx = np.stack((iD*vArr.size+iV, iD*vArr.size+iV1, iD1*vArr.size+iV, iD1*vArr.size+iV1))
+    w = np.stack(((1-wd)*(1-wv), (1-wd)*wv, wd*(1-wv), wd*wv))
+    return idx, w, idxValid
+
+def interpValue(Value, idx, w):
+    # weighted sum of the neighbour values, neighbours with zero weight are dropped so their inf does not give nan
+    with np.errstate(invalid='ignore'):
+        return np.sum(np.where(w > 0, w*Value[idx], 0), axis=0)
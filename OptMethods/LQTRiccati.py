@@ -0,0 +1,74 @@
+import time
+import torch
+
+class LQTRiccati():
+    # finite-horizon discrete LQ tracking for Env.LQT / LQTVec, batched over reference trajectories:
+    #   min sum_{k<N} (x_k-r_k)^T Q (x_k-r_k) + u_k^T R u_k + (x_N-r_N)^T Qf (x_N-r_N),  x_{k+1} = A x_k + B u_k
+    # The feedback gains depend only on (A, B, Q, R, Qf, N) and are computed once, the feedforward term
+    # is a backward sweep over all references at once. Inputs are not bounded, while LQT.step clips
+    # them to [-1, 1], so the cost is a lower bound on what any policy can reach in the env.
+    def __init__(self, Env, dtype=torch.float64):
+        self.N = Env.N
+        self.dtype = dtype
+        self.A = torch.as_tensor(Env.A, dtype=dtype)
+        self.B = torch.as_tensor(Env.B, dtype=dtype)
+        self.Q = torch.as_tensor(Env.Q, dtype=dtype)
+        self.R = torch.as_tensor(Env.R, dtype=dtype)
+        self.Qf = torch.as_tensor(Env.Qf, dtype=dtype)
+        # same scaling as the env reward
+        self.costScale = 0.01
+        self.solveRiccati()
+
+    def solveRiccati(self):
+        # P_k of the value x^T P_k x + 2 s_k^T x + c_k, feedback gains K_k and G_k = (R + B^T P_{k+1} B)^-1 B^T
+        A, B, Q, R = self.A, self.B, self.Q, self.R
+        n, m = B.shape
+        self.P = torch.empty((self.N+1, n, n), dtype=self.dtype)
+        self.K = torch.empty((self.N, m, n), dtype=self.dtype)
+        self.G = torch.empty((self.N, m, n), dtype=self.dtype)
+        self.P[self.N] = self.Qf
+        for k in range(self.N-1, -1, -1):
+            P = self.P[k+1]
+            G = torch.linalg.solve(R + B.T @ P @ B, B.T)
+            self.G[k] = G
+            self.K[k] = G @ P @ A
+            P = Q + A.T @ P @ (A - B @ self.K[k])
+            self.P[k] = 0.5*(P + P.T)
+
+    def runOpt(self, dp, x0):
+        # dp: references [nRef, N+1, 4], x0: initial states [nRef, 4]
+        # returns optimal inputs uOpt [nRef, N, 2], states xOpt [nRef, N+1, 4] and costs [nRef] in env units
+        dp = torch.as_tensor(dp, dtype=self.dtype).reshape(-1, self.N+1, self.A.shape[0])
+        x0 = torch.as_tensor(x0, dtype=self.dtype).reshape(-1, self.A.shape[0])
+        nRef = dp.shape[0]
+        A, B, Q = self.A, self.B, self.Q
+
+        # feedforward: s_N = -Qf r_N, s_k = (A - B K_k)^T s_{k+1} - Q r_k, u_k = -K_k x_k - G_k s_{k+1}
+        sNext = -dp[:,self.N] @ self.Qf.T
+        uff = torch.empty((nRef, self.N, B.shape[1]), dtype=self.dtype)
+        for k in range(self.N-1, -1, -1):
+            uff[:,k] = -sNext @ self.G[k].T
+            sNext = sNext @ (A - B @ self.K[k]) - dp[:,k] @ Q.T
+
+        xOpt = torch.empty((nRef, self.N+1, A.shape[0]), dtype=self.dtype)
+        uOpt = torch.empty_like(uff)
+        xOpt[:,0] = x0
+        cost = torch.zeros(nRef, dtype=self.dtype)
+        for k in range(self.N):
+            x = xOpt[:,k]
+            u = -x @ self.K[k].T + uff[:,k]
+            e = x - dp[:,k]
+            cost = cost + ((e @ Q) * e).sum(1) + ((u @ self.R) * u).sum(1)
+            uOpt[:,k] = u
+            xOpt[:,k+1] = x @ A.T + u @ B.T
+        e = xOpt[:,self.N] - dp[:,self.N]
+        cost = cost + ((e @ self.Qf) * e).sum(1)
+        return uOpt, xOpt, cost*self.costScale
+
+    def optimalityGap(self, dp, x0, costPolicy):
+        # relative gap of achieved episode costs [nRef] (i.e. -episode reward) to the LQT optimum
+        tStart = time.time()
+        _, _, costOpt = self.runOpt(dp, x0)
+        costPolicy = torch.as_tensor(costPolicy, dtype=self.dtype).reshape(-1)
+        gap = (costPolicy - costOpt)/costOpt.abs().clamp(min=1e-12)
+        return gap, costOpt, time.time()-tStart
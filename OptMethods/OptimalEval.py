@@ -0,0 +1,245 @@
+import torch
+
+# Optimal baselines for Env.Linear and Env.NonLinear and a batched evaluator comparing them with an
+# agent's actions on a whole grid of observations (x, k). Both solvers follow the env's own objective:
+#   - step j (true time j = 0..N-1) applies u_j, then getReward is evaluated on x_{j+1} with the step
+#     counter already incremented to j+1,
+#   - for j+1 < N that is the stage cost of (x_{j+1}, u_j), for j+1 == N only the terminal cost of x_N,
+#     so the last action u_{N-1} is not penalized,
+#   - the k slot of an observation lags one step: after step j it holds j, i.e. an observation with slot k
+#     is the state at true time t = k+1. Only the reset state (t = 0) shares slot 0 with t = 1, the
+#     evaluator treats every observation as t = k+1.
+# runOpt(x, k) returns the optimal action and the cost-to-go (sum of -reward until the episode ends) of
+# every grid point, rolloutCost plays the solver's plan in the env to check the claimed cost.
+
+class LinearRiccati():
+    # Env.Linear: x_{j+1} = x_j + u_j, reward -0.5 u_j^2 for j < N-1 and -0.5 x_N^2 at the last step.
+    # Scalar Riccati recursion for V_j(x) = 0.5 P_j x^2 with the control weight r_j = 1 (j < N-1),
+    # r_{N-1} = 0 and P_N = 1: P_j = r_j P_{j+1}/(r_j + P_{j+1}), u*_j = -P_{j+1}/(r_j + P_{j+1}) x_j.
+    # With the free last action this gives u*_{N-1} = -x, P_j = 0 and u*_j = 0 before it.
+    def __init__(self, Env=None, N=None):
+        self.N = Env.N if N is None else N
+        self.IS_K = True if Env is None else Env.IS_K
+        self.P = torch.empty(self.N+1, dtype=torch.float64)
+        self.gain = torch.empty(self.N, dtype=torch.float64)
+        self.P[self.N] = 1.0
+        for j in range(self.N-1, -1, -1):
+            r = 0.0 if j == self.N-1 else 1.0
+            self.gain[j] = self.P[j+1]/(r + self.P[j+1])
+            self.P[j] = r*self.P[j+1]/(r + self.P[j+1])
+
+    def startTime(self, k):
+        t = k.reshape(-1).long() + 1
+        if torch.any(t > self.N-1):
+            raise ValueError('observations with k > N-2 have no action left, got k up to {}'.format(int(t.max())-1))
+        return t
+
+    def runOpt(self, x, k):
+        # x [G, 1] or [G], observation slot k [G] -> u [G, 1], cost-to-go [G]
+        x = x.reshape(-1).to(torch.float64)
+        t = self.startTime(k)
+        return (-self.gain[t]*x).reshape(-1, 1), 0.5*self.P[t]*x**2
+
+    def plan(self, x, k):
+        # optimal controls uSeq [G, N, 1] by true time (zero before the start) and the cost-to-go [G]
+        x = x.reshape(-1).to(torch.float64)
+        t = self.startTime(k)
+        uSeq = torch.zeros((x.shape[0], self.N, 1), dtype=torch.float64)
+        xj = x
+        for j in range(self.N):
+            u = torch.where(t <= j, -self.gain[j]*xj, torch.zeros_like(xj))
+            uSeq[:,j,0] = u
+            xj = xj + u
+        return uSeq, 0.5*self.P[t]*x**2
+
+    def observation(self, x, k):
+        x = x.reshape(-1, 1)
+        if self.IS_K:
+            return torch.column_stack((x, k.reshape(-1).to(x.dtype)))
+        return x
+
+
+class NonLinearILQR():
+    # Env.NonLinear: x0' = 0.2 x0 exp(x1^2) + g00 u0, x1' = 0.3 x1^3 + g11 u1, reward
+    # -(0.5 x_{j+1}^T Q x_{j+1} + u_j^T R u_j) for j < N-1 and -0.5 x_N^T Qf x_N at the last step.
+    # In the usual stage form the state cost is paid on x_{t+1}..x_{N-1} (not on the start state, its cost
+    # belongs to the previous reward), the control cost on u_t..u_{N-2} and Qf on x_N. Iterative LQR run for
+    # all grid points at once: every point starts at its own true time t, the steps before t are padded as
+    # inactive (x kept, zero state cost, u pushed to 0 by R) so the whole batch shares one horizon of N steps.
+    def __init__(self, Env, maxIter=100, tol=1e-7, mu=1e-6, dtype=torch.float64):
+        self.N = Env.N
+        self.dtype = dtype
+        self.Q = Env.Q.to(dtype)
+        self.R = Env.R.to(dtype)
+        self.Qf = Env.Qf.to(dtype)
+        self.g = Env.g.to(dtype)
+        self.IS_K = Env.IS_K
+        self.maxIter = maxIter
+        self.tol = tol
+        self.mu = mu
+        self.alphaList = torch.tensor([1.0, 0.5, 0.25, 0.1, 0.05, 0.01], dtype=dtype)
+        # control weight per step, the last action is free
+        self.rMask = torch.ones(self.N, dtype=dtype)
+        self.rMask[-1] = 0
+
+    def dynamics(self, x, u):
+        # batched Env.NonLinear.getNextState without the time index, x [..., 2], u [..., 2]
+        return torch.stack((0.2*x[...,0]*torch.exp(x[...,1]**2) + self.g[0,0]*u[...,0],
+                            0.3*x[...,1]**3 + self.g[1,1]*u[...,1]), dim=-1)
+
+    def jacobians(self, x, u):
+        # fx, fu [..., 2, 2]
+        e = torch.exp(x[...,1]**2)
+        zero = torch.zeros_like(e)
+        fx = torch.stack((torch.stack((0.2*e, 0.4*x[...,0]*x[...,1]*e), dim=-1),
+                          torch.stack((zero, 0.9*x[...,1]**2), dim=-1)), dim=-2)
+        fu = self.g.expand(*x.shape[:-1], 2, 2)
+        return fx, fu
+
+    def rollout(self, x0, u, active, xMask):
+        # states [G, N+1, 2] and total costs [G] of the controls u [G, N, 2]
+        xList = [x0]
+        cost = torch.zeros(x0.shape[0], dtype=self.dtype)
+        for i in range(self.N):
+            x = xList[-1]
+            stage = 0.5*((x @ self.Q)*x).sum(-1)*xMask[:,i] + ((u[:,i] @ self.R)*u[:,i]).sum(-1)*self.rMask[i]
+            cost = cost + stage
+            xList.append(torch.where(active[:,i,None] > 0, self.dynamics(x, u[:,i]), x))
+        xs = torch.stack(xList, dim=1)
+        cost = cost + 0.5*((xs[:,-1] @ self.Qf)*xs[:,-1]).sum(-1)
+        return xs, cost
+
+    def backward(self, xs, u, active, xMask):
+        # feedforward kff [G, N, 2] and gains K [G, N, 2, 2] of one iLQR step
+        G = xs.shape[0]
+        fx, fu = self.jacobians(xs[:,:-1], u)
+        a = active[...,None,None]
+        eye = torch.eye(2, dtype=self.dtype)
+        fx = torch.where(a > 0, fx, eye)
+        fu = torch.where(a > 0, fu, torch.zeros_like(fu))
+        Vx = xs[:,-1] @ self.Qf
+        Vxx = self.Qf.expand(G, 2, 2)
+        kff = torch.empty_like(u)
+        K = torch.empty((G, self.N, 2, 2), dtype=self.dtype)
+        for i in range(self.N-1, -1, -1):
+            lx = (xs[:,i] @ self.Q)*xMask[:,i,None]
+            lxx = self.Q*xMask[:,i,None,None]
+            R = self.R*self.rMask[i]
+            fxT = fx[:,i].transpose(1, 2)
+            fuT = fu[:,i].transpose(1, 2)
+            Qx = lx + (fxT @ Vx[...,None])[...,0]
+            Qu = 2*u[:,i] @ R + (fuT @ Vx[...,None])[...,0]
+            Qxx = lxx + fxT @ Vxx @ fx[:,i]
+            Quu = 2*R + fuT @ Vxx @ fu[:,i] + self.mu*eye
+            Qux = fuT @ Vxx @ fx[:,i]
+            kff[:,i] = -torch.linalg.solve(Quu, Qu[...,None])[...,0]
+            K[:,i] = -torch.linalg.solve(Quu, Qux)
+            KT = K[:,i].transpose(1, 2)
+            Vx = Qx + (KT @ Quu @ kff[:,i,:,None])[...,0] + (KT @ Qu[...,None])[...,0] + (Qux.transpose(1, 2) @ kff[:,i,:,None])[...,0]
+            Vxx = Qxx + KT @ Quu @ K[:,i] + KT @ Qux + Qux.transpose(1, 2) @ K[:,i]
+            Vxx = 0.5*(Vxx + Vxx.transpose(1, 2))
+        return kff, K
+
+    def forward(self, xs, u, kff, K, alpha, active):
+        xList = [xs[:,0]]
+        uNew = torch.empty_like(u)
+        for i in range(self.N):
+            dx = xList[-1] - xs[:,i]
+            uNew[:,i] = u[:,i] + alpha[:,None]*kff[:,i] + (K[:,i] @ dx[...,None])[...,0]
+            xList.append(torch.where(active[:,i,None] > 0, self.dynamics(xList[-1], uNew[:,i]), xList[-1]))
+        return uNew
+
+    def plan(self, x, k):
+        # optimal controls uSeq [G, N, 2] by true time (zero before the start) and the cost-to-go [G]
+        x0 = x.reshape(-1, 2).to(self.dtype)
+        t = k.reshape(-1).long() + 1
+        if torch.any(t > self.N-1):
+            raise ValueError('observations with k > N-2 have no action left, got k up to {}'.format(int(t.max())-1))
+        G = x0.shape[0]
+        steps = torch.arange(self.N)[None,:]
+        active = (steps >= t[:,None]).to(self.dtype)
+        xMask = (steps > t[:,None]).to(self.dtype)
+        u = torch.zeros((G, self.N, 2), dtype=self.dtype)
+        xs, cost = self.rollout(x0, u, active, xMask)
+        for _ in range(self.maxIter):
+            kff, K = self.backward(xs, u, active, xMask)
+            # line search for every point at once, each keeps its best step size if it improves
+            uBest, costBest = u, cost
+            for alpha in self.alphaList:
+                uTry = self.forward(xs, u, kff, K, alpha.expand(G), active)
+                _, costTry = self.rollout(x0, uTry, active, xMask)
+                better = costTry < costBest
+                uBest = torch.where(better[:,None,None], uTry, uBest)
+                costBest = torch.where(better, costTry, costBest)
+            improvement = ((cost - costBest)/cost.abs().clamp(min=1e-12)).max()
+            u, cost = uBest, costBest
+            xs, _ = self.rollout(x0, u, active, xMask)
+            if improvement < self.tol:
+                break
+        return u, cost
+
+    def runOpt(self, x, k):
+        # x [G, 2], observation slot k [G] -> optimal action at true time k+1 u [G, 2] and cost-to-go [G]
+        u, cost = self.plan(x, k)
+        t = k.reshape(-1).long() + 1
+        return u[torch.arange(u.shape[0]), t], cost
+
+    def observation(self, x, k):
+        x = x.reshape(-1, 2)
+        if self.IS_K:
+            return torch.column_stack((x, k.reshape(-1).to(x.dtype)))
+        return x
+
+
+def rolloutCost(Env, solver, x, k):
+    # cost of playing solver.plan(x, k) from the observations (x, k) through the env's batched
+    # getNextState/getReward, i.e. the sum of -reward until the episode ends, and the cost the solver claims
+    uSeq, costClaimed = solver.plan(x, k)
+    t = k.reshape(-1).long() + 1
+    obs = solver.observation(x, k).float()
+    uSeq = uSeq.float()
+    cost = torch.zeros(obs.shape[0], dtype=torch.float64)
+    for j in range(solver.N):
+        active = t <= j
+        # the k slot of x_{j+1} is j, the reward is taken with the counter at j+1
+        obsNext = Env.getNextState(obs, uSeq[:,j], j)
+        reward = Env.getReward(obsNext, uSeq[:,j], j+1)
+        cost = cost - torch.where(active, reward.reshape(-1).double(), torch.zeros_like(cost))
+        obs = torch.where(active[:,None], obsNext, obs)
+    return cost, costClaimed
+
+
+def verifyBaseline(Env, solver, x, k, tol=1e-3):
+    # raises if the env's rollout cost of the baseline differs from its claimed cost-to-go
+    cost, costClaimed = rolloutCost(Env, solver, x, k)
+    err = ((cost - costClaimed).abs()/costClaimed.abs().clamp(min=1.0)).max().item()
+    if err > tol:
+        raise RuntimeError('{} does not match the env objective, relative cost error {:.2e}'.format(type(solver).__name__, err))
+    return err
+
+
+def evaluatePolicy(agent, solver, x, k):
+    # optimal actions of solver and the deterministic agent.select_action_batch on the same batch of grid
+    # points x [G, n], k [G]; returns the error statistics, the per-k mean absolute error and both action batches
+    uOpt, costOpt = solver.runOpt(x, k)
+    observation = solver.observation(x, k).float()
+    uAgent = agent.select_action_batch(observation, evaluate=True).reshape(uOpt.shape).to(uOpt.dtype)
+    err = (uAgent - uOpt).abs()
+    kUnique, kInverse = torch.unique(k.reshape(-1), return_inverse=True)
+    errPerK = torch.zeros(kUnique.numel(), dtype=err.dtype).index_add_(0, kInverse, err.mean(-1))
+    errPerK = errPerK/torch.bincount(kInverse, minlength=kUnique.numel())
+    stats = {'mae': err.mean().item(),
+             'rmse': err.pow(2).mean().sqrt().item(),
+             'max': err.max().item(),
+             'k': kUnique,
+             'maePerK': errPerK}
+    return stats, uAgent, uOpt, costOpt
+
+
+def stateGrid(xList, kList):
+    # all combinations of the states xList [nX, n] and observation slots kList [nK] as x [nX*nK, n], k [nX*nK]
+    xList = torch.as_tensor(xList).reshape(len(xList), -1)
+    kList = torch.as_tensor(kList).reshape(-1)
+    x = xList.repeat_interleave(kList.numel(), dim=0)
+    k = kList.repeat(xList.shape[0])
+    return x, k
@@ -6,7 +6,11 @@ import torch.optim as optim
 from torch.distributions import Normal, Categorical
 import numpy as np
 from torch.optim import Adam
-from .lib.ReplayBuffer import Replay_buffer
+from .lib.ReplayBuffer import build_replay_buffer
+from .lib.TargetUpdate import SoftUpdater
+from .lib.LossMeter import LossMeter
+from .lib.Compile import CompiledFn
+from .lib.AgentBase import PolicyActions, BatchUpdates
 import gymnasium as gym
 
 LOG_SIG_MAX = 2
@@ -162,10 +166,11 @@ class Q(nn.Module):
     
 
 
-class SAC:
+class SAC(PolicyActions, BatchUpdates):
     def __init__(self, state_dim, action_space, ScalingDict, device, args):
         self.gamma = args.gamma
         self.tau = args.tau
+        self.loss_meter = LossMeter()
         self.device = device
         self.alpha = torch.FloatTensor([args.alpha]).to(device)
         self.state_dim = state_dim
@@ -174,7 +179,8 @@ class SAC:
         
             
         self.automatic_entropy_tuning = args.automatic_entropy_tuning   
-        self.replay_buffer = Replay_buffer()
+        self.replay_buffer = build_replay_buffer(args, device)
+        self.PRIORITIZED = getattr(self.replay_buffer, 'PRIORITIZED', False)
 
 
         xumean = torch.cat([ScalingDict.get('xMean', torch.zeros(state_dim)).to(device),
@@ -194,6 +200,7 @@ class SAC:
             target_param.data.copy_(param.data)
         for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
             target_param.data.copy_(param.data)
+        self.target_updater = SoftUpdater([self.Q_target_net1, self.Q_target_net2], [self.Q_net1, self.Q_net2], self.tau, getattr(args, 'target_update_every', 1))
 
         self.policy_type = args.policy_type
         if self.policy_type == "Gaussian":
@@ -207,12 +214,18 @@ class SAC:
             self.policy_net = DeterministicPolicy(state_dim, action_space.shape[0], args.hidden_size, action_space).to(self.device)
         self.policy_optimizer = Adam(self.policy_net.parameters(), lr=args.learning_rate)
 
+        # compile = True runs the policy sampling and both losses through torch.compile, eager otherwise
+        self.COMPILE = getattr(args, 'compile', False)
+        self.sample_fn = CompiledFn(self.policy_net.sample, self.COMPILE)
+        self.critic_loss_fn = CompiledFn(self.critic_loss, self.COMPILE)
+        self.actor_loss_fn = CompiledFn(self.actor_loss, self.COMPILE)
+
     def select_action(self, state, evaluate=False,ref=None):
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
         if evaluate is False:
-            action, _, _ = self.policy_net.sample(state)
+            action, _, _ = self.sample_fn(state)
         else:
-            _, _, action = self.policy_net.sample(state)
+            _, _, action = self.sample_fn(state)
         return action.detach().cpu()[0]
 
     def evaluate(self, state):
@@ -318,29 +331,52 @@ class SAC:
         
         
         
-    def update(self, batch_size, Info=None):
-        x, y, u, r, d, ref = self.replay_buffer.sample(batch_size)
-        state_batch = torch.FloatTensor(x).to(self.device)
-        action_batch = torch.LongTensor(u).to(self.device) if self.is_discrete else torch.FloatTensor(u).to(self.device).reshape(-1, self.action_dim)
-        next_state_batch = torch.FloatTensor(y).to(self.device)
-        reward_batch = torch.FloatTensor(r).reshape(-1, 1).to(self.device)
-        done_batch = torch.FloatTensor(1 - np.array(d)).reshape(-1, 1).to(self.device)
-
+    def critic_loss(self, state_batch, action_batch, reward_batch, done_batch, next_state_batch, alpha, weight_batch=None):
+        # TD losses of both critics, their model (next state) losses and the absolute TD error [B, 1]
         with torch.no_grad():
             next_action, next_log_pi, _= self.policy_net.sample(next_state_batch)
             q1_next, _ = self.Q_target_net1(next_state_batch, next_action)
             q2_next, _ = self.Q_target_net2(next_state_batch, next_action)
             # next_log_pi = next_log_pi.sum(dim=1, keepdim=True)
-            min_q_next = torch.min(q1_next, q2_next) - self.alpha * next_log_pi.reshape(-1, 1)
+            min_q_next = torch.min(q1_next, q2_next) - alpha * next_log_pi.reshape(-1, 1)
             next_q_value = reward_batch + done_batch * self.gamma * min_q_next
 
         qf1, model_output1 = self.Q_net1(state_batch, action_batch)
         qf2, model_output2 = self.Q_net2(state_batch, action_batch)
         
-        q1_loss = F.mse_loss(qf1, next_q_value)
-        q2_loss = F.mse_loss(qf2, next_q_value)
+        if weight_batch is None:
+            q1_loss = F.mse_loss(qf1, next_q_value)
+            q2_loss = F.mse_loss(qf2, next_q_value)
+        else:
+            # importance-sampling weighted critic loss
+            q1_loss = (weight_batch * (qf1 - next_q_value).pow(2)).mean()
+            q2_loss = (weight_batch * (qf2 - next_q_value).pow(2)).mean()
+        td_error = 0.5*((qf1 - next_q_value).abs() + (qf2 - next_q_value).abs()).detach()
         model1_loss = F.mse_loss(model_output1, next_state_batch)
         model2_loss = F.mse_loss(model_output2, next_state_batch)
+        return q1_loss, q2_loss, model1_loss, model2_loss, td_error
+
+    def actor_loss(self, state_batch, alpha):
+        pi, log_prob, _ = self.policy_net.sample(state_batch)
+        q1_pi, _ = self.Q_net1(state_batch, pi)
+        q2_pi, _ = self.Q_net2(state_batch, pi)
+
+        min_q_pi = torch.min(q1_pi, q2_pi)
+        return (alpha * log_prob - min_q_pi).mean(), log_prob
+
+    def update_batch(self, batch, weight_batch=None, sampleIdx=None):
+        # one gradient step on a minibatch already on the device, PER weights and indices come with it
+        x, y, u, r, d, ref = batch
+        state_batch = x
+        action_batch = u.long() if self.is_discrete else u.reshape(-1, self.action_dim)
+        next_state_batch = y
+        reward_batch = r.reshape(-1, 1)
+        done_batch = (1 - d).reshape(-1, 1)
+
+        q1_loss, q2_loss, model1_loss, model2_loss, self.td_error = self.critic_loss_fn(state_batch, action_batch, reward_batch, done_batch, next_state_batch, self.alpha, weight_batch)
+        if self.PRIORITIZED:
+            # new priorities from the TD errors
+            self.replay_buffer.updatePriorities(sampleIdx, self.td_error.cpu().numpy())
         
         self.Q1_optimizer.zero_grad()
         self.Q2_optimizer.zero_grad()
@@ -357,12 +393,7 @@ class SAC:
         self.Q1_optimizer.step()
         self.Q2_optimizer.step()
         
-        pi, log_prob, _ = self.policy_net.sample(state_batch)
-        q1_pi, model_output1 = self.Q_net1(state_batch, pi)
-        q2_pi, model_output2 = self.Q_net2(state_batch, pi)
-
-        min_q_pi = torch.min(q1_pi, q2_pi)
-        policy_loss = (self.alpha * log_prob - min_q_pi).mean()
+        policy_loss, log_prob = self.actor_loss_fn(state_batch, self.alpha)
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
         self.policy_optimizer.step()
@@ -374,13 +405,12 @@ class SAC:
             self.alpha_optim.step()
             self.alpha = self.log_alpha.exp()
 
-        for target_param, param in zip(self.Q_target_net1.parameters(), self.Q_net1.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
+        self.target_updater()
         # if self.alpha.item()<0.3:
         #     self.MPC_rollout(state_batch[25])
-        return q1_loss.item(), q2_loss.item(), policy_loss.item(), alpha_loss.item(), self.alpha.item()
+        self.loss_meter.add(Q1=q1_loss, Q2=q2_loss, Policy=policy_loss, Alpha=self.alpha)
+        if self.automatic_entropy_tuning:
+            self.loss_meter.add(Alpha_loss=alpha_loss)
     
     
     def save(self, modelPath):
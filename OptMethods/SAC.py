@@ -6,7 +6,12 @@ import torch.optim as optim
 from torch.distributions import Normal, Categorical
 import numpy as np
 from torch.optim import Adam
-from .lib.ReplayBuffer import Replay_buffer
+from .lib.ReplayBuffer import build_replay_buffer
+from .lib.TargetUpdate import SoftUpdater
+from .lib.LossMeter import LossMeter
+from .lib.Compile import CompiledFn
+from .lib.AgentBase import PolicyActions, BatchUpdates, TwinCritics
+from .lib.NeuroModel import EnsembleMLP, ensemble_min
 
 LOG_SIG_MAX = 2
 LOG_SIG_MIN = -20
@@ -156,20 +161,41 @@ class Q(nn.Module):
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         return self.fc3(x)
-    
+
+class EnsembleQ(nn.Module):
+    # K critics of the Q architecture above in one module, forward returns [K, B, 1]
+    def __init__(self, state_dim, action_dim, xMean, xStd, hidden_dim=512, is_discrete=False, K=2):
+        super(EnsembleQ, self).__init__()
+        self.fc = EnsembleMLP(K, [state_dim + action_dim, hidden_dim, hidden_dim, 1])
+        self.K = K
+        self.state_dim = state_dim
+        self.action_dim = action_dim
+        self.xmean = xMean
+        self.xstd = xStd
+        self.is_discrete = is_discrete
+
+    def forward(self, s, a):
+        s = (s - self.xmean[:self.state_dim]) / self.xstd[:self.state_dim]
+        if self.is_discrete:
+            a = F.one_hot(a.to(torch.int64), num_classes=self.action_dim).float()
+        x = torch.cat((s, a), -1)
+        x = (x - self.xmean) / self.xstd
+        return self.fc(x)
 
 
-class SAC:
+class SAC(PolicyActions, BatchUpdates, TwinCritics):
     def __init__(self, state_dim, action_space, ScalingDict, device, args):
         self.gamma = args.gamma
         self.tau = args.tau
+        self.loss_meter = LossMeter()
         self.device = device
         self.alpha = torch.FloatTensor([args.alpha]).to(device)
         self.state_dim = state_dim
         self.action_dim = action_space.shape[0]
         self.is_discrete = args.is_discrete
         self.automatic_entropy_tuning = args.automatic_entropy_tuning   
-        self.replay_buffer = Replay_buffer()
+        self.replay_buffer = build_replay_buffer(args, device)
+        self.PRIORITIZED = getattr(self.replay_buffer, 'PRIORITIZED', False)
 
 
         xumean = torch.cat([ScalingDict.get('xMean', torch.zeros(state_dim)).to(device),
@@ -177,20 +203,11 @@ class SAC:
         xustd = torch.cat([ScalingDict.get('xStd', torch.ones(state_dim)).to(device),
                            ScalingDict.get('uStd', torch.ones(self.action_dim)).to(device)])
 
-        self.Q_net1 = Q(state_dim, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, self.is_discrete).to(device)
-        self.Q_net2 = Q(state_dim, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, self.is_discrete).to(device)
-        self.Q_net_list = [self.Q_net1, self.Q_net2]
-        self.Q_target_net1 = Q(state_dim, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, self.is_discrete).to(device)
-        self.Q_target_net2 = Q(state_dim, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, self.is_discrete).to(device)
-        self.Q_target_net_list = [self.Q_target_net1, self.Q_target_net2]
-
-        self.Q1_optimizer = Adam(self.Q_net1.parameters(), lr=args.learning_rate)
-        self.Q2_optimizer = Adam(self.Q_net2.parameters(), lr=args.learning_rate)
-
-        for target_param, param in zip(self.Q_target_net1.parameters(), self.Q_net1.parameters()):
-            target_param.data.copy_(param.data)
-        for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
-            target_param.data.copy_(param.data)
+        self.build_critics(args,
+                           lambda: Q(state_dim, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, self.is_discrete),
+                           lambda K: EnsembleQ(state_dim, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, self.is_discrete, K))
+        self.Q_optimizer_list = [Adam(Q_net.parameters(), lr=args.learning_rate) for Q_net in self.Q_net_list]
+        self.target_updater = SoftUpdater(self.Q_target_net_list, self.Q_net_list, self.tau, getattr(args, 'target_update_every', 1))
 
         self.policy_type = args.policy_type
         if self.policy_type == "Gaussian":
@@ -204,12 +221,18 @@ class SAC:
             self.policy_net = DeterministicPolicy(state_dim, action_space.shape[0], args.hidden_size, action_space).to(self.device)
         self.policy_optimizer = Adam(self.policy_net.parameters(), lr=args.learning_rate)
 
+        # compile = True runs the policy sampling and both losses through torch.compile, eager otherwise
+        self.COMPILE = getattr(args, 'compile', False)
+        self.sample_fn = CompiledFn(self.policy_net.sample, self.COMPILE)
+        self.critic_loss_fn = CompiledFn(self.critic_loss, self.COMPILE)
+        self.actor_loss_fn = CompiledFn(self.actor_loss, self.COMPILE)
+
     def select_action(self, state, evaluate=False,ref=None):
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
         if evaluate is False:
-            action, _, _ = self.policy_net.sample(state)
+            action, _, _ = self.sample_fn(state)
         else:
-            _, _, action = self.policy_net.sample(state)
+            _, _, action = self.sample_fn(state)
         return action.detach().cpu()[0]
 
     def evaluate(self, state):
@@ -231,42 +254,57 @@ class SAC:
             log_prob = dist.log_prob(x_t) - log_det
             return action, log_prob, mu, log_std, torch.tanh(mu)
 
-    def update(self, batch_size, Info=None):
-        x, y, u, r, d, ref = self.replay_buffer.sample(batch_size)
-        state_batch = torch.FloatTensor(x).to(self.device)
-        action_batch = torch.LongTensor(u).to(self.device) if self.is_discrete else torch.FloatTensor(u).to(self.device).reshape(-1, self.action_dim)
-        next_state_batch = torch.FloatTensor(y).to(self.device)
-        reward_batch = torch.FloatTensor(r).reshape(-1, 1).to(self.device)
-        undone_batch = torch.FloatTensor(d).reshape(-1, 1).to(self.device)
-        done_batch = torch.FloatTensor(1 - np.array(d)).reshape(-1, 1).to(self.device)
+    def critic(self, s, a, target=False):
+        # Q values of all critics stacked as [K, B, 1]
+        Q_net_list = self.Q_target_net_list if target else self.Q_net_list
+        if self.Q_ENSEMBLE:
+            return Q_net_list[0](s, a)
+        return torch.stack([Q_net(s, a) for Q_net in Q_net_list])
 
+    def critic_loss(self, state_batch, action_batch, reward_batch, done_batch, next_state_batch, alpha, weight_batch=None):
+        # per critic TD loss [K] and the absolute TD error [B, 1] averaged over the critics
         with torch.no_grad():
             next_action, next_log_pi, _= self.policy_net.sample(next_state_batch)
-            q1_next = self.Q_target_net1(next_state_batch, next_action)
-            q2_next = self.Q_target_net2(next_state_batch, next_action)
-            # next_log_pi = next_log_pi.sum(dim=1, keepdim=True)
-            min_q_next = torch.min(q1_next, q2_next) - self.alpha * next_log_pi.reshape(-1, 1)
+            q_next = self.critic(next_state_batch, next_action, target=True)
+            min_q_next = ensemble_min(q_next, self.q_min_subset) - alpha * next_log_pi.reshape(-1, 1)
             next_q_value  = reward_batch + done_batch * self.gamma * min_q_next
-            
 
-        qf1 = self.Q_net1(state_batch, action_batch)
-        qf2 = self.Q_net2(state_batch, action_batch)
-        
-        q1_loss = F.mse_loss(qf1, next_q_value)
-        q2_loss = F.mse_loss(qf2, next_q_value)
+        td = self.critic(state_batch, action_batch) - next_q_value
+        if weight_batch is None:
+            q_loss = td.pow(2).mean(dim=(1, 2))
+        else:
+            # importance-sampling weighted critic loss
+            q_loss = (weight_batch * td.pow(2)).mean(dim=(1, 2))
+        return q_loss, td.abs().mean(0).detach()
+
+    def actor_loss(self, state_batch, alpha):
+        pi, log_prob, _ = self.policy_net.sample(state_batch)
+        min_q_pi = self.critic(state_batch, pi).min(0)[0]
+        return (alpha * log_prob - min_q_pi).mean(), log_prob
+
+    def update_batch(self, batch, weight_batch=None, sampleIdx=None):
+        # one gradient step on a minibatch already on the device, PER weights and indices come with it
+        x, y, u, r, d, ref = batch
+        state_batch = x
+        action_batch = u.long() if self.is_discrete else u.reshape(-1, self.action_dim)
+        next_state_batch = y
+        reward_batch = r.reshape(-1, 1)
+        undone_batch = d.reshape(-1, 1)
+        done_batch = (1 - d).reshape(-1, 1)
+
+        q_loss, self.td_error = self.critic_loss_fn(state_batch, action_batch, reward_batch, done_batch, next_state_batch, self.alpha, weight_batch)
+        if self.PRIORITIZED:
+            # new priorities from the TD errors
+            self.replay_buffer.updatePriorities(sampleIdx, self.td_error.cpu().numpy())
+        q1_loss, q2_loss = q_loss[0], q_loss[1]
         
-        self.Q1_optimizer.zero_grad()
-        self.Q2_optimizer.zero_grad()
-        (q1_loss+q2_loss).backward()   
-        self.Q1_optimizer.step()
-        self.Q2_optimizer.step()
+        for Q_optimizer in self.Q_optimizer_list:
+            Q_optimizer.zero_grad()
+        q_loss.sum().backward()
+        for Q_optimizer in self.Q_optimizer_list:
+            Q_optimizer.step()
         
-        pi, log_prob, _ = self.policy_net.sample(state_batch)
-        q1_pi   = self.Q_net1(state_batch, pi)
-        q2_pi   = self.Q_net2(state_batch, pi)
-
-        min_q_pi = torch.min(q1_pi, q2_pi)
-        policy_loss = (self.alpha * log_prob - min_q_pi).mean()
+        policy_loss, log_prob = self.actor_loss_fn(state_batch, self.alpha)
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
         self.policy_optimizer.step()
@@ -278,20 +316,16 @@ class SAC:
             self.alpha_optim.step()
             self.alpha = self.log_alpha.exp()
 
-        for target_param, param in zip(self.Q_target_net1.parameters(), self.Q_net1.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        return q1_loss.item(), q2_loss.item(), policy_loss.item(), alpha_loss.item(), self.alpha.item()
+        self.target_updater()
+        self.loss_meter.add(Q1=q1_loss, Q2=q2_loss, Policy=policy_loss, Alpha=self.alpha)
+        if self.automatic_entropy_tuning:
+            self.loss_meter.add(Alpha_loss=alpha_loss)
     
     
     def save(self, modelPath):
         import os
         torch.save(self.policy_net.state_dict(), os.path.join(modelPath, 'policy_net.pth'))
-        torch.save(self.Q_net1.state_dict(), os.path.join(modelPath, 'Q_net1.pth'))
-        torch.save(self.Q_net2.state_dict(), os.path.join(modelPath, 'Q_net2.pth'))
-        torch.save(self.Q_target_net1.state_dict(), os.path.join(modelPath, 'Q_target_net1.pth'))
-        torch.save(self.Q_target_net2.state_dict(), os.path.join(modelPath, 'Q_target_net2.pth'))
+        self.save_critics(modelPath)
         #torch.save(self.critic_target.state_dict(), os.path.join(savePath, 'critic_target.pth'))
         print("====================================")
         print("Model has been saved...")
@@ -299,7 +333,4 @@ class SAC:
     def load(self, modelPath):
         import os
         self.policy_net.load_state_dict(torch.load(os.path.join(modelPath, 'policy_net.pth')))
-        self.Q_net1.load_state_dict(torch.load(os.path.join(modelPath, 'Q_net1.pth')))
-        self.Q_net2.load_state_dict(torch.load(os.path.join(modelPath, 'Q_net2.pth')))
-        self.Q_target_net1.load_state_dict(torch.load(os.path.join(modelPath, 'Q_target_net1.pth')))
-        self.Q_target_net2.load_state_dict(torch.load(os.path.join(modelPath, 'Q_target_net2.pth')))
+        self.load_critics(modelPath)
@@ -7,6 +7,10 @@ from torch.distributions import Normal, Categorical
 import numpy as np
 from torch.optim import Adam
 from operator import itemgetter
+from .lib.TargetUpdate import SoftUpdater
+from .lib.LossMeter import LossMeter
+from .lib.Compile import CompiledFn
+from .lib.AgentBase import PolicyActions, LossMetrics
 
 class Replay_buffer():
     def __init__(self, max_size=10000):
@@ -215,10 +219,11 @@ class Q(nn.Module):
         return x[:,0], x[:,1]
     
 
-class SAC1:
+class SAC1(PolicyActions, LossMetrics):
     def __init__(self, state_dim, action_space, ScalingDict, device, args):
         self.gamma = args.gamma
         self.tau = args.tau
+        self.loss_meter = LossMeter()
         self.device = device
         self.alpha = torch.FloatTensor([args.alpha]).to(device)
         self.state_dim = state_dim
@@ -245,6 +250,7 @@ class SAC1:
             target_param.data.copy_(param.data)
         for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
             target_param.data.copy_(param.data)
+        self.target_updater = SoftUpdater([self.Q_target_net1, self.Q_target_net2], [self.Q_net1, self.Q_net2], self.tau, getattr(args, 'target_update_every', 1))
 
         self.policy_type = args.policy_type
         if self.policy_type == "Gaussian":
@@ -258,12 +264,18 @@ class SAC1:
             self.policy_net = DeterministicPolicy(state_dim, action_space.shape[0], args.hidden_size, action_space).to(self.device)
         self.policy_optimizer = Adam(self.policy_net.parameters(), lr=args.learning_rate)
 
+        # compile = True runs the policy sampling and both losses through torch.compile, eager otherwise
+        self.COMPILE = getattr(args, 'compile', False)
+        self.sample_fn = CompiledFn(self.policy_net.sample, self.COMPILE)
+        self.critic_loss_fn = CompiledFn(self.critic_loss, self.COMPILE)
+        self.actor_loss_fn = CompiledFn(self.actor_loss, self.COMPILE)
+
     def select_action(self, state, evaluate=False,ref=None):
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
         if evaluate is False:
-            action, _, _ = self.policy_net.sample(state)
+            action, _, _ = self.sample_fn(state)
         else:
-            _, _, action = self.policy_net.sample(state)
+            _, _, action = self.sample_fn(state)
         return action.detach().cpu()[0]
 
     def evaluate(self, state):
@@ -285,25 +297,15 @@ class SAC1:
             log_prob = dist.log_prob(x_t) - log_det
             return action, log_prob, mu, log_std, torch.tanh(mu)
 
-    def update(self, batch_size, Info=None):
-        x, y, u, r, d, xN, rN = self.replay_buffer.sample(batch_size)
-        state_batch = torch.FloatTensor(x).to(self.device)
-        action_batch = torch.LongTensor(u).to(self.device) if self.is_discrete else torch.FloatTensor(u).to(self.device).reshape(-1, self.action_dim)
-        next_state_batch = torch.FloatTensor(y).to(self.device)
-        reward_batch = torch.FloatTensor(r).reshape(-1, 1).to(self.device)
-        undone_batch = torch.FloatTensor(d).reshape(-1, 1).to(self.device)
-        done_batch = torch.FloatTensor(1 - np.array(d)).reshape(-1, 1).to(self.device)
-        
-        terminal_state_batch = torch.FloatTensor(xN).reshape(-1, 2).to(self.device)
-        rN_batch = torch.FloatTensor(rN).reshape(-1, 1).to(self.device)
+    def critic_loss(self, state_batch, action_batch, reward_batch, done_batch, next_state_batch, terminal_state_batch, rN_batch, alpha):
+        # TD losses of both critics and the losses of their terminal reward heads
         with torch.no_grad():
             next_action, next_log_pi, _= self.policy_net.sample(next_state_batch)
             q1_next, RN1 = self.Q_target_net1(next_state_batch, next_action, terminal_state_batch)
             q2_next, RN2 = self.Q_target_net2(next_state_batch, next_action, terminal_state_batch)
             # next_log_pi = next_log_pi.sum(dim=1, keepdim=True)
-            min_q_next = torch.min(q1_next, q2_next) - self.alpha * next_log_pi.reshape(-1, 1)
+            min_q_next = torch.min(q1_next, q2_next) - alpha * next_log_pi.reshape(-1, 1)
             next_q_value  = reward_batch + done_batch * self.gamma * min_q_next
-            
 
         qf1, RN1  = self.Q_net1(state_batch, action_batch, terminal_state_batch)
         qf2, RN2 = self.Q_net2(state_batch, action_batch, terminal_state_batch)
@@ -313,7 +315,28 @@ class SAC1:
         
         RN1_loss = F.mse_loss(RN1, rN_batch)
         RN2_loss = F.mse_loss(RN2, rN_batch)
+        return q1_loss, q2_loss, RN1_loss, RN2_loss
+
+    def actor_loss(self, state_batch, terminal_state_batch, alpha):
+        pi, log_prob, _ = self.policy_net.sample(state_batch)
+        q1_pi, _ = self.Q_net1(state_batch, pi, terminal_state_batch)
+        q2_pi, _ = self.Q_net2(state_batch, pi, terminal_state_batch)
+
+        min_q_pi = torch.min(q1_pi, q2_pi)
+        return (alpha * log_prob - min_q_pi).mean(), log_prob
+
+    def update(self, batch_size, Info=None):
+        x, y, u, r, d, xN, rN = self.replay_buffer.sample(batch_size)
+        state_batch = torch.FloatTensor(x).to(self.device)
+        action_batch = torch.LongTensor(u).to(self.device) if self.is_discrete else torch.FloatTensor(u).to(self.device).reshape(-1, self.action_dim)
+        next_state_batch = torch.FloatTensor(y).to(self.device)
+        reward_batch = torch.FloatTensor(r).reshape(-1, 1).to(self.device)
+        undone_batch = torch.FloatTensor(d).reshape(-1, 1).to(self.device)
+        done_batch = torch.FloatTensor(1 - np.array(d)).reshape(-1, 1).to(self.device)
         
+        terminal_state_batch = torch.FloatTensor(xN).reshape(-1, 2).to(self.device)
+        rN_batch = torch.FloatTensor(rN).reshape(-1, 1).to(self.device)
+        q1_loss, q2_loss, RN1_loss, RN2_loss = self.critic_loss_fn(state_batch, action_batch, reward_batch, done_batch, next_state_batch, terminal_state_batch, rN_batch, self.alpha)
         
         self.Q1_optimizer.zero_grad()
         self.Q2_optimizer.zero_grad()
@@ -321,12 +344,7 @@ class SAC1:
         self.Q1_optimizer.step()
         self.Q2_optimizer.step()
         
-        pi, log_prob, _ = self.policy_net.sample(state_batch)
-        q1_pi, RN1   = self.Q_net1(state_batch, pi, terminal_state_batch)
-        q2_pi, RN2   = self.Q_net2(state_batch, pi, terminal_state_batch)
-
-        min_q_pi = torch.min(q1_pi, q2_pi)
-        policy_loss = (self.alpha * log_prob - min_q_pi).mean()
+        policy_loss, log_prob = self.actor_loss_fn(state_batch, terminal_state_batch, self.alpha)
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
         self.policy_optimizer.step()
@@ -338,11 +356,10 @@ class SAC1:
             self.alpha_optim.step()
             self.alpha = self.log_alpha.exp()
 
-        for target_param, param in zip(self.Q_target_net1.parameters(), self.Q_net1.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        return q1_loss.item(), q2_loss.item(), policy_loss.item(), alpha_loss.item(), self.alpha.item()
+        self.target_updater()
+        self.loss_meter.add(Q1=q1_loss, Q2=q2_loss, Policy=policy_loss, Alpha=self.alpha)
+        if self.automatic_entropy_tuning:
+            self.loss_meter.add(Alpha_loss=alpha_loss)
     
     
     def save(self, modelPath):
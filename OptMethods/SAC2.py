@@ -1,4 +1,5 @@
 
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,7 +7,12 @@ import torch.optim as optim
 from torch.distributions import Normal, Categorical
 import numpy as np
 from torch.optim import Adam
-from .lib.ReplayBuffer import Replay_buffer
+from .lib.ReplayBuffer import build_replay_buffer
+from .lib.TargetUpdate import SoftUpdater
+from .lib.LossMeter import LossMeter
+from .lib.Compile import CompiledFn
+from .lib.AgentBase import PolicyActions, BatchUpdates, TwinCritics
+from .lib.NeuroModel import EnsembleLinear, EnsembleMLP, ensemble_min
 
 LOG_SIG_MAX = 2
 LOG_SIG_MIN = -20
@@ -35,8 +41,15 @@ class RefEncoder(nn.Module):
         return x
 
     
-def extract_encoder_backbone(refencoder, modelPath):
-    refencoder.load_state_dict(torch.load(modelPath)) 
+def extract_encoder_backbone(refencoder, modelPath, mmap=False):
+    if mmap:
+        try:
+            # weights stay memory-mapped from the checkpoint instead of being copied (torch >= 2.1)
+            refencoder.load_state_dict(torch.load(modelPath, map_location='cpu', mmap=True), assign=True)
+        except TypeError:
+            mmap = False
+    if not mmap:
+        refencoder.load_state_dict(torch.load(modelPath)) 
     backbone = nn.Sequential(
     refencoder.fc1,
     nn.ReLU(),
@@ -47,6 +60,68 @@ def extract_encoder_backbone(refencoder, modelPath):
 )
     return backbone
 
+# frozen ref encoder backbones by (checkpoint path, device), shared read-only by every critic
+REF_ENCODER_REGISTRY = {}
+
+def load_ref_encoder(modelPath="ref_enc.pth", device='cpu', mmap=False):
+    key = (os.path.abspath(modelPath), str(device))
+    if key not in REF_ENCODER_REGISTRY:
+        backbone = extract_encoder_backbone(RefEncoder(4, 4, 256), modelPath, mmap).to(device)
+        backbone.requires_grad_(False)
+        REF_ENCODER_REGISTRY[key] = backbone.eval()
+    return REF_ENCODER_REGISTRY[key]
+
+# columns [k, A, B, w] of an LQT observation, the input of every ref encoder
+REF_COLS = slice(4, 8)
+
+class RefFeatureCache():
+    # features of a frozen ref encoder for the encoder input [k, A, B, w]. Only (A, B, w) is constant within
+    # an episode, so every reference gets a table of its features for all steps k < numK, encoded once when
+    # add() sees the reference on the host. SAC2 adds the references of its training episodes in
+    # select_action; rows of any other reference (evaluation-only or loaded agents, replaced slots) miss and
+    # only those rows are encoded directly. The oldest reference is replaced first, so maxSize should cover
+    # the episodes in the buffer
+    def __init__(self, encoder, maxSize=4096, numK=51, device='cpu'):
+        self.encoder = encoder
+        self.maxSize = maxSize
+        self.numK = numK
+        self.device = device
+        # nan keys never match an empty slot
+        self.keys = torch.full((maxSize, 3), float('nan'), device=device)
+        self.table = torch.zeros((maxSize, numK, 256), device=device)
+        self.slotKeys = [None]*maxSize
+        self.slots = {}
+        self.next = 0
+
+    @torch.no_grad()
+    def add(self, para):
+        # para: (A, B, w) of the running episode, host side
+        key = tuple(float(p) for p in para)
+        if key in self.slots:
+            return
+        slot = self.next
+        if self.slotKeys[slot] is not None:
+            del self.slots[self.slotKeys[slot]]
+        keyTensor = torch.tensor(key, dtype=torch.float32, device=self.device)
+        kArr = torch.arange(self.numK, dtype=torch.float32, device=self.device)
+        self.table[slot] = self.encoder(torch.column_stack((kArr, keyTensor.expand(self.numK, 3))))
+        self.keys[slot] = keyTensor
+        self.slotKeys[slot] = key
+        self.slots[key] = slot
+        self.next = (slot + 1) % self.maxSize
+
+    @torch.no_grad()
+    def __call__(self, ref):
+        # ref: encoder input [B, 4] = [k, A, B, w]
+        k = ref[:,0].round().long().clamp(0, self.numK-1)
+        hit, slot = (ref[:,None,1:4] == self.keys[None]).all(-1).max(1)
+        feat = self.table[slot, k]
+        # a miss gives slot 0, its rows are encoded instead
+        idxMiss = torch.nonzero(~hit).reshape(-1)
+        if idxMiss.numel() > 0:
+            feat[idxMiss] = self.encoder(ref[idxMiss])
+        return feat
+
 '''========================================================='''
 
 
@@ -55,8 +130,8 @@ class GaussianPolicy(nn.Module):
         super(GaussianPolicy, self).__init__()
         '''========================================================='''
         ref_dim = 4
+        # trained from the xavier init below, the pretrained weights are only used through load_ref_encoder
         self.ref_encoder = RefEncoder(4, 4, 256)
-        self.ref_encoder.load_state_dict(torch.load("ref_enc.pth"))
         '''========================================================='''
         self.linear1 = nn.Linear(num_inputs-ref_dim, hidden_dim)
         self.linear2 = nn.Linear(hidden_dim, hidden_dim)
@@ -77,7 +152,7 @@ class GaussianPolicy(nn.Module):
                 (action_space.high + action_space.low) / 2.)
 
     def forward(self, state):
-        ref = state[:,4:]
+        ref = state[:,REF_COLS]
         ref = self.ref_encoder.fc1(ref)
         ref = F.relu(ref)
         ref = self.ref_encoder.fc2(ref)
@@ -157,12 +232,14 @@ class DeterministicPolicy(nn.Module):
         return super(DeterministicPolicy, self).to(device)
 
 class Q(nn.Module):
-    def __init__(self, state_dim, action_dim, xMean, xStd, hidden_dim=512, dp_dim=4):
+    def __init__(self, state_dim, action_dim, xMean, xStd, hidden_dim=512, dp_dim=4, own_encoder=True):
         super(Q, self).__init__()
         '''========================================================='''
         ref_dim = 4
-        self.ref_encoder = RefEncoder(4, 4, 256)
-        self.ref_encoder.load_state_dict(torch.load("ref_enc.pth"))
+        # own_encoder = False: ref features always come from the shared encoder of load_ref_encoder,
+        # otherwise the critic trains its own from the xavier init below
+        if own_encoder:
+            self.ref_encoder = RefEncoder(4, 4, 256)
         '''========================================================='''
         
         self.fc1 = nn.Linear(state_dim- ref_dim + action_dim, hidden_dim)
@@ -176,14 +253,18 @@ class Q(nn.Module):
         self.xstd = xStd
         self.apply(weights_init_)
 
-    def forward(self, s, a):
-        ref = s[:,4:]
-        ref = self.ref_encoder.fc1(ref)
-        ref = F.relu(ref)
-        ref = self.ref_encoder.fc2(ref)
-        ref = F.relu(ref)
-        ref = self.ref_encoder.fc3(ref)
-        ref = F.relu(ref)
+    def forward(self, s, a, ref_feature=None):
+        # ref_feature: encoded s[:,REF_COLS] from a RefFeatureCache, computed here if not given
+        if ref_feature is None:
+            ref = s[:,REF_COLS]
+            ref = self.ref_encoder.fc1(ref)
+            ref = F.relu(ref)
+            ref = self.ref_encoder.fc2(ref)
+            ref = F.relu(ref)
+            ref = self.ref_encoder.fc3(ref)
+            ref = F.relu(ref)
+        else:
+            ref = ref_feature
         
         x = torch.cat((s, a), -1)
         x = (x - self.xmean) / self.xstd
@@ -193,18 +274,50 @@ class Q(nn.Module):
         
         x = self.fc3(x)
         return x
-    
-class SAC2:
+
+class EnsembleQ(nn.Module):
+    # K critics of the Q architecture above in one module, forward returns [K, B, 1]
+    # the ensemble encoder (fc1..fc3 of RefEncoder(4, 4, 256) per member) starts from xavier weights like Q's
+    def __init__(self, state_dim, action_dim, xMean, xStd, hidden_dim=512, K=2, own_encoder=True):
+        super(EnsembleQ, self).__init__()
+        ref_dim = 4
+        if own_encoder:
+            self.ref_encoder = EnsembleMLP(K, [ref_dim, 256, 256, 256], last_relu=True)
+        self.fc1 = EnsembleLinear(K, state_dim - ref_dim + action_dim, hidden_dim)
+        self.fc2 = EnsembleLinear(K, hidden_dim, hidden_dim)
+        self.fc3 = EnsembleLinear(K, hidden_dim+256, 1)
+        self.K = K
+        self.state_dim = state_dim
+        self.action_dim = action_dim
+        self.xmean = xMean
+        self.xstd = xStd
+
+    def forward(self, s, a, ref_feature=None):
+        # a ref_feature [B, 256] from a RefFeatureCache is shared by all members
+        if ref_feature is None:
+            ref = self.ref_encoder(s[:,REF_COLS])
+        else:
+            ref = ref_feature.expand(self.K, -1, -1)
+        x = torch.cat((s, a), -1)
+        x = (x - self.xmean) / self.xstd
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        x = torch.cat((x, ref), dim=-1)
+        return self.fc3(x)
+
+class SAC2(PolicyActions, BatchUpdates, TwinCritics):
     def __init__(self, state_dim, action_space, ScalingDict, device, args):
         self.gamma = args.gamma
         self.tau = args.tau
+        self.loss_meter = LossMeter()
         self.device = device
         self.alpha = torch.FloatTensor([args.alpha]).to(device)
         self.state_dim = state_dim
         self.action_dim = action_space.shape[0]
         self.is_discrete = args.is_discrete
         self.automatic_entropy_tuning = args.automatic_entropy_tuning   
-        self.replay_buffer = Replay_buffer()
+        self.replay_buffer = build_replay_buffer(args, device)
+        self.PRIORITIZED = getattr(self.replay_buffer, 'PRIORITIZED', False)
         self.num_buffer = args.num_buffer
         if args.ShortTerm_Buffer:
             self.ShortTerm_Buffer = True
@@ -220,20 +333,24 @@ class SAC2:
         xmean = ScalingDict.get('xMean', torch.zeros(state_dim)).to(device)
         xstd = ScalingDict.get('xStd', torch.ones(state_dim)).to(device)
 
-        self.Q_net1 = Q(state_dim_Q, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer).to(device)
-        self.Q_net2 = Q(state_dim_Q, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer).to(device)
-        self.Q_net_list = [self.Q_net1, self.Q_net2]
-        self.Q_target_net1 = Q(state_dim_Q, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer).to(device)
-        self.Q_target_net2 = Q(state_dim_Q, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer).to(device)
-        self.Q_target_net_list = [self.Q_target_net1, self.Q_target_net2]
-
-        self.Q1_optimizer = Adam(self.Q_net1.parameters(), lr=args.learning_rate)
-        self.Q2_optimizer = Adam(self.Q_net2.parameters(), lr=args.learning_rate)
-
-        for target_param, param in zip(self.Q_target_net1.parameters(), self.Q_net1.parameters()):
-            target_param.data.copy_(param.data)
-        for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
-            target_param.data.copy_(param.data)
+        # ref_shared: all critics read their ref features from one frozen pretrained encoder, loaded once
+        # from ref_enc_path, instead of training an encoder each. ref_cache_size > 0 implies it and
+        # caches the features of that many references (A, B, w) for every step k <= horizon
+        ref_cache_size = getattr(args, 'ref_cache_size', 0)
+        self.REF_SHARED = getattr(args, 'ref_shared', False) or ref_cache_size > 0
+        self.ref_backbone = None
+        self.ref_cache = None
+        if self.REF_SHARED:
+            self.ref_backbone = load_ref_encoder(getattr(args, 'ref_enc_path', "ref_enc.pth"), device, getattr(args, 'ref_mmap', False))
+            if ref_cache_size > 0:
+                self.ref_cache = RefFeatureCache(self.ref_backbone, ref_cache_size, getattr(args, 'horizon', 50)+1, device)
+        own_encoder = not self.REF_SHARED
+
+        self.build_critics(args,
+                           lambda: Q(state_dim_Q, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, own_encoder=own_encoder),
+                           lambda K: EnsembleQ(state_dim_Q, self.action_dim, xumean, xustd, args.num_hidden_units_per_layer, K, own_encoder))
+        self.Q_optimizer_list = [Adam(Q_net.parameters(), lr=args.learning_rate) for Q_net in self.Q_net_list]
+        self.target_updater = SoftUpdater(self.Q_target_net_list, self.Q_net_list, self.tau, getattr(args, 'target_update_every', 1))
 
         self.policy_type = args.policy_type
         if self.policy_type == "Gaussian":
@@ -247,12 +364,21 @@ class SAC2:
             self.policy_net = DeterministicPolicy(state_dim, action_space.shape[0], args.hidden_size, action_space).to(self.device)
         self.policy_optimizer = Adam(self.policy_net.parameters(), lr=args.learning_rate)
 
+        # compile = True runs the policy sampling and both losses through torch.compile, eager otherwise
+        self.COMPILE = getattr(args, 'compile', False)
+        self.sample_fn = CompiledFn(self.policy_net.sample, self.COMPILE)
+        self.critic_loss_fn = CompiledFn(self.critic_loss, self.COMPILE)
+        self.actor_loss_fn = CompiledFn(self.actor_loss, self.COMPILE)
+
     def select_action(self, state, evaluate=False,ref=None):
+        if self.ref_cache is not None and not evaluate:
+            # a new training episode registers its reference (A, B, w) before its transitions reach the buffer
+            self.ref_cache.add(state[REF_COLS][1:])
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
         if evaluate is False:
-            action, _, _ = self.policy_net.sample(state)
+            action, _, _ = self.sample_fn(state)
         else:
-            _, _, action = self.policy_net.sample(state)
+            _, _, action = self.sample_fn(state)
         return action.detach().cpu()[0]
 
     def evaluate(self, state):
@@ -274,47 +400,70 @@ class SAC2:
             log_prob = dist.log_prob(x_t) - log_det
             return action, log_prob, mu, log_std, torch.tanh(mu)
 
-    def update(self, batch_size, Info=None):
-        x, y, u, r, d, ref = self.replay_buffer.sample(batch_size)
-        state_batch = torch.FloatTensor(x).to(self.device)
-        action_batch = torch.LongTensor(u).to(self.device)
-        next_state_batch = torch.FloatTensor(y).to(self.device)
-        reward_batch = torch.FloatTensor(r).reshape(-1, 1).to(self.device)
-        undone_batch = torch.FloatTensor(d).reshape(-1, 1).to(self.device)
-        done_batch = torch.FloatTensor(1 - np.array(d)).reshape(-1, 1).to(self.device)
-        if self.ShortTerm_Buffer:
-            reff = torch.FloatTensor(ref[:,1:]).to(self.device).reshape(-1, self.num_buffer*4-4)
-            ref_next_batch = torch.cat((reff, state_batch[:,:4]), dim=1)
-            ref_batch = torch.FloatTensor(ref).to(self.device).reshape(-1, self.num_buffer*4)
-            state_batch_ref = torch.cat((state_batch, ref_batch), dim=1)
-            next_state_batch_ref = torch.cat((next_state_batch, ref_next_batch), dim=1)
-        
+    def critic(self, s, a, target=False):
+        # Q values of all critics stacked as [K, B, 1]
+        Q_net_list = self.Q_target_net_list if target else self.Q_net_list
+        ref_feature = None
+        if self.ref_cache is not None:
+            ref_feature = self.ref_cache(s[:,REF_COLS])
+        elif self.ref_backbone is not None:
+            with torch.no_grad():
+                ref_feature = self.ref_backbone(s[:,REF_COLS])
+        if self.Q_ENSEMBLE:
+            return Q_net_list[0](s, a, ref_feature)
+        return torch.stack([Q_net(s, a, ref_feature) for Q_net in Q_net_list])
+
+    def critic_loss(self, state_batch_ref, action_batch, reward_batch, done_batch, next_state_batch, next_state_batch_ref, alpha, weight_batch=None):
+        # per critic TD loss [K] and the absolute TD error [B, 1] averaged over the critics
         with torch.no_grad():
             next_action, next_log_pi, _= self.policy_net.sample(next_state_batch)
-            q1_next = self.Q_target_net1(next_state_batch_ref, next_action)
-            q2_next = self.Q_target_net2(next_state_batch_ref, next_action)
-            min_q_next = torch.min(q1_next, q2_next) - self.alpha * next_log_pi.reshape(-1, 1)
+            q_next = self.critic(next_state_batch_ref, next_action, target=True)
+            min_q_next = ensemble_min(q_next, self.q_min_subset) - alpha * next_log_pi.reshape(-1, 1)
             next_q_value  = reward_batch + done_batch * self.gamma * min_q_next
-            
 
-        qf1 = self.Q_net1(state_batch_ref, action_batch)
-        qf2 = self.Q_net2(state_batch_ref, action_batch)
+        td = self.critic(state_batch_ref, action_batch) - next_q_value
+        if weight_batch is None:
+            q_loss = td.pow(2).mean(dim=(1, 2))
+        else:
+            # importance-sampling weighted critic loss
+            q_loss = (weight_batch * td.pow(2)).mean(dim=(1, 2))
+        return q_loss, td.abs().mean(0).detach()
+
+    def actor_loss(self, state_batch, state_batch_ref, alpha):
+        pi, log_prob, _ = self.policy_net.sample(state_batch)
+        min_q_pi = self.critic(state_batch_ref, pi).min(0)[0]
+        return (alpha * log_prob - min_q_pi).mean(), log_prob
+
+    def update_batch(self, batch, weight_batch=None, sampleIdx=None):
+        # one gradient step on a minibatch already on the device, PER weights and indices come with it
+        x, y, u, r, d, ref = batch
+        state_batch = x
+        action_batch = u.long() if self.is_discrete else u.reshape(-1, self.action_dim)
+        next_state_batch = y
+        reward_batch = r.reshape(-1, 1)
+        undone_batch = d.reshape(-1, 1)
+        done_batch = (1 - d).reshape(-1, 1)
+        if self.ShortTerm_Buffer:
+            reff = ref[:,1:].reshape(-1, self.num_buffer*4-4)
+            ref_next_batch = torch.cat((reff, state_batch[:,:4]), dim=1)
+            ref_batch = ref.reshape(-1, self.num_buffer*4)
+            state_batch_ref = torch.cat((state_batch, ref_batch), dim=1)
+            next_state_batch_ref = torch.cat((next_state_batch, ref_next_batch), dim=1)
         
-        q1_loss = F.mse_loss(qf1, next_q_value)
-        q2_loss = F.mse_loss(qf2, next_q_value)
+        q_loss, self.td_error = self.critic_loss_fn(state_batch_ref, action_batch, reward_batch, done_batch,
+                                                    next_state_batch, next_state_batch_ref, self.alpha, weight_batch)
+        if self.PRIORITIZED:
+            # new priorities from the TD errors
+            self.replay_buffer.updatePriorities(sampleIdx, self.td_error.cpu().numpy())
+        q1_loss, q2_loss = q_loss[0], q_loss[1]
         
-        self.Q1_optimizer.zero_grad()
-        self.Q2_optimizer.zero_grad()
-        (q1_loss+q2_loss).backward()   
-        self.Q1_optimizer.step()
-        self.Q2_optimizer.step()
+        for Q_optimizer in self.Q_optimizer_list:
+            Q_optimizer.zero_grad()
+        q_loss.sum().backward()
+        for Q_optimizer in self.Q_optimizer_list:
+            Q_optimizer.step()
         
-        pi, log_prob, _ = self.policy_net.sample(state_batch)
-        q1_pi  = self.Q_net1(state_batch_ref, pi)
-        q2_pi  = self.Q_net2(state_batch_ref, pi)
-
-        min_q_pi = torch.min(q1_pi, q2_pi)
-        policy_loss = (self.alpha * log_prob - min_q_pi).mean()
+        policy_loss, log_prob = self.actor_loss_fn(state_batch, state_batch_ref, self.alpha)
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
         self.policy_optimizer.step()
@@ -326,20 +475,16 @@ class SAC2:
             self.alpha_optim.step()
             self.alpha = self.log_alpha.exp()
 
-        for target_param, param in zip(self.Q_target_net1.parameters(), self.Q_net1.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        for target_param, param in zip(self.Q_target_net2.parameters(), self.Q_net2.parameters()):
-            target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-        return q1_loss.item(), q2_loss.item(), policy_loss.item(), alpha_loss.item(), self.alpha.item()
+        self.target_updater()
+        self.loss_meter.add(Q1=q1_loss, Q2=q2_loss, Policy=policy_loss, Alpha=self.alpha)
+        if self.automatic_entropy_tuning:
+            self.loss_meter.add(Alpha_loss=alpha_loss)
     
     
     def save(self, modelPath):
         import os
         torch.save(self.policy_net.state_dict(), os.path.join(modelPath, 'policy_net.pth'))
-        torch.save(self.Q_net1.state_dict(), os.path.join(modelPath, 'Q_net1.pth'))
-        torch.save(self.Q_net2.state_dict(), os.path.join(modelPath, 'Q_net2.pth'))
-        torch.save(self.Q_target_net1.state_dict(), os.path.join(modelPath, 'Q_target_net1.pth'))
-        torch.save(self.Q_target_net2.state_dict(), os.path.join(modelPath, 'Q_target_net2.pth'))
+        self.save_critics(modelPath)
         #torch.save(self.critic_target.state_dict(), os.path.join(savePath, 'critic_target.pth'))
         print("====================================")
         print("Model has been saved...")
@@ -347,8 +492,5 @@ class SAC2:
     def load(self, modelPath):
         import os
         self.policy_net.load_state_dict(torch.load(os.path.join(modelPath, 'policy_net.pth')))
-        self.Q_net1.load_state_dict(torch.load(os.path.join(modelPath, 'Q_net1.pth')))
-        self.Q_net2.load_state_dict(torch.load(os.path.join(modelPath, 'Q_net2.pth')))
-        self.Q_target_net1.load_state_dict(torch.load(os.path.join(modelPath, 'Q_target_net1.pth')))
-        self.Q_target_net2.load_state_dict(torch.load(os.path.join(modelPath, 'Q_target_net2.pth')))
+        self.load_critics(modelPath)
         
\ No newline at end of file
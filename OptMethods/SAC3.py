@@ -8,6 +8,10 @@ import numpy as np
 from torch.optim import Adam
 
 from operator import itemgetter
+from .lib.TargetUpdate import SoftUpdater
+from .lib.LossMeter import LossMeter
+from .lib.Compile import CompiledFn
+from .lib.AgentBase import PolicyActions, LossMetrics
 import torch
 # import replay buffer
 # from .lib import ReplayBuffer
@@ -214,10 +218,11 @@ class Q(nn.Module):
         x = F.relu(self.fc2(x))
         return self.fc3(x)
     
-class SAC3:
+class SAC3(PolicyActions, LossMetrics):
     def __init__(self, state_dim, action_space, ScalingDict, device, args):
         self.gamma = args.gamma
         self.tau = args.tau
+        self.loss_meter = LossMeter()
         self.device = device
         self.alpha = torch.FloatTensor([args.alpha]).to(device)
         self.state_dim = state_dim
@@ -247,6 +252,7 @@ class SAC3:
         for target_Q_net, Q_net in zip(self.Q_target_net_list, self.Q_net_list):
             for target_param, param in zip(target_Q_net.parameters(), Q_net.parameters()):
                 target_param.data.copy_(param.data)
+        self.target_updater = SoftUpdater(self.Q_target_net_list, self.Q_net_list, self.tau, getattr(args, 'target_update_every', 1))
         self.policy_type = args.policy_type
         if self.policy_type == "Gaussian":
             if self.automatic_entropy_tuning is True:
@@ -258,12 +264,18 @@ class SAC3:
             self.policy_net = DeterministicPolicy(state_dim, action_space.shape[0], args.hidden_size, action_space).to(self.device)
         self.policy_optimizer = Adam(self.policy_net.parameters(), lr=args.learning_rate)
 
+        # compile = True runs the policy sampling and both losses through torch.compile, eager otherwise
+        self.COMPILE = getattr(args, 'compile', False)
+        self.sample_fn = CompiledFn(self.policy_net.sample, self.COMPILE)
+        self.critic_loss_fn = CompiledFn(self.critic_loss, self.COMPILE)
+        self.actor_loss_fn = CompiledFn(self.actor_loss, self.COMPILE)
+
     def select_action(self, state, evaluate=False, ref=None):
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
         if evaluate is False:
-            action, _, _ = self.policy_net.sample(state)
+            action, _, _ = self.sample_fn(state)
         else:
-            _, _, action = self.policy_net.sample(state)
+            _, _, action = self.sample_fn(state)
         return action.detach().cpu()[0]
 
     def evaluate(self, state):
@@ -284,9 +296,25 @@ class SAC3:
             log_det = log_det.sum(dim=-1, keepdim=True)
             log_prob = dist.log_prob(x_t) - log_det
             return action, log_prob, mu, log_std, torch.tanh(mu)
+
+    def critic_loss(self, i, state_batch, action_batch, reward_batch, undone_batch, next_state_batch, alpha):
+        # TD loss of critic i, its target bootstraps from the same critic
+        with torch.no_grad():
+            next_action, next_log_pi, _= self.policy_net.sample(next_state_batch)
+            q_next = self.Q_net_list[i](next_state_batch, next_action) - alpha * next_log_pi.reshape(-1, 1)
+            next_q_value = (reward_batch + undone_batch* self.gamma* q_next)
+            
+        qf = self.Q_net_list[i](state_batch, action_batch)
+        return F.mse_loss(qf, next_q_value)
+
+    def actor_loss(self, i, state_batch, alpha):
+        pi, log_prob, _ = self.policy_net.sample(state_batch)
+        q_pi = self.Q_net_list[i](state_batch, pi)
+        q_target_pi = self.Q_target_net_list[i](state_batch, pi)
+        min_q_pi = torch.min(q_pi, q_target_pi)
+        return (alpha * log_prob - min_q_pi).mean(), log_prob
         
     def update(self, batch_size, Info=None):
-        Q_loss_list = []
         for i in range(self.num_Q):
             x, y, u, r, d, ref = self.replay_buffer_list[i].sample(batch_size)
             state_batch = torch.FloatTensor(x).to(self.device)
@@ -295,22 +323,12 @@ class SAC3:
             done_batch = torch.FloatTensor(d).reshape(-1, 1).to(self.device)    
             undone_batch = torch.FloatTensor(1 - np.array(d)).reshape(-1, 1).to(self.device)
             reward_batch = torch.FloatTensor(r).reshape(-1, 1).to(self.device)  
-            with torch.no_grad():
-                next_action, next_log_pi, _= self.policy_net.sample(next_state_batch)
-                q_next = self.Q_net_list[i](next_state_batch, next_action) - self.alpha * next_log_pi.reshape(-1, 1)
-                next_q_value = (reward_batch + undone_batch* self.gamma* q_next)
-                
-            qf = self.Q_net_list[i](state_batch, action_batch)
-            q_loss = F.mse_loss(qf, next_q_value)
+            q_loss = self.critic_loss_fn(i, state_batch, action_batch, reward_batch, undone_batch, next_state_batch, self.alpha)
             self.Q_optimizer[i].zero_grad()
             (q_loss).backward()
             self.Q_optimizer[i].step()
-            Q_loss_list.append(q_loss.item())
-            pi, log_prob, _ = self.policy_net.sample(state_batch)
-            q_pi = self.Q_net_list[i](state_batch, pi)
-            q_target_pi = self.Q_target_net_list[i](state_batch, pi)
-            min_q_pi = torch.min(q_pi, q_target_pi)
-            policy_loss = (self.alpha * log_prob - min_q_pi).mean()
+            self.loss_meter.add(**{'Q{}'.format(i+1): q_loss})
+            policy_loss, log_prob = self.actor_loss_fn(i, state_batch, self.alpha)
             self.policy_optimizer.zero_grad()
             policy_loss.backward()
             self.policy_optimizer.step()
@@ -321,11 +339,10 @@ class SAC3:
                 self.alpha_optim.step()
                 self.alpha = self.log_alpha.exp()
                 
-        for target_Q_net, Q_net in zip(self.Q_target_net_list, self.Q_net_list):    
-            for target_param, param in zip(target_Q_net.parameters(), Q_net.parameters()):
-                target_param.data.copy_(target_param * (1 - self.tau) + param * self.tau)
-            
-        return Q_loss_list,policy_loss.item(),alpha_loss.item(),self.alpha.item()
+        self.target_updater()
+        self.loss_meter.add(Policy=policy_loss, Alpha=self.alpha)
+        if self.automatic_entropy_tuning is True:
+            self.loss_meter.add(Alpha_loss=alpha_loss)
             
         
     def save(self, modelPath):
@@ -1,5 +1,8 @@
-from .DPbackward import DPbackward
+from .DPbackward import DPbackward, DPbackwardBatch
 from .DPforward import DPforward
+from .DPcache import DPcache
+from .LQTRiccati import LQTRiccati
+from .OptimalEval import LinearRiccati, NonLinearILQR, evaluatePolicy, verifyBaseline
 from .SAC import SAC
 from .SAC_ref import SAC as SAC_REF
 from .SAC1 import SAC1
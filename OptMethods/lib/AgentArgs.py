@@ -0,0 +1,20 @@
+def add_common_args(parser):
+    # agent options shared by the mainRunRL scripts. The agents read them with getattr and these
+    # defaults, so an agent built without them behaves the same
+    parser.add_argument('--buffer_type', default='list', type=str) # replay buffer storage: list, array, device, ref (dp is interned per episode) or prioritized
+    parser.add_argument('--per_alpha', default=0.6, type=float) # prioritized replay exponent
+    parser.add_argument('--per_beta', default=0.4, type=float) # initial importance-sampling exponent, annealed to 1
+    parser.add_argument('--q_ensemble', default=0, type=int) # number of fused critics, 0 keeps the two separate Q nets
+    parser.add_argument('--q_min_subset', default=0, type=int) # critics drawn for the target min, 0 uses all (REDQ if < q_ensemble)
+    parser.add_argument('--target_update_every', default=1, type=int) # soft target update on every N-th gradient step
+    parser.add_argument('--loss_log_interval', default=50, type=int) # write the mean losses to TensorBoard every N updates
+    parser.add_argument('--compile', default=False, type=bool) # torch.compile the policy sampling and SAC losses, eager fallback
+    return parser
+
+def add_ref_encoder_args(parser):
+    # SAC2 only: where the critics get their reference features from
+    parser.add_argument('--ref_shared', default=False, type=bool) # critics share one frozen pretrained ref encoder instead of training their own
+    parser.add_argument('--ref_cache_size', default=0, type=int) # cache the shared encoder's features for this many references (implies ref_shared)
+    parser.add_argument('--ref_enc_path', default='ref_enc.pth', type=str) # pretrained RefEncoder checkpoint
+    parser.add_argument('--ref_mmap', default=False, type=bool) # memory-map the ref encoder weights (torch >= 2.1)
+    return parser
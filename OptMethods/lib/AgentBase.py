@@ -0,0 +1,77 @@
+import os
+import torch
+from .ReplayBuffer import to_tensor_batch
+
+class PolicyActions():
+    # batched action selection shared by the SAC agents. The agent provides policy_net, device and
+    # state_dim; sample_fn (the compiled policy_net.sample) is used when the agent builds one
+    def select_action_batch(self, states, evaluate=False):
+        # select_action for a batch of states [B, state_dim] in one policy forward, returns actions [B, action_dim]
+        states = torch.as_tensor(states, dtype=torch.float32, device=self.device).reshape(-1, self.state_dim)
+        sample = getattr(self, 'sample_fn', self.policy_net.sample)
+        with torch.no_grad():
+            action, _, mean_action = sample(states)
+        return (mean_action if evaluate else action).cpu()
+
+class LossMetrics():
+    # metrics() for the agents that collect their update losses in self.loss_meter (a LossMeter)
+    def metrics(self):
+        # mean losses since the last call, the only place the update losses are synchronized
+        return self.loss_meter.metrics()
+
+class BatchUpdates(LossMetrics):
+    # update() and update_many() for the agents that implement update_batch(batch, weight_batch, sampleIdx)
+    # on a minibatch already on the device. The agent provides replay_buffer, device and PRIORITIZED
+    def update(self, batch_size, Info=None):
+        self.update_many(1, batch_size, Info)
+
+    def update_many(self, n, batch_size, Info=None):
+        # n gradient steps from a single draw of n*batch_size transitions: one gather and one copy
+        # to the device, the minibatches are slices of it
+        batch = to_tensor_batch(self.replay_buffer.sample(n*batch_size), self.device)
+        weight = sampleIdx = None
+        if self.PRIORITIZED:
+            weight = torch.as_tensor(self.replay_buffer.sampleWeight, device=self.device).reshape(-1, 1)
+            sampleIdx = self.replay_buffer.sampleIdx
+        for i in range(n):
+            sl = slice(i*batch_size, (i+1)*batch_size)
+            self.update_batch(tuple(b[sl] for b in batch),
+                              None if weight is None else weight[sl], None if sampleIdx is None else sampleIdx[sl])
+
+class TwinCritics():
+    # critics, their targets and their checkpoints for the SAC agents. build_critics sets Q_net_list and
+    # Q_target_net_list, save_critics/load_critics pick the checkpoint files from the critic type
+    def build_critics(self, args, makeQ, makeEnsembleQ):
+        # makeQ() builds one Q net, makeEnsembleQ(K) one EnsembleQ of K critics, both on the agent's device.
+        # q_ensemble = K >= 2 fuses K critics into one EnsembleQ, 0 keeps the two separate Q nets
+        self.Q_ENSEMBLE = getattr(args, 'q_ensemble', 0) >= 2
+        self.q_min_subset = getattr(args, 'q_min_subset', 0)
+        if self.Q_ENSEMBLE:
+            self.Q_net = makeEnsembleQ(args.q_ensemble).to(self.device)
+            self.Q_target_net = makeEnsembleQ(args.q_ensemble).to(self.device)
+            self.Q_net_list = [self.Q_net]
+            self.Q_target_net_list = [self.Q_target_net]
+        else:
+            self.Q_net1 = makeQ().to(self.device)
+            self.Q_net2 = makeQ().to(self.device)
+            self.Q_target_net1 = makeQ().to(self.device)
+            self.Q_target_net2 = makeQ().to(self.device)
+            self.Q_net_list = [self.Q_net1, self.Q_net2]
+            self.Q_target_net_list = [self.Q_target_net1, self.Q_target_net2]
+
+        for target_Q_net, Q_net in zip(self.Q_target_net_list, self.Q_net_list):
+            target_Q_net.load_state_dict(Q_net.state_dict())
+
+    def critic_files(self):
+        # {attribute: checkpoint file} of every critic
+        if self.Q_ENSEMBLE:
+            return {'Q_net': 'Q_net_ensemble.pth', 'Q_target_net': 'Q_target_net_ensemble.pth'}
+        return {name: name + '.pth' for name in ['Q_net1', 'Q_net2', 'Q_target_net1', 'Q_target_net2']}
+
+    def save_critics(self, modelPath):
+        for name, fileName in self.critic_files().items():
+            torch.save(getattr(self, name).state_dict(), os.path.join(modelPath, fileName))
+
+    def load_critics(self, modelPath):
+        for name, fileName in self.critic_files().items():
+            getattr(self, name).load_state_dict(torch.load(os.path.join(modelPath, fileName)))
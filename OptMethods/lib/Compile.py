@@ -0,0 +1,42 @@
+import warnings
+import torch
+
+def compileErrors():
+    # exceptions raised by dynamo tracing and the compiler backends (BackendCompilerFailed, Unsupported,
+    # inductor errors), anything else comes from fn itself
+    errors = []
+    try:
+        from torch._dynamo.exc import TorchDynamoException
+        errors.append(TorchDynamoException)
+    except ImportError:
+        pass
+    try:
+        from torch._inductor.exc import InductorError
+        errors.append(InductorError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+class CompiledFn():
+    # fn run through torch.compile when enabled, with a fallback to the eager fn if torch.compile is
+    # missing (torch < 2.0) or fails to compile; the fallback is reported once. Errors raised by fn
+    # itself (shape errors, NaN asserts) are raised as in eager mode. fn must not have side effects
+    # (no optimizer steps or buffer updates) so that a failed compiled call can simply be repeated eagerly.
+    def __init__(self, fn, enabled=True, **kwargs):
+        self.fn = fn
+        self.compiled = None
+        self.errors = compileErrors()
+        if enabled:
+            if hasattr(torch, 'compile'):
+                self.compiled = torch.compile(fn, **kwargs)
+            else:
+                warnings.warn('torch.compile is not available in torch {}, running eagerly'.format(torch.__version__))
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except self.errors as e:
+                warnings.warn('compiling {} failed, running eagerly: {}'.format(getattr(self.fn, '__name__', self.fn), e))
+                self.compiled = None
+        return self.fn(*args, **kwargs)
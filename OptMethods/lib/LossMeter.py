@@ -0,0 +1,29 @@
+import torch
+
+class LossMeter():
+    # running sums of detached loss tensors kept on the device, update() never waits for the GPU
+    # and metrics() reduces everything and moves it to the host with a single transfer
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, **losses):
+        for name, value in losses.items():
+            value = value.detach().reshape(())
+            if name in self.sums:
+                self.sums[name].add_(value)
+                self.counts[name] += 1
+            else:
+                self.sums[name] = value.float().clone()
+                self.counts[name] = 1
+
+    def metrics(self):
+        # mean of every loss since the last call as {name: float}, then starts over
+        if not self.sums:
+            return {}
+        names = list(self.sums)
+        values = torch.stack([self.sums[name] for name in names]).tolist()
+        MetricDict = {name: value/self.counts[name] for name, value in zip(names, values)}
+        self.sums = {}
+        self.counts = {}
+        return MetricDict
@@ -37,3 +37,52 @@ class ThreeLayerMLP(nn.Module):
             x = self.yMax * torch.tanh(x)
         
         return x
+
+
+class EnsembleLinear(nn.Module):
+    # K independent linear layers stored as stacked [K, in, out] weights and evaluated with one batched matmul
+    def __init__(self, K, in_dim, out_dim):
+        super(EnsembleLinear, self).__init__()
+        self.K = K
+        self.in_dim = in_dim
+        self.out_dim = out_dim
+        self.weight = nn.Parameter(torch.empty(K, in_dim, out_dim))
+        self.bias = nn.Parameter(torch.zeros(K, 1, out_dim))
+        # same as xavier_uniform_ on every member, fan_in + fan_out does not depend on the layout
+        bound = (6 / (in_dim + out_dim))**0.5
+        nn.init.uniform_(self.weight, -bound, bound)
+
+    def forward(self, x):
+        # x: [B, in] shared by all members or [K, B, in], returns [K, B, out]
+        if x.dim() == 2:
+            return torch.baddbmm(self.bias, x.unsqueeze(0).expand(self.K, -1, -1), self.weight)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+    def load_members(self, linearList):
+        # copy the weights of K nn.Linear layers into the stacked parameters
+        with torch.no_grad():
+            for k, linear in enumerate(linearList):
+                self.weight[k].copy_(linear.weight.t())
+                self.bias[k, 0].copy_(linear.bias)
+
+
+class EnsembleMLP(nn.Module):
+    # K MLPs with ReLU between layers, dimList = [in, hidden, ..., out]
+    def __init__(self, K, dimList, last_relu=False):
+        super(EnsembleMLP, self).__init__()
+        self.layers = nn.ModuleList([EnsembleLinear(K, dimList[i], dimList[i+1]) for i in range(len(dimList)-1)])
+        self.last_relu = last_relu
+
+    def forward(self, x):
+        for i, layer in enumerate(self.layers):
+            x = layer(x)
+            if i < len(self.layers)-1 or self.last_relu:
+                x = F.relu(x)
+        return x
+
+
+def ensemble_min(q, num_subset=0):
+    # min over the critic axis of q [K, B, 1], over a random subset of num_subset critics if given (REDQ)
+    if num_subset and num_subset < q.shape[0]:
+        q = q[torch.randperm(q.shape[0], device=q.device)[:num_subset]]
+    return q.min(0)[0]
@@ -53,3 +53,297 @@ class Replay_buffer():
         refBatch = np.array(batch[5])
 
         return (observationBatch, observationNextBatch, actionBatch, rewardBatch, doneBatch, refBatch)
+    
+    def __len__(self):
+        return len(self.storage)
+
+
+def _toNumpy(x):
+    # transitions are pushed as a mix of torch tensors, numpy arrays and python scalars
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+class Array_buffer():
+    # same interface as Replay_buffer, but each field of the transition tuple is kept
+    # in its own preallocated float32 array [max_size, *field_shape], sized on the first push
+    def __init__(self, max_size=10000):
+        self.columns = None
+        self.max_size = max_size
+        self.ptr = 0
+        self.size = 0
+        self.IS_NUMPY = True
+
+    def __len__(self):
+        return self.size
+
+    def allocate(self, data):
+        self.columns = [np.empty((self.max_size,)+np.shape(_toNumpy(field)), dtype=np.float32) for field in data]
+        self.IS_NUMPY = isinstance(data[0], np.ndarray)
+
+    def push(self, data):
+        if self.columns is None:
+            self.allocate(data)
+        for column, field in zip(self.columns, data):
+            column[self.ptr] = _toNumpy(field)
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+    def gather(self, ind):
+        return [column[ind] for column in self.columns]
+
+    def sample(self, batch_size):
+        ind = np.random.randint(0, self.size, size=batch_size)
+        return tuple(self.gather(ind))
+
+    def getEpisodeBatch(self, steps):
+
+        if self.size == 0:
+            return
+
+        # last steps+1 transitions in push order, wrapping around the ring when full
+        idxList = (self.ptr + np.arange(-steps-1, 0)) % self.size
+        batch = self.gather(idxList)
+        if not self.IS_NUMPY:
+            batch[2] = batch[2].flatten()
+            batch[3] = batch[3].flatten()
+
+        return tuple(batch)
+
+
+class Ref_buffer(Array_buffer):
+    # Array_buffer whose last field is the episode reference (e.g. Env.dp). The reference is interned
+    # once per episode in refTable, each transition only keeps an integer episode id, and the ref
+    # column is materialized at sample time
+    def __init__(self, max_size=10000):
+        super(Ref_buffer, self).__init__(max_size)
+        self.episodeId = np.full(max_size, -1, dtype=np.int64)
+        self.refTable = {}
+        self.refCount = {}
+        self.nEpisode = 0
+
+    def intern(self, ref):
+        # keep a float32 copy, callers are free to modify their array in place afterwards
+        ref = _toNumpy(ref).astype(np.float32)
+        lastId = self.nEpisode-1
+        if lastId in self.refTable and np.array_equal(self.refTable[lastId], ref):
+            return lastId
+        self.refTable[self.nEpisode] = ref
+        self.refCount[self.nEpisode] = 0
+        self.nEpisode += 1
+        return self.nEpisode-1
+
+    def push(self, data):
+        epId = self.intern(data[-1])
+        self.refCount[epId] += 1
+        # release the reference of the transition we are about to overwrite
+        oldId = self.episodeId[self.ptr]
+        if oldId >= 0:
+            self.refCount[oldId] -= 1
+            if self.refCount[oldId] == 0:
+                del self.refTable[oldId]
+                del self.refCount[oldId]
+        self.episodeId[self.ptr] = epId
+        super(Ref_buffer, self).push(data[:-1])
+
+    def gather(self, ind):
+        uniqueId, inverse = np.unique(self.episodeId[ind], return_inverse=True)
+        ref = np.stack([self.refTable[i] for i in uniqueId])[inverse]
+        return super(Ref_buffer, self).gather(ind) + [ref]
+
+    def getMemoryInfo(self):
+        # bytes held by the buffer vs. a dense per-transition ref column
+        columnBytes = sum(column.nbytes for column in self.columns) if self.columns is not None else 0
+        tableBytes = sum(ref.nbytes for ref in self.refTable.values())
+        refBytes = next(iter(self.refTable.values())).nbytes if self.refTable else 0
+        denseBytes = refBytes*self.size
+        internBytes = tableBytes + self.episodeId.nbytes
+        return {'columns': columnBytes,
+                'refTable': tableBytes,
+                'episodeId': self.episodeId.nbytes,
+                'refDense': denseBytes,
+                'nEpisode': len(self.refTable),
+                'saving': denseBytes/internBytes if internBytes > 0 else 1.0,
+                }
+
+
+class SumTree():
+    # array-based sum-tree, node i has children 2i and 2i+1, leaves live at [capacity, 2*capacity)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tree = np.zeros(2*capacity, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, ind, priority):
+        node = np.asarray(ind, dtype=np.int64) + self.capacity
+        self.tree[node] = priority
+        # recompute parents from their children, so repeated indices in one batch are fine
+        node = np.unique(node//2)
+        node = node[node >= 1]
+        while node.size > 0:
+            self.tree[node] = self.tree[2*node] + self.tree[2*node+1]
+            node = np.unique(node//2)
+            node = node[node >= 1]
+
+    def find(self, value):
+        # descend all values of the batch together, O(log n) per value
+        value = np.array(value, dtype=np.float64)
+        node = np.ones(value.shape, dtype=np.int64)
+        inner = node < self.capacity
+        while np.any(inner):
+            left = 2*node[inner]
+            goLeft = value[inner] <= self.tree[left]
+            value[inner] = np.where(goLeft, value[inner], value[inner]-self.tree[left])
+            node[inner] = np.where(goLeft, left, left+1)
+            inner = node < self.capacity
+        return node - self.capacity, self.tree[node]
+
+
+class Prioritized_buffer(Array_buffer):
+    # proportional prioritized replay (Schaul et al.) on top of the columnar storage.
+    # sample() keeps the Replay_buffer return value; the sampled indices and importance weights
+    # are left in sampleIdx/sampleWeight for the agent, which reports back with updatePriorities()
+    PRIORITIZED = True
+
+    def __init__(self, max_size=10000, alpha=0.6, beta=0.4, beta_increment=1e-4, eps=1e-6):
+        super(Prioritized_buffer, self).__init__(max_size)
+        self.tree = SumTree(max_size)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.maxPriority = 1.0
+        self.sampleIdx = None
+        self.sampleWeight = None
+
+    def push(self, data):
+        # new transitions get the largest priority seen so far so they are replayed at least once
+        self.tree.update([self.ptr], self.maxPriority**self.alpha)
+        super(Prioritized_buffer, self).push(data)
+
+    def sample(self, batch_size):
+        # stratified: one draw from each of batch_size equal slices of the total priority
+        total = self.tree.total()
+        value = (np.arange(batch_size) + np.random.uniform(size=batch_size))*total/batch_size
+        # kept below the total so that rounding in the descent cannot end in an empty leaf
+        ind, _ = self.tree.find(np.minimum(value, total*(1-1e-9)))
+        ind = np.minimum(ind, self.size-1)
+        # read back after the clamp so that weight and index belong to the same leaf
+        priority = self.tree.tree[ind + self.tree.capacity]
+
+        prob = np.maximum(priority, 1e-12)/total
+        weight = (self.size*prob)**(-self.beta)
+        self.sampleIdx = ind
+        self.sampleWeight = (weight/weight.max()).astype(np.float32)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return tuple(self.gather(ind))
+
+    def updatePriorities(self, ind, tdError):
+        priority = np.abs(np.asarray(tdError, dtype=np.float64)).reshape(-1) + self.eps
+        self.tree.update(ind, priority**self.alpha)
+        self.maxPriority = max(self.maxPriority, priority.max())
+
+
+class Device_buffer():
+    # same interface as Replay_buffer, but the columns live as torch tensors on the agent's device
+    # and sample() returns ready-to-use float32 tensors. On CUDA, pushes are collected in a pinned
+    # host staging block and moved to the device in one non-blocking copy per stage_size transitions.
+    def __init__(self, max_size=10000, device='cpu', stage_size=256):
+        self.columns = None
+        self.max_size = max_size
+        self.device = torch.device(device)
+        self.ptr = 0
+        self.size = 0
+        self.IS_NUMPY = True
+        self.PINNED = self.device.type == 'cuda'
+        self.stage_size = min(stage_size, max_size)
+        self.stage = None
+        self.nStaged = 0
+        self.stageEvent = None
+
+    def __len__(self):
+        return self.size
+
+    def allocate(self, data):
+        shapes = [tuple(np.shape(_toNumpy(field))) for field in data]
+        self.columns = [torch.empty((self.max_size,)+shape, dtype=torch.float32, device=self.device) for shape in shapes]
+        if self.PINNED:
+            self.stage = [torch.empty((self.stage_size,)+shape, dtype=torch.float32).pin_memory() for shape in shapes]
+        self.IS_NUMPY = isinstance(data[0], np.ndarray)
+
+    def push(self, data):
+        if self.columns is None:
+            self.allocate(data)
+        if self.PINNED:
+            # the previous flush may still be reading from the staging block
+            if self.stageEvent is not None:
+                self.stageEvent.synchronize()
+                self.stageEvent = None
+            for stage, field in zip(self.stage, data):
+                stage[self.nStaged] = torch.as_tensor(_toNumpy(field), dtype=torch.float32)
+            self.nStaged += 1
+        else:
+            for column, field in zip(self.columns, data):
+                column[self.ptr] = torch.as_tensor(_toNumpy(field), dtype=torch.float32)
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+        if self.nStaged == self.stage_size:
+            self.flush()
+
+    def flush(self):
+        if self.nStaged == 0:
+            return
+        # staged transitions occupy the ring slots right before ptr
+        idx = torch.arange(self.ptr - self.nStaged, self.ptr) % self.max_size
+        idx = idx.to(self.device, non_blocking=True)
+        for column, stage in zip(self.columns, self.stage):
+            column.index_copy_(0, idx, stage[:self.nStaged].to(self.device, non_blocking=True))
+        self.stageEvent = torch.cuda.Event()
+        self.stageEvent.record()
+        self.nStaged = 0
+
+    def sample(self, batch_size):
+        self.flush()
+        ind = torch.randint(0, self.size, (batch_size,), device=self.device)
+        return tuple(column[ind] for column in self.columns)
+
+    def getEpisodeBatch(self, steps):
+
+        if self.size == 0:
+            return
+        self.flush()
+
+        idxList = torch.as_tensor((self.ptr + np.arange(-steps-1, 0)) % self.size, device=self.device)
+        batch = [column[idxList].cpu().numpy() for column in self.columns]
+        if not self.IS_NUMPY:
+            batch[2] = batch[2].flatten()
+            batch[3] = batch[3].flatten()
+
+        return tuple(batch)
+
+
+def to_tensor_batch(batch, device):
+    # numpy batches from Replay_buffer/Array_buffer are copied to the device, Device_buffer batches pass through
+    return tuple(torch.as_tensor(b, dtype=torch.float32, device=device) for b in batch)
+
+
+def build_replay_buffer(args=None, device='cpu', max_size=10000):
+    # args.buffer_type selects the storage: 'list' (default) keeps python tuples, 'array' is columnar,
+    # 'device' keeps the columns on the agent's device, 'ref' interns the per-episode reference,
+    # 'prioritized' samples proportionally to the TD error
+    bufferType = getattr(args, 'buffer_type', 'list')
+    if bufferType == 'list':
+        return Replay_buffer(max_size)
+    elif bufferType == 'array':
+        return Array_buffer(max_size)
+    elif bufferType == 'ref':
+        return Ref_buffer(max_size)
+    elif bufferType == 'prioritized':
+        return Prioritized_buffer(max_size, alpha=getattr(args, 'per_alpha', 0.6), beta=getattr(args, 'per_beta', 0.4))
+    elif bufferType == 'device':
+        return Device_buffer(max_size, device)
+    else:
+        raise ValueError('unknown buffer_type {}'.format(bufferType))
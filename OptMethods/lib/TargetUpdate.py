@@ -0,0 +1,28 @@
+import torch
+
+class SoftUpdater():
+    # Polyak averaging target <- (1 - tau) * target + tau * online over all parameters of the
+    # given net pairs, done in place with the multi-tensor foreach kernels instead of a Python
+    # loop with two temporaries per tensor. With every = N the average is applied on every
+    # N-th call only, tau is used as given.
+    def __init__(self, target_net_list, net_list, tau, every=1):
+        self.target_params = [p.data for target_net in target_net_list for p in target_net.parameters()]
+        self.params = [p.data for net in net_list for p in net.parameters()]
+        self.tau = tau
+        self.every = max(1, int(every))
+        self.count = 0
+
+    def hard(self):
+        # copy the online weights into the targets
+        with torch.no_grad():
+            for target_param, param in zip(self.target_params, self.params):
+                target_param.copy_(param)
+
+    def __call__(self):
+        self.count += 1
+        if self.count % self.every:
+            return False
+        with torch.no_grad():
+            torch._foreach_mul_(self.target_params, 1 - self.tau)
+            torch._foreach_add_(self.target_params, self.params, alpha=self.tau)
+        return True
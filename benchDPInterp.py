@@ -0,0 +1,89 @@
+import argparse
+import contextlib
+import io
+import time
+import numpy as np
+import torch
+from Env.SimpleSpeed import SimpleSpeed, speedModel, speedActionCost, speedDistanceCost, speedTerminalCost
+from OptMethods.DPbackward import DPbackward
+
+# Convergence benchmark of DPbackward value lookup: solve time vs. cost error of nearest-grid rounding
+# and bilinear interpolation on one fixed SimpleSpeed segment. The error is measured by replaying the
+# optimal actions on the true dynamics from (d0, v0), against a bilinear solve on the finest grid.
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', type=str, default='/mnt/d/RL/traindata.mat')
+parser.add_argument('--veh_id', type=str, default=None)
+parser.add_argument('--t_beg', type=float, default=None)
+parser.add_argument('--t_horizon', type=float, default=15)
+parser.add_argument('--a_res', type=float, default=0.1)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+# (dRes, vRes) from coarse to fine, the last one is the reference
+GRIDS = [(4, 0.8), (2, 0.4), (1, 0.2), (0.5, 0.1), (0.25, 0.05)]
+
+class DPSegment():
+    # SimpleSpeed seen through the interface DPbackward expects: amin/amax and a vectorized
+    # getReward(state, action, k) returning the positive stage cost, terminal cost at k == N.
+    # DPbackward passes k with every call, the dynamics do not depend on it
+    def __init__(self, Env):
+        self.Env = Env
+        self.amin = Env.umin
+        self.amax = Env.umax
+
+    def __getattr__(self, name):
+        return getattr(self.Env, name)
+
+    def getNextState(self, state, action):
+        return self.Env.getNextState(state, action)
+
+    def getReward(self, state, action, k):
+        Env = self.Env
+        model = speedModel(Env)
+        state = state.reshape(-1, 2)
+        a = action.reshape(-1)
+        d = state[:,0]
+        v = state[:,1]
+        if k == Env.N:
+            cost = speedTerminalCost(model, d, v, Env.dp[k], Env.vp[k])
+        else:
+            cost = speedActionCost(model, v, a) + speedDistanceCost(model, d, Env.dp[k])
+        return cost*0.01, None, None
+
+def rolloutCost(Seg, aOpt):
+    state = torch.FloatTensor([Seg.d0, Seg.v0])
+    total = 0
+    for k in range(Seg.N+1):
+        action = torch.FloatTensor([aOpt[k]])
+        cost,_,_ = Seg.getReward(state, action, k=k)
+        total += cost.item()
+        state = Seg.getNextState(state, action)[0]
+    return total
+
+def solve(Seg, dRes, vRes, lookup):
+    tStart = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        DP = DPbackward(Seg, dRes=dRes, vRes=vRes, aRes=args.a_res, SELECT_LOOKUP=lookup)
+        DP.runOpt()
+        _, _, _, aOpt, _, _, _, _ = DP.retrieveOptValue()
+    return time.time()-tStart, rolloutCost(Seg, aOpt)
+
+if __name__ == '__main__':
+    np.random.seed(args.seed)
+    options = {'tHorizon': args.t_horizon}
+    if args.veh_id is not None:
+        options['selectPrecedingId'] = args.veh_id
+    if args.t_beg is not None:
+        options['tBeg'] = args.t_beg
+    Env = SimpleSpeed(args.data_path, options=options)
+    Seg = DPSegment(Env)
+    print('segment vehId {} tBeg {} N {} d0 {:.2f} v0 {:.2f}'.format(Env.vehId, Env.tBeg, Env.N, Env.d0, Env.v0))
+
+    tRef, costRef = solve(Seg, *GRIDS[-1], 'bilinear')
+    print('reference dRes {} vRes {} bilinear: cost {:.4f} in {:.1f}s'.format(*GRIDS[-1], costRef, tRef))
+
+    print('{:>6s} {:>6s} {:>9s} {:>9s} {:>10s} {:>10s}'.format('dRes', 'vRes', 'lookup', 'time[s]', 'cost', 'error[%]'))
+    for dRes, vRes in GRIDS[:-1]:
+        for lookup in ['nearest', 'bilinear']:
+            tSolve, cost = solve(Seg, dRes, vRes, lookup)
+            print('{:6.2f} {:6.2f} {:>9s} {:9.2f} {:10.4f} {:10.3f}'.format(dRes, vRes, lookup, tSolve, cost, (cost-costRef)/abs(costRef)*100))
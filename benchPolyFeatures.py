@@ -0,0 +1,96 @@
+import argparse
+import timeit
+import numpy as np
+import torch
+from Env.SimpleSpeed import LagrangeBasis, polyFeatures
+
+# Micro-benchmark of the SimpleSpeed polynomial features: the per-interval np.polymul Lagrange
+# construction and per-column observation loop they replaced, against the batched versions.
+# Uses a synthetic preceding-vehicle trajectory so no traffic data is needed.
+parser = argparse.ArgumentParser()
+parser.add_argument('--horizon', default=15, type=float) # seconds
+parser.add_argument('--batch', default=256, type=int) # rows per state2Observation call
+parser.add_argument('--repeat', default=200, type=int)
+args = parser.parse_args()
+
+dt = 0.1
+tIntDur = 5
+n = 3
+tauList = np.array([-1.0, -0.4472135954999579, 0.4472135954999579, 1.0])
+
+def legacyLagrangeCoeff(n, x, y):
+    L = [1]*(n+1)
+    Lbasis = [1]*(n+1)
+    for k in range(0, n+1):
+        for kk in range(0, k):
+            L[k] = np.polymul(L[k],[1/(x[k]-x[kk]), - x[kk]/(x[k]-x[kk])])
+        for kk in range(k+1, n+1):
+            L[k] = np.polymul(L[k],[1/(x[k]-x[kk]), - x[kk]/(x[k]-x[kk])])
+        Lbasis[k] = L[k]
+        L[k] = y[k]*L[k]
+    L = np.sum(np.array(L), axis=0)
+    return L, Lbasis
+
+def legacyReset(t, dp, tIntBeg, tIntEnd):
+    fArr = [np.nan]*len(tIntBeg)
+    for i, _ in enumerate(tIntBeg):
+        tList = ((1-tauList)*tIntBeg[i] + (1+tauList)*tIntEnd[i])/2
+        dpVal = np.interp(tList, t, dp)
+        L, _ = legacyLagrangeCoeff(n, tList, dpVal)
+        fArr[i] = np.flip(L)
+    return fArr
+
+def batchedReset(t, dp, tIntBeg, tIntEnd, basis=None):
+    tList, invV = LagrangeBasis(tIntBeg, tIntEnd, tauList) if basis is None else basis
+    dpVal = np.interp(tList, t, dp)
+    return np.matmul(invV, dpVal[:,:,None])[:,:,0]
+
+def legacyObservation(fArr, state, k):
+    nIntvl = len(fArr)
+    observation = torch.empty(state.shape[0], 3+nIntvl*(n+1))
+    observation[:,0] = state[:,0]
+    observation[:,1] = state[:,1]
+    observation[:,2] = k
+    for i in range(nIntvl):
+        for j in range(n):
+            observation[:,3+i*(n+1)+j] = fArr[i][n-j]*np.power(dt*(k+1), n-j)
+        observation[:,3+i*(n+1)+n] = observation[:,3+i*(n+1)+n-1] + fArr[i][0]
+    return observation
+
+def batchedObservation(fArr, state, k):
+    return torch.column_stack((state[:,0], state[:,1], k.float(), polyFeatures(fArr, k, dt)))
+
+if __name__ == '__main__':
+    t = np.arange(0, args.horizon+dt/2, dt) + dt
+    vp = np.clip(10 + np.cumsum(np.random.normal(0, 0.3, t.size)), 0, 25)
+    dp = 50 + np.cumsum(vp)*dt
+    tIntBeg = np.arange(t[0], t[-1]-1, tIntDur)
+    tIntEnd = np.arange(t[0]+tIntDur, t[-1]+1, tIntDur)
+    basis = LagrangeBasis(tIntBeg, tIntEnd, tauList)
+
+    fOld = np.array(legacyReset(t, dp, tIntBeg, tIntEnd))
+    fNew = batchedReset(t, dp, tIntBeg, tIntEnd, basis)
+    print('coefficients max abs diff {:.3e}'.format(np.max(np.abs(fOld-fNew))))
+
+    N = t.size-1
+    fTensor = torch.FloatTensor(fNew)
+    for B in [1, args.batch]:
+        state = torch.rand(B, 2)*torch.FloatTensor([80., 25.])
+        k = torch.randint(0, N, (B,)).int()
+        diff = (legacyObservation(fNew, state, k)-batchedObservation(fTensor, state, k)).abs().max().item()
+        print('observation B={} max abs diff {:.3e}'.format(B, diff))
+
+    def report(name, old, new):
+        tOld = timeit.timeit(old, number=args.repeat)/args.repeat*1e6
+        tNew = timeit.timeit(new, number=args.repeat)/args.repeat*1e6
+        print('{:<28s} old {:9.1f} us  new {:9.1f} us  speedup {:5.1f}x'.format(name, tOld, tNew, tOld/tNew))
+
+    report('reset (coefficients)', lambda: legacyReset(t, dp, tIntBeg, tIntEnd),
+                                   lambda: batchedReset(t, dp, tIntBeg, tIntEnd, basis))
+    report('reset (uncached basis)', lambda: legacyReset(t, dp, tIntBeg, tIntEnd),
+                                     lambda: batchedReset(t, dp, tIntBeg, tIntEnd))
+    for B in [1, args.batch]:
+        state = torch.rand(B, 2)*torch.FloatTensor([80., 25.])
+        k = torch.randint(0, N, (B,)).int()
+        report('step obs B={}'.format(B), lambda: legacyObservation(fNew, state, k),
+                                          lambda: batchedObservation(fTensor, state, k))
@@ -0,0 +1,57 @@
+import argparse
+import time
+from types import SimpleNamespace
+import numpy as np
+import torch
+from OptMethods.SAC import SAC
+
+# Throughput benchmark of SAC.update: updates/sec of the eager agent against the agent with
+# --compile, on random transitions so no environment or traffic data is needed. The first
+# --warmup updates of each agent are timed separately, for the compiled one they include compilation.
+parser = argparse.ArgumentParser()
+parser.add_argument('--state_dim', default=27, type=int)
+parser.add_argument('--batch_size', default=128, type=int)
+parser.add_argument('--hidden', default=256, type=int)
+parser.add_argument('--q_ensemble', default=0, type=int)
+parser.add_argument('--warmup', default=20, type=int)
+parser.add_argument('--updates', default=500, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+args = parser.parse_args()
+
+def makeAgent(compile):
+    agentArgs = SimpleNamespace(gamma=1, tau=0.005, alpha=0.2, is_discrete=False, automatic_entropy_tuning=True,
+                                buffer_type='list', num_hidden_units_per_layer=args.hidden, hidden_size=args.hidden,
+                                learning_rate=1e-4, policy_type='Gaussian', q_ensemble=args.q_ensemble, compile=compile)
+    actionSpace = SimpleNamespace(shape=(1,), high=np.array([1.]), low=np.array([-1.]))
+    agent = SAC(args.state_dim, actionSpace, {}, args.device, agentArgs)
+    for _ in range(10*args.batch_size):
+        state = np.random.randn(args.state_dim).astype(np.float32)
+        nextState = np.random.randn(args.state_dim).astype(np.float32)
+        agent.replay_buffer.push((state, nextState, np.random.uniform(-1, 1, 1), np.random.randn(), 0., np.zeros(1)))
+    return agent
+
+def timeUpdates(agent, n):
+    tStart = time.time()
+    for _ in range(n):
+        agent.update(args.batch_size)
+    agent.metrics()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return time.time()-tStart
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    np.random.seed(0)
+    print('device {}  batch {}  hidden {}  q_ensemble {}'.format(args.device, args.batch_size, args.hidden, args.q_ensemble))
+    rate = {}
+    for compile in [False, True]:
+        agent = makeAgent(compile)
+        tWarm = timeUpdates(agent, args.warmup)
+        tRun = timeUpdates(agent, args.updates)
+        COMPILED = agent.critic_loss_fn.compiled is not None
+        name = 'compiled' if compile else 'eager'
+        if compile and not COMPILED:
+            name += ' (fell back to eager)'
+        rate[compile] = args.updates/tRun
+        print('{:<24s} warmup {:7.2f}s  {:8.1f} updates/s'.format(name, tWarm, rate[compile]))
+    print('speedup {:.2f}x'.format(rate[True]/rate[False]))
@@ -0,0 +1,16 @@
+import argparse
+import time
+from Env.TrafficCache import buildTrafficCache
+
+# Convert the VISSIM traffic export (.h5, or .mat with --old_fashion) into the memory-mapped
+# columnar cache read by SimpleSpeed, then train with options={'TrafficCache': cache_dir}
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', type=str, default='/mnt/d/RL/traindata.mat')
+parser.add_argument('--cache_dir', type=str, default='/mnt/d/RL/traindata_cache')
+parser.add_argument('--old_fashion', default=False, type=bool) # scipy.io.loadmat format
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    tStart = time.time()
+    nVeh, nSample = buildTrafficCache(args.data_path, args.cache_dir, OLD_FASHION=args.old_fashion)
+    print('cached {} vehicles, {} samples to {} in {:.1f}s'.format(nVeh, nSample, args.cache_dir, time.time()-tStart))
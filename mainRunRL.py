@@ -7,6 +7,7 @@ from datetime import datetime
 import os, sys, random
 from copy import deepcopy
 from torch.utils.tensorboard import SummaryWriter
+from OptMethods.lib.AgentArgs import add_common_args, add_ref_encoder_args
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 parser = argparse.ArgumentParser()
 parser.add_argument('--tau',  default=0.005, type=float) # target smoothing coefficient
@@ -30,6 +31,8 @@ parser.add_argument('--load', default=False, type=bool) # load model
 #parser.add_argument('--render_interval', default=100, type=int) # after render_interval, the env.render() will work
 parser.add_argument('--hidden_size', default=256, type=int)
 parser.add_argument("--buffer_warm_size", type=int, default=256)
+add_common_args(parser)
+add_ref_encoder_args(parser)
 parser.add_argument('--alpha', type=float, default=0.2, metavar='G',
                     help='Temperature parameter α determines the relative importance of the entropy\
                             term against the reward (default: 0.2)')
@@ -116,6 +119,7 @@ elif args.ENV_NAME == 'LQT':
     args.is_discrete = False
     args.SELECT_OBSERVATION = 'ref'
     Env = LQT(args=args)
+    args.horizon = Env.N
     state_dim = Env.x_dim
     action_dim = Env.u_dim
     args.obs_dim = Env.obs_dim
@@ -202,10 +206,13 @@ import OptMethods
 def main():
     print(f"========= Exp Name: {MODEL_NAME}   Env: {args.ENV_NAME.lower()}   Agent: {args.OPT_METHODS.upper()} ===========")
     agent = getattr(OptMethods, '{}'.format(args.OPT_METHODS.upper()))(state_dim, action_space, ScalingDict, device, args)
+    # optimal LQ tracking baseline for the validation episodes
+    lqtSolver = OptMethods.LQTRiccati(Env) if args.ENV_NAME == 'LQT' else None
 
     episode_reward = 0
     iStepEvaluation = 0 # number of evaluation steps
     total_numsteps = 0
+    num_updates = 0
 
     from collections import deque
     short_term_buffer = deque(maxlen=args.num_buffer)
@@ -253,21 +260,19 @@ def main():
                         writer.add_scalar(f'Trajectory/Episode_{i}/x_traj', dp[Env.k-1,0], t)
                         writer.add_scalar(f'Trajectory/Episode_{i}/y_traj', dp[Env.k-1,1], t)
 
-                if len(agent.replay_buffer.storage) >= args.buffer_warm_size:
+                if len(agent.replay_buffer) >= args.buffer_warm_size:
                     Info = {'done': done}
-                    for iUp in range(args.update_iteration):
-                        Info['iUpdate'] = iUp
-                        if Multi_buffer:      
-                            Q_loss, policy_loss, alpha_loss, alpha = agent.update(args.batch_size)
-                            for k in range(agent.num_Q):
-                                writer.add_scalar(f'Loss/Q{k+1}', Q_loss[k], i)
-                        else:
-                            q1_loss, q2_loss, policy_loss, alpha_loss, alpha= agent.update(args.batch_size, Info)
-                            writer.add_scalar(f'Loss/Q1', q1_loss, i)
-                            writer.add_scalar(f'Loss/Q2', q2_loss, i)
-                        writer.add_scalar(f'Loss/Policy', policy_loss, i)
-                        writer.add_scalar(f'Loss/Alpha_loss', alpha_loss, i)
-                        writer.add_scalar(f'Loss/Alpha', alpha, i)
+                    if hasattr(agent, 'update_many'):
+                        # all update_iteration minibatches are drawn and moved to the device at once
+                        agent.update_many(args.update_iteration, args.batch_size, Info)
+                    else:
+                        for iUp in range(args.update_iteration):
+                            Info['iUpdate'] = iUp
+                            agent.update(args.batch_size, Info)
+                    num_updates += args.update_iteration
+                    if num_updates % args.loss_log_interval < args.update_iteration:
+                        for name, value in agent.metrics().items():
+                            writer.add_scalar(f'Loss/{name}', value, i)
                 if done:
                     break
             
@@ -279,11 +284,15 @@ def main():
                 if (args.ENABLE_VALIDATION) :
                     avg_reward = 0.
                     episodes = 5
+                    dpList, x0List, costList = [], [], []
                     for _  in range(episodes):
                         state, _ = Env.reset(random_state=True)
                         episode_reward = 0
                         done = False
                         dp = Env.dp
+                        if lqtSolver is not None:
+                            dpList.append(dp)
+                            x0List.append(Env.x.clone())
                         for t in count():
                             action = agent.select_action(state, ref=dp, evaluate=True)
                             next_state, reward, terminated, truncated, _ = Env.step(action)
@@ -308,6 +317,7 @@ def main():
                                 writer.add_scalar(f'Test/Ep_{i}/y_traj', dp[Env.k-1,1], t)
                                 
                             avg_reward += episode_reward
+                        costList.append(-float(episode_reward))
                         try:
                             ref = agent.get_ref(state)
                             ref = ref.detach().cpu().numpy().squeeze()
@@ -323,6 +333,10 @@ def main():
                             pass
                     avg_reward /= episodes
                     writer.add_scalar(f'Episode/Test/Reward', avg_reward, i)
+                    if lqtSolver is not None:
+                        gap, costOpt, tSolve = lqtSolver.optimalityGap(np.stack(dpList), torch.stack(x0List), costList)
+                        writer.add_scalar(f'Episode/Test/OptimalityGap', gap.mean().item(), i)
+                        print("Optimality gap to LQT Riccati: {:.2%} (optimal cost {:.4f}, solved in {:.1f} ms)".format(gap.mean().item(), costOpt.mean().item(), tSolve*1e3))
                     iStepEvaluation += 1
                     print("----------------------------------------")
                     print("Test Episodes: {}, Avg. Reward: {} ".format(episodes, avg_reward, 2))
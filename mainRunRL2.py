@@ -8,6 +8,7 @@ import os, sys, random
 from copy import deepcopy
 import time
 from torch.utils.tensorboard import SummaryWriter
+from OptMethods.lib.AgentArgs import add_common_args
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 parser = argparse.ArgumentParser()
 parser.add_argument('--tau',  default=0.005, type=float) # target smoothing coefficient
@@ -31,6 +32,7 @@ parser.add_argument('--load', default=False, type=bool) # load model
 #parser.add_argument('--render_interval', default=100, type=int) # after render_interval, the env.render() will work
 parser.add_argument('--hidden_size', default=256, type=int)
 parser.add_argument("--buffer_warm_size", type=int, default=256)
+add_common_args(parser)
 parser.add_argument('--alpha', type=float, default=0.2, metavar='G',
                     help='Temperature parameter α determines the relative importance of the entropy\
                             term against the reward (default: 0.2)')
@@ -190,6 +192,7 @@ def main():
     episode_reward = 0
     iStepEvaluation = 0 # number of evaluation steps
     total_numsteps = 0
+    num_updates = 0
     for i in range(1, args.max_episode):
             episode_steps = 0
             state, _ = Env.reset()
@@ -216,16 +219,19 @@ def main():
                     writer.add_scalar(f'Trajectory/Episode_{i}/CarFollowing', dfk, t)
                     writer.add_scalar(f'Trajectory/Episode_{i}/dp', dp[Env.k-1], t)
 
-                if len(agent.replay_buffer.storage) >= args.buffer_warm_size:
+                if len(agent.replay_buffer) >= args.buffer_warm_size:
                     Info = {'done': done}
-                    for iUp in range(args.update_iteration):
-                        Info['iUpdate'] = iUp
-                        q1_loss, q2_loss, policy_loss, alpha_loss, alpha = agent.update(args.batch_size, Info)
-                        writer.add_scalar(f'Loss/Q1', q1_loss, i)
-                        writer.add_scalar(f'Loss/Q2', q2_loss, i)
-                        writer.add_scalar(f'Loss/Policy', policy_loss, i)
-                        writer.add_scalar(f'Loss/Alpha_loss', alpha_loss, i)
-                        writer.add_scalar(f'Loss/Alpha', alpha, i)
+                    if hasattr(agent, 'update_many'):
+                        # all update_iteration minibatches are drawn and moved to the device at once
+                        agent.update_many(args.update_iteration, args.batch_size, Info)
+                    else:
+                        for iUp in range(args.update_iteration):
+                            Info['iUpdate'] = iUp
+                            agent.update(args.batch_size, Info)
+                    num_updates += args.update_iteration
+                    if num_updates % args.loss_log_interval < args.update_iteration:
+                        for name, value in agent.metrics().items():
+                            writer.add_scalar(f'Loss/{name}', value, i)
                 if done:
                     xn = state
                     rn = reward
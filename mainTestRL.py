@@ -1,4 +1,6 @@
 import torch
+from Env import Linear
+from OptMethods.OptimalEval import LinearRiccati, evaluatePolicy, stateGrid, verifyBaseline
 
 def load_critic(path):
     critic = torch.load(path)
@@ -6,17 +8,18 @@ def load_critic(path):
 
 
 
-def get_full_state(critic):
-    N=10
-    for i in range(100):
-        UK_RL = []
-        UK_RICCATI = []
-        for k in range(N):
-            x = torch.tensor([0.01*i-0.5,k])
-            uk_rl = critic.select_action(x)
-            uk_riccati = -(1/(N-k+2))*x[0]
-            print(f"RL: {uk_rl.item()}, RICCATI: {uk_riccati}, k: {k}")
-            UK_RL.append(uk_rl.item())
-            UK_RICCATI.append(uk_riccati)
-       
-
+def get_full_state(critic, Env=None, N=10):
+    # RL actions against the Riccati optimum of Env.Linear's own reward on the grid x in [-0.5, 0.49] and
+    # observation slots k <= N-2 (the last ones with an action left), in one batch
+    if Env is None:
+        Env = Linear()
+        Env.N = N
+    solver = LinearRiccati(Env)
+    x, k = stateGrid(torch.arange(100)*0.01-0.5, torch.arange(Env.N-1))
+    err = verifyBaseline(Env, solver, x, k)
+    print("Riccati baseline matches the env rollout, relative cost error {:.2e}".format(err))
+    stats, UK_RL, UK_RICCATI, _ = evaluatePolicy(critic, solver, x, k)
+    print("RL vs. RICCATI: mae {:.4f}, rmse {:.4f}, max {:.4f}".format(stats['mae'], stats['rmse'], stats['max']))
+    for kk, err in zip(stats['k'].tolist(), stats['maePerK'].tolist()):
+        print(f"k: {kk}, mae: {err}")
+    return stats, UK_RL, UK_RICCATI